@@ -2,25 +2,40 @@
 """ESXi Kickstart Floppy API - generates and serves ESXi kickstart floppy images."""
 
 import datetime
+import hashlib
+import json
 import os
-import re
 import secrets
-import shutil
-import warnings
+import threading
+import time
+from collections import OrderedDict
 from io import BytesIO
 
-import fs
-import pycdlib
-from apiflask import APIFlask, APIKeyHeaderAuth, EmptySchema, FileSchema, Schema, abort
-from apiflask.fields import Boolean, DateTime, File, Integer, IPv4, List, String
-from apiflask.validators import Range, Regexp
-from flask import request, send_file, url_for
-from flask_apscheduler import APScheduler
-from flask_sqlalchemy import SQLAlchemy
-from marshmallow import ValidationError, validates_schema
-from pycdlib.pycdlibexception import PyCdlibException
+import click
+import sqlalchemy
+from apiflask import APIFlask, FileSchema, Schema, abort
+from apiflask.fields import Boolean, DateTime, Integer, IPv4, List, Nested, String
+from apiflask.validators import Length, Range, Regexp
+from flask import Response, g, request, send_file, stream_with_context, url_for
+from marshmallow import ValidationError, validates, validates_schema
+from werkzeug.http import is_resource_modified
 from werkzeug.utils import secure_filename
 
+import esxi
+import metrics
+import profiles
+import tokenstore
+from expiry import ExpiryQueue, SchedulerLeader
+from extensions import (auth, cleanup_deleted, cleanup_reclaimed_bytes, db, http_request_seconds,
+                        http_requests, image_pool_depth, image_reuses, live_images,
+                        metrics_registry, observe_request_stage, require_admin, stage_seconds,
+                        stored_bytes)
+from imagestore import (ImageStoreFull, get_blank_pool, get_floppy_template, get_image_store,
+                        image_store_bytes, open_floppy_image, store_floppy_image)
+from kstemplates import TEMPLATE_NAME, TemplateError, TemplateRegistry
+from models import GroupCommit, KickstartFloppyModel, KickstartSourceModel
+from tokenstore import HashedTokenStore
+
 
 # Validator for fields interpolated into kickstart directives.
 # Blocks whitespace (same-line flag injection), leading dashes (flag-lookalike values),
@@ -43,6 +58,7 @@ _FIRSTDISK_VALUE = Regexp(
           'backslashes'
 )
 
+
 class KickstartFloppyIn(Schema):
     """Input schema for creating a kickstart floppy image."""
 
@@ -61,6 +77,13 @@ class KickstartFloppyIn(Schema):
     clearpart_overwritevmfs = Boolean(required=False, load_default=False)
     allowed_ip = IPv4(required=True)
     timeout_minutes = Integer(required=False, load_default=60, validate=Range(min=1, max=1440))
+    template = String(required=False, load_default='default', validate=Regexp(TEMPLATE_NAME))
+
+    @validates('template')
+    def validate_template(self, value, **_):
+        """Ensure the named kickstart template exists."""
+        if kickstart_templates.get(value) is None:
+            raise ValidationError(f'Unknown kickstart template "{value}".')
 
     @validates_schema
     def validate_disk_options(self, data, **_):
@@ -79,6 +102,28 @@ class KickstartFloppyIn(Schema):
             raise ValidationError('"clearpart_overwritevmfs" requires "clearpart" to be true.')
 
 
+class KickstartTemplateIn(Schema):
+    """Input schema for registering a kickstart template."""
+
+    template = String(required=True, validate=Length(min=1, max=65536))
+
+
+class KickstartTemplateOut(Schema):
+    """Output schema describing a kickstart template."""
+
+    name = String(required=True)
+    sha256 = String(required=True)
+    builtin = Boolean(required=True)
+    template = String(required=False)
+    error = String(required=False)
+
+
+class KickstartTemplatesOut(Schema):
+    """Output schema listing the kickstart templates."""
+
+    templates = List(Nested(KickstartTemplateOut), required=True)
+
+
 class KickstartFloppyOut(Schema):
     """Output schema for the created kickstart floppy image."""
 
@@ -87,18 +132,7 @@ class KickstartFloppyOut(Schema):
     allowed_ip = String(required=True)
     expires_at = DateTime(required=True)
 
-class EsxiIsoIn(Schema):
-    """Input schema for uploading an ESXi ISO file."""
 
-    file = File(required=True)
-
-class EsxiIsosOut(Schema):
-    """Output schema listing available ESXi ISO URLs."""
-
-    iso_urls = List(String(), required=True, allow_none=True)
-
-
-db = SQLAlchemy()
 app = APIFlask(__name__, title='ESXi Kickstart Floppy API')
 application = app # for mod_wsgi compatibility
 DATABASE = 'ks.db'
@@ -108,8 +142,38 @@ app.config['MAX_CONTENT_LENGTH'] = 1024 * 1024 * 1024  # 1GB max-limit
 app.config['ESXI_ISOS_PATH'] = os.path.join(app.instance_path, 'esxi')
 app.config['KICKSTART_IMAGE_PATH'] = os.path.join(app.instance_path, 'ks')
 app.config['ESXI_STATIC_URL'] = 'esxi-static'
-db.init_app(app)
-auth = APIKeyHeaderAuth()
+app.config['KICKSTART_IMAGE_STORE'] = 'filesystem'  # filesystem, database or memory
+app.config['KICKSTART_IMAGE_MEMORY_BUDGET'] = 256 * 1024 * 1024  # bytes, memory store only
+app.config['KICKSTART_LAZY_IMAGES'] = False  # build images on first download instead of on POST
+app.config['KICKSTART_BATCH_MAX'] = 1000  # items accepted by a single POST /ks/batch
+app.config['KICKSTART_BATCH_COMMIT_SIZE'] = 100  # rows per transaction when streaming NDJSON
+app.config['KICKSTART_CLEANUP_BATCH_SIZE'] = 500  # expired rows deleted per cleanup transaction
+app.config['KICKSTART_REUSE_IMAGES'] = True  # share one stored image between identical kickstarts
+app.config['KICKSTART_METADATA_CACHE_SIZE'] = 10000  # floppies GET /ks remembers per process
+app.config['KICKSTART_NEGATIVE_CACHE_SECONDS'] = 5  # unknown image names are remembered this long
+# How often the scheduler process looks for floppies created by other processes, 0 to never.
+app.config['KICKSTART_EXPIRY_RESYNC_SECONDS'] = 300
+app.config['SCHEDULER_LOCK_FILE'] = os.path.join(app.instance_path, 'scheduler.lock')
+app.config['BACKGROUND_JOBS'] = True  # take part in the election of the cleanup process
+app.config['ESXI_UPLOAD_TIMEOUT_HOURS'] = 24  # unfinished uploads are discarded after this
+app.config['ESXI_ASYNC_JOBS'] = False  # always process uploaded ISOs in background jobs
+app.config['ESXI_JOB_WORKERS'] = 2  # ISO processing jobs run at the same time
+app.config['KICKSTART_IMAGE_POOL_SIZE'] = 0  # blank images kept ready for the filesystem store
+app.config['KICKSTART_IMAGE_POOL_IDLE_SECONDS'] = 0.1  # quiet time before the pool is refilled
+app.config['TOKENS'] = {}
+app.config['TOKEN_FILE'] = os.path.join(app.instance_path, 'token_hashes.json')
+app.config['TOKEN_INDEX_KEY'] = ''  # HMAC key for looking up hashed tokens, keep it secret
+app.config['TOKEN_CACHE_TTL'] = 60  # seconds a verified hashed token is trusted without rehashing
+app.config['TOKEN_CACHE_SIZE'] = 1024
+# WAL journal, busy timeouts, a larger pool and group commits for multi-process deployments.
+app.config['DATABASE_PRODUCTION_MODE'] = False
+app.config['DATABASE_BUSY_TIMEOUT'] = 30  # seconds a connection waits for a database lock
+app.config['DATABASE_POOL_SIZE'] = 10  # pooled connections per process in production mode
+app.config['METRICS_REQUIRE_TOKEN'] = False  # require an API token for GET /metrics
+app.config['KICKSTART_TEMPLATE_PATH'] = os.path.join(app.instance_path, 'templates')
+app.config['ADMIN_TOKEN_NAMES'] = []  # names of the tokens that may profile requests
+app.config['PROFILE_PATH'] = os.path.join(app.instance_path, 'profiles')
+app.config['PROFILE_KEEP'] = 50  # request profiles kept before the oldest are removed
 try:
     app.config.from_pyfile(os.path.join(app.instance_path, 'tokens.py'))
 except FileNotFoundError:
@@ -120,79 +184,368 @@ except FileNotFoundError:
 tokens = app.config['TOKENS']
 
 
-class KickstartFloppyModel(db.Model):  # pylint: disable=too-few-public-methods
-    """SQLAlchemy model for tracking kickstart floppy images."""
+def set_sqlite_pragmas(dbapi_connection, _connection_record):
+    """Put a new SQLite connection in WAL mode with relaxed syncing and a busy timeout.
+
+    In WAL mode readers never block the writer, and ``synchronous=NORMAL``
+    only syncs at checkpoints, which is still safe against corruption.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute(f"PRAGMA busy_timeout={int(app.config['DATABASE_BUSY_TIMEOUT'] * 1000)}")
+    cursor.close()
+
+
+# Read once: the engine is set up for one mode or the other and the rest of
+# the app has to follow it, whatever the config says later.
+database_production_mode = app.config['DATABASE_PRODUCTION_MODE']
+if database_production_mode:
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': app.config['DATABASE_POOL_SIZE'],
+        'max_overflow': app.config['DATABASE_POOL_SIZE'],
+        'pool_timeout': app.config['DATABASE_BUSY_TIMEOUT'],
+        'connect_args': {'timeout': app.config['DATABASE_BUSY_TIMEOUT']},
+        **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}),
+    }
+db.init_app(app)
+if database_production_mode:
+    with app.app_context():
+        sqlalchemy.event.listen(db.engine, 'connect', set_sqlite_pragmas)
+
+
+def token_index_key():
+    """Return TOKEN_INDEX_KEY as bytes."""
+    key = app.config['TOKEN_INDEX_KEY']
+    return key.encode() if isinstance(key, str) else key
+
+
+if not app.config['TOKEN_INDEX_KEY'] and os.path.exists(app.config['TOKEN_FILE']):
+    app.logger.warning("TOKEN_INDEX_KEY is not set, so the tokens in %s are indexed "
+                       "with an empty key", app.config['TOKEN_FILE'])
+token_store = HashedTokenStore(app.config['TOKEN_FILE'], token_index_key(),
+                               app.config['TOKEN_CACHE_TTL'], app.config['TOKEN_CACHE_SIZE'])
+
 
-    id = db.Column(db.Integer, primary_key=True)
-    image_file = db.Column(db.String(12), unique=True, nullable=False)
-    image_url = db.Column(db.String(255), unique=True, nullable=False)
-    allowed_ip = db.Column(db.String(39), nullable=False)
-    expires_at = db.Column(db.DateTime, nullable=False)
+def image_blob_column():
+    """Return the name of the stored image of a KickstartFloppyModel row, as a column."""
+    return db.func.coalesce(KickstartFloppyModel.image_blob,
+                            KickstartFloppyModel.image_file).label('image_blob')
 
-    def __init__(self, image_file, image_url, allowed_ip, expires_at):
-        self.image_file = image_file
-        self.image_url = image_url
+
+class CachedFloppy:  # pylint: disable=too-few-public-methods
+    """The parts of a KickstartFloppyModel row that GET /ks needs.
+
+    ``validators``, the image's ETag and Last-Modified time, is filled in
+    when the image is first served, and ``gzipped``, the image compressed
+    for ``Content-Encoding: gzip``, when it is first served compressed; the
+    image never changes once stored.
+    """
+
+    def __init__(self, allowed_ip, expires_at, image_blob):
         self.allowed_ip = allowed_ip
         self.expires_at = expires_at
+        self.image_blob = image_blob
+        self.validators = None
+        self.gzipped = None
+
+
+class FloppyMetadataCache:
+    """Read-through LRU cache of floppy metadata for GET /ks, keyed by image file.
+
+    Holds up to KICKSTART_METADATA_CACHE_SIZE entries. An entry is kept
+    until its floppy expires; a name with no live floppy is remembered for
+    KICKSTART_NEGATIVE_CACHE_SECONDS, so requests for random names do not
+    each reach the database.
+    """
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, image_file):
+        """Return the CachedFloppy for a live floppy, or None, loading it on a miss."""
+        now = datetime.datetime.now()
+        with self.lock:
+            entry = self.entries.get(image_file)
+            if entry is not None and entry[1] > now:
+                self.entries.move_to_end(image_file)
+                return entry[0]
+        row = db.session.execute(
+            db.select(KickstartFloppyModel.allowed_ip, KickstartFloppyModel.expires_at,
+                      image_blob_column())
+            .where(KickstartFloppyModel.image_file == image_file)).one_or_none()
+        if row is None or row.expires_at <= now:
+            record = None
+            valid_until = now + datetime.timedelta(
+                seconds=self.app.config['KICKSTART_NEGATIVE_CACHE_SECONDS'])
+        else:
+            record = CachedFloppy(row.allowed_ip, row.expires_at, row.image_blob)
+            valid_until = row.expires_at
+        with self.lock:
+            self.entries[image_file] = (record, valid_until)
+            self.entries.move_to_end(image_file)
+            while len(self.entries) > self.app.config['KICKSTART_METADATA_CACHE_SIZE']:
+                self.entries.popitem(last=False)
+        return record
+
+    def discard(self, image_file):
+        """Forget ``image_file``."""
+        with self.lock:
+            self.entries.pop(image_file, None)
+
+    def clear(self):
+        """Forget every entry."""
+        with self.lock:
+            self.entries.clear()
 
 
-with app.app_context():
-    db.create_all()
+floppy_cache = FloppyMetadataCache(app)
 
 
-if not os.path.exists(app.config['KICKSTART_IMAGE_PATH']):
-    os.mkdir(app.config['KICKSTART_IMAGE_PATH'])
-if not os.path.exists(app.config['ESXI_ISOS_PATH']):
-    os.mkdir(app.config['ESXI_ISOS_PATH'])
+# How long a floppy must still be live for a new floppy to reuse its image.
+REUSE_MIN_REMAINING = datetime.timedelta(minutes=1)
 
 
-scheduler = APScheduler()
-scheduler.init_app(app)
+# The fields a kickstart template can use, all taken from validated KickstartFloppyIn data.
+KICKSTART_TEMPLATE_FIELDS = (
+    'hostname', 'rootpw', 'ip', 'netmask', 'gateway', 'nameserver', 'device',
+    'addvmportgroup', 'vlanid_option', 'disk_option', 'clearpart_line',
+)
+DEFAULT_KICKSTART_TEMPLATE = (
+    "vmaccepteula\n"
+    "rootpw --iscrypted {{ rootpw }}\n"
+    "{{ clearpart_line }}"
+    "install {{ disk_option }} --preservevmfs\n"
+    "network --bootproto=static --device={{ device }}"
+    " --ip={{ ip }} --gateway={{ gateway }} --nameserver={{ nameserver }}"
+    " --netmask={{ netmask }} --hostname={{ hostname }}"
+    " --addvmportgroup={{ addvmportgroup }}{{ vlanid_option }}\n"
+    "reboot\n"
+    "\n"
+    "%post --interpreter=busybox --ignorefailure=true\n"
+    "# check if the ilo tools are installed\n"
+    "# if they are, then assume the floppy is mounted via ilo\n"
+    "if [ -f /opt/ilorest/bin/ilorest.sh ]; then\n"
+    "  # eject the virtual floppy from the iLO\n"
+    "  /opt/ilorest/bin/ilorest.sh virtualmedia 1 --remove\n"
+    "fi\n"
+)
+kickstart_templates = TemplateRegistry(app.config['KICKSTART_TEMPLATE_PATH'],
+                                       KICKSTART_TEMPLATE_FIELDS,
+                                       {'default': DEFAULT_KICKSTART_TEMPLATE})
+
+
+scheduler = None  # pylint: disable=invalid-name
 
 
-@scheduler.task('interval', id='cleanup', seconds=60)
 def cleanup():
-    """Delete expired kickstart floppy entries and their image files."""
+    """Delete expired kickstart floppy entries and their images.
+
+    Expired rows are deleted with one indexed ``DELETE ... RETURNING`` per
+    batch of KICKSTART_CLEANUP_BATCH_SIZE, so no transaction holds the
+    database for long however many images expire at once. Returns the
+    number of entries removed and the bytes of image data reclaimed.
+    """
+    entries = reclaimed = 0
     with app.app_context():
-        expired_items = KickstartFloppyModel.query.filter(
-            KickstartFloppyModel.expires_at < datetime.datetime.now()).all()
-        if len(expired_items) > 0:
-            app.logger.info("%d expired entries found", len(expired_items))
-            for item in expired_items:
-                app.logger.info("Deleting expired entry: %s", item.image_file)
-                image_path = os.path.join(app.config['KICKSTART_IMAGE_PATH'], item.image_file)
-                try:
-                    os.remove(image_path)
-                except FileNotFoundError:
-                    app.logger.warning(
-                        "Image file not found during cleanup, skipping removal: %s",
-                        image_path,
-                    )
-                db.session.delete(item)
+        image_store = get_image_store()
+        batch_size = app.config['KICKSTART_CLEANUP_BATCH_SIZE']
+        while True:
+            expired = db.select(KickstartFloppyModel.id).where(
+                KickstartFloppyModel.expires_at < datetime.datetime.now()).limit(batch_size)
+            rows = db.session.execute(
+                db.delete(KickstartFloppyModel)
+                .where(KickstartFloppyModel.id.in_(expired.scalar_subquery()))
+                .returning(KickstartFloppyModel.image_file, image_blob_column())).all()
+            if not rows:
+                break
+            image_files = [row.image_file for row in rows]
+            # Images shared with floppies that have not expired are kept.
+            blobs = {row.image_blob for row in rows}
+            blobs -= set(db.session.execute(
+                db.select(KickstartFloppyModel.image_blob)
+                .where(KickstartFloppyModel.image_blob.in_(blobs))).scalars())
+            lazy = set(db.session.execute(
+                db.delete(KickstartSourceModel)
+                .where(KickstartSourceModel.image_file.in_(image_files))
+                .returning(KickstartSourceModel.image_file)).scalars())
             db.session.commit()
-
-
-scheduler.start()
+            removed = image_store.delete_many(sorted(blobs))
+            db.session.commit()
+            for image_file in image_files:
+                floppy_cache.discard(image_file)
+            # Lazily created images that were never downloaded have nothing stored.
+            missing = blobs - lazy - set(removed)
+            if missing:
+                app.logger.warning("Images not found during cleanup: %s",
+                                   ', '.join(sorted(missing)))
+            entries += len(rows)
+            reclaimed += sum(removed.values())
+            cleanup_deleted.inc(len(rows))
+            cleanup_reclaimed_bytes.inc(sum(removed.values()))
+            if len(rows) < batch_size:
+                break
+    if entries:
+        app.logger.info("Cleanup removed %d expired entries, reclaiming %d bytes",
+                        entries, reclaimed)
+    return entries, reclaimed
+
+
+def start_background_jobs():
+    """Start the scheduler in the elected process."""
+    global scheduler  # pylint: disable=global-statement
+    app.logger.info("Process %d is running background jobs", os.getpid())
+    # APScheduler is only imported by the one process that runs it.
+    from flask_apscheduler import APScheduler  # pylint: disable=import-outside-toplevel
+    scheduler = APScheduler()
+    scheduler.init_app(app)
+    scheduler.add_job('cleanup_uploads', esxi.cleanup_uploads, args=(app,), trigger='interval',
+                      hours=1)
+    expiry_queue.scheduler = scheduler
+    expiry_queue.seed()
+    scheduler.start()
+
+
+expiry_queue = ExpiryQueue(app, cleanup)
+scheduler_leader = SchedulerLeader(app.config['SCHEDULER_LOCK_FILE'], start_background_jobs)
+initialized = threading.Event()
+initialize_lock = threading.Lock()
+
+
+def add_missing_columns():
+    """Add the nullable columns of newer versions to tables created by older ones."""
+    preparer = db.engine.dialect.identifier_preparer
+    inspector = sqlalchemy.inspect(db.engine)
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing or not column.nullable:
+                    continue
+                app.logger.info("Adding column %s.%s", table.name, column.name)
+                connection.execute(sqlalchemy.text(
+                    f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN '
+                    f'{preparer.format_column(column)} '
+                    f'{column.type.compile(dialect=db.engine.dialect)}'))
+
+
+@app.before_request
+def initialize():
+    """Create the database tables and directories and join the scheduler election.
+
+    Run once, before the first request a process handles, so that
+    importing the module (as every WSGI worker and the CLI do) stays cheap.
+    """
+    if initialized.is_set():
+        return
+    with initialize_lock:
+        if initialized.is_set():
+            return
+        db.create_all()
+        # create_all does not add columns or indexes to tables created by older versions.
+        add_missing_columns()
+        for index in KickstartFloppyModel.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
+        os.makedirs(app.config['KICKSTART_IMAGE_PATH'], exist_ok=True)
+        os.makedirs(app.config['ESXI_ISOS_PATH'], exist_ok=True)
+        get_blank_pool()  # start filling the pool before the first POST /ks
+        if app.config['BACKGROUND_JOBS']:
+            scheduler_leader.start()
+        initialized.set()
+
+
+@app.before_request
+def start_request_timer():
+    """Note when a request started, for the request and stage duration metrics."""
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    """Count the response and observe how long the request took."""
+    started = g.get('request_started')
+    if started is not None:
+        endpoint = request.endpoint or 'none'
+        http_requests.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+        http_request_seconds.observe(time.perf_counter() - started, endpoint=endpoint)
+    return response
+
+
+# Registered after the hooks above, so that profiling starts after the request
+# timer and its profile is saved before the request is counted.
+app.request_class = esxi.KickstartRequest
+app.register_blueprint(esxi.bp)
+app.register_blueprint(profiles.bp)
 
 
 @auth.verify_token
 def verify_token(token):
-    """Return the identity for a valid API token, or None."""
+    """Return the identity for a valid API token, or None.
+
+    Tokens are checked against the hashed TOKEN_FILE, then the plaintext
+    TOKENS from tokens.py.
+    """
+    identity = token_store.verify(token)
+    if identity is not None:
+        return identity
     if token in tokens:
         return tokens[token]
     return None
 
 
-@app.post('/ks')
-@app.auth_required(auth)
-@app.input(KickstartFloppyIn, location='json')
-@app.output(KickstartFloppyOut, status_code=201)
-def create_kickstart_floppy(json_data):  # pylint: disable=too-many-locals
-    """Create a kickstart floppy image and return its metadata."""
+@app.cli.command('add-token')
+@click.argument('name')
+def add_token_command(name):
+    """Create an API token called NAME and store its hash in TOKEN_FILE."""
+    token = tokenstore.add_token(app.config['TOKEN_FILE'], name, token_index_key())
+    click.echo(token)
+
+
+@app.cli.command('remove-token')
+@click.argument('name')
+def remove_token_command(name):
+    """Remove every API token called NAME from TOKEN_FILE."""
+    removed = tokenstore.remove_tokens(app.config['TOKEN_FILE'], name)
+    click.echo(f'Removed {removed} token(s) called {name}')
+
+
+@app.get('/metrics')
+@app.auth_required(auth, optional=True)
+@app.doc(responses={200: 'Metrics in the Prometheus text format'})
+def get_metrics():
+    """Report request, stage, cleanup and storage metrics in the Prometheus text format.
+
+    No token is needed unless METRICS_REQUIRE_TOKEN is set. The values are
+    those of the process that answers the request.
+    """
+    if app.config['METRICS_REQUIRE_TOKEN'] and auth.current_user is None:
+        abort(401)
+    live_images.set(db.session.execute(
+        db.select(db.func.count()).select_from(KickstartFloppyModel)
+        .where(KickstartFloppyModel.expires_at > datetime.datetime.now())).scalar())
+    stored_bytes.set(image_store_bytes(), kind='kickstart_images')
+    pool = get_blank_pool()
+    image_pool_depth.set(pool.depth() if pool is not None else 0)
+    # ISOs with the same contents are hard links to one file.
+    isos = {entry['upload_sha256'] or entry['filename']: entry['size']
+            for entry in esxi.iso_catalog.list()}
+    stored_bytes.set(sum(isos.values()), kind='esxi_isos')
+    return Response(metrics_registry.render(), content_type=metrics.CONTENT_TYPE)
+
+
+def render_kickstart(json_data):
+    """Return the ks.cfg contents for validated KickstartFloppyIn data.
+
+    The fields are worked out from the request and substituted into the
+    kickstart template it names.
+    """
     if 'vlanid' in json_data:
-        vlanid = f" --vlanid={json_data['vlanid']}"
+        vlanid_option = f" --vlanid={json_data['vlanid']}"
     else:
-        vlanid = ""
+        vlanid_option = ""
     if 'disk' in json_data:
         disk_option = f"--disk={json_data['disk']}"
     else:
@@ -209,162 +562,338 @@ def create_kickstart_floppy(json_data):  # pylint: disable=too-many-locals
         clearpart_line += "\n"
     else:
         clearpart_line = ""
-    rootpw = json_data['rootpw']
-    device = json_data['device']
-    ip = json_data['ip']
-    gateway = json_data['gateway']
-    nameserver_str = ",".join(str(x) for x in json_data['nameserver'])
-    netmask = json_data['netmask']
-    hostname = json_data['hostname']
-    addvmportgroup_val = int(json_data['addvmportgroup'])
-    kickstart_contents = (
-        f"vmaccepteula\n"
-        f"rootpw --iscrypted {rootpw}\n"
-        f"{clearpart_line}"
-        f"install {disk_option} --preservevmfs\n"
-        f"network --bootproto=static --device={device}"
-        f" --ip={ip} --gateway={gateway} --nameserver={nameserver_str}"
-        f" --netmask={netmask} --hostname={hostname}"
-        f" --addvmportgroup={addvmportgroup_val}{vlanid}\n"
-        "reboot\n"
-        "\n"
-        "%post --interpreter=busybox --ignorefailure=true\n"
-        "# check if the ilo tools are installed\n"
-        "# if they are, then assume the floppy is mounted via ilo\n"
-        "if [ -f /opt/ilorest/bin/ilorest.sh ]; then\n"
-        "  # eject the virtual floppy from the iLO\n"
-        "  /opt/ilorest/bin/ilorest.sh virtualmedia 1 --remove\n"
-        "fi\n"
-    )
-    blank_path = os.path.join(app.root_path, 'blank.img')
-    image_file = secrets.token_urlsafe(6) + '.img'
-    floppy_path = os.path.join(app.config['KICKSTART_IMAGE_PATH'], image_file)
-    shutil.copyfile(blank_path, floppy_path)
-    with warnings.catch_warnings():
-        warnings.filterwarnings('ignore', message='Unable to reliably determine FAT type',
-                                category=UserWarning, module='pyfatfs')
-        floppy_fs = fs.open_fs("fat://" + floppy_path + "?offset=512")
-    floppy_fs.create('ks.cfg')
-    floppy_fs.writefile('ks.cfg', BytesIO(kickstart_contents.encode('ascii')))
-    floppy_fs.close()
+    template = kickstart_templates.get(json_data.get('template', 'default'))
+    if template is None:
+        # The template was removed after the request was validated.
+        raise ValidationError(f"Unknown kickstart template \"{json_data['template']}\".",
+                              'template')
+    return template.render({
+        'hostname': json_data['hostname'],
+        'rootpw': json_data['rootpw'],
+        'ip': str(json_data['ip']),
+        'netmask': str(json_data['netmask']),
+        'gateway': str(json_data['gateway']),
+        'nameserver': ",".join(str(x) for x in json_data['nameserver']),
+        'device': json_data['device'],
+        'addvmportgroup': str(int(json_data['addvmportgroup'])),
+        'vlanid_option': vlanid_option,
+        'disk_option': disk_option,
+        'clearpart_line': clearpart_line,
+    })
+
+
+def new_image_file():
+    """Return a random image file name that ``secure_filename`` leaves unchanged.
+
+    ``GET /ks`` looks images up by their secure_filename, which strips a
+    leading underscore that token_urlsafe can produce.
+    """
+    while True:
+        image_file = secrets.token_urlsafe(6) + '.img'
+        if secure_filename(image_file) == image_file:
+            return image_file
+
+
+def find_reusable_image(content_hash):
+    """Return the stored image of a live floppy with the same kickstart, or None.
+
+    Only floppies that stay live for at least REUSE_MIN_REMAINING are
+    considered, so cleanup cannot remove the image before the floppy that
+    reuses it is committed.
+    """
+    return db.session.execute(
+        db.select(image_blob_column())
+        .where(KickstartFloppyModel.content_hash == content_hash,
+               KickstartFloppyModel.expires_at > datetime.datetime.now() + REUSE_MIN_REMAINING)
+        .limit(1)).scalar()
+
+
+def add_kickstart_floppy(json_data):
+    """Build the image for validated KickstartFloppyIn data and add its record to the session.
+
+    A floppy whose kickstart is identical to that of a live floppy shares its
+    stored image instead of building another one. It still gets its own
+    name, allowed IP and expiry time. The caller commits the session. Raises
+    ImageStoreFull when the image cannot be stored.
+    """
+    with stage_seconds.time(operation='kickstart', stage='render_kickstart'):
+        kickstart_contents = render_kickstart(json_data)
+    image_file = new_image_file()
+    image_blob = content_hash = None
+    if app.config['KICKSTART_LAZY_IMAGES']:
+        db.session.add(KickstartSourceModel(image_file, kickstart_contents))
+    else:
+        content_hash = hashlib.sha256(kickstart_contents.encode('ascii')).hexdigest()
+        if app.config['KICKSTART_REUSE_IMAGES']:
+            image_blob = find_reusable_image(content_hash)
+        if image_blob is None:
+            store_floppy_image(image_file, kickstart_contents)
+        else:
+            image_reuses.inc()
 
     current_time = datetime.datetime.now()
     expires_at = current_time + datetime.timedelta(minutes=json_data['timeout_minutes'])
     allowed_ip = str(json_data['allowed_ip'])
     image_url = url_for('get_kickstart_floppy', image_file=image_file,
                         _external=True)
-    floppy_data = KickstartFloppyModel(image_file, image_url, allowed_ip, expires_at)
+    floppy_data = KickstartFloppyModel(image_file, image_url, allowed_ip, expires_at,
+                                       image_blob=image_blob or image_file,
+                                       content_hash=content_hash)
     db.session.add(floppy_data)
-    db.session.commit()
-    app.logger.info("Created %s with access for %s", image_file, allowed_ip)
+    floppy_cache.discard(image_file)
+    expiry_queue.push(expires_at)
     return floppy_data
 
 
-@app.get('/ks/<string:image_file>')
-@app.output(FileSchema,
-            content_type='application/octet-stream', status_code=200)
-def get_kickstart_floppy(image_file):
-    """Serve a kickstart floppy image to the requesting IP if authorized."""
-    filename = secure_filename(image_file)
-    floppy = db.session.execute(
-        db.select(KickstartFloppyModel).filter_by(
-            image_file=filename)).scalar_one_or_none()
+def kickstart_template_info(name, template, source=False):
+    """Return the KickstartTemplateOut dict for a compiled template."""
+    info = {'name': name, 'sha256': template.sha256,
+            'builtin': kickstart_templates.builtin.get(name) is template}
+    if source:
+        info['template'] = template.source
+    if name in kickstart_templates.errors:
+        info['error'] = kickstart_templates.errors[name]
+    return info
 
-    if floppy is None:
-        abort(404, 'File not found')
 
-    if floppy.allowed_ip != request.remote_addr:
-        abort(401, f'{request.remote_addr} is not permitted')
+@app.get('/ks/templates')
+@app.auth_required(auth)
+@app.output(KickstartTemplatesOut, status_code=200)
+def get_kickstart_templates():
+    """List the kickstart templates POST /ks can use."""
+    return {'templates': [kickstart_template_info(name, template)
+                          for name, template in kickstart_templates.list().items()]}
 
-    image_path = os.path.join(app.config['KICKSTART_IMAGE_PATH'], filename)
-    if not os.path.exists(image_path):
-        abort(404, 'File not found')
 
-    app.logger.info("Serving %s for %s", filename, request.remote_addr)
-    return send_file(image_path)
+@app.get('/ks/templates/<string:name>')
+@app.auth_required(auth)
+@app.output(KickstartTemplateOut, status_code=200)
+def get_kickstart_template(name):
+    """Return a kickstart template and its source."""
+    template = kickstart_templates.get(name)
+    if template is None:
+        abort(404, 'Template not found')
+    return kickstart_template_info(name, template, source=True)
 
 
-@app.get('/esxi')
-@app.output(EsxiIsosOut, status_code=200)
-def get_esxi_isos():
-    """Return a list of URLs for available ESXi ISO files."""
-    iso_path = app.config['ESXI_ISOS_PATH']
-    if not os.path.exists(iso_path):
-        return {'iso_urls': []}
-    # Use a configured BASE_URL to avoid Host header injection. Falls back to
-    # request.url_root only if BASE_URL is unset or blank (not recommended for production).
-    base_url = app.config.get('BASE_URL') or request.url_root
-    static_base = base_url.rstrip('/') + '/' + app.config['ESXI_STATIC_URL'].strip('/') + '/'
-    isos = [static_base + f for f in os.listdir(iso_path) if f.endswith('.iso')]
-    return {'iso_urls': isos}
+@app.put('/ks/templates/<string:name>')
+@app.auth_required(auth)
+@app.input(KickstartTemplateIn, location='json')
+@app.output(KickstartTemplateOut, status_code=200)
+def put_kickstart_template(name, json_data):
+    """Register or replace a kickstart template. Admin tokens only.
+
+    The template is compiled before it is stored in KICKSTART_TEMPLATE_PATH,
+    where every process picks it up on its next use. Built-in templates
+    cannot be replaced.
+    """
+    require_admin()
+    if name in kickstart_templates.builtin:
+        abort(403, 'Built-in templates cannot be replaced')
+    try:
+        template = kickstart_templates.put(name, json_data['template'])
+    except TemplateError as e:
+        abort(400, str(e))
+    app.logger.info("Stored kickstart template %s (%s)", name, template.sha256)
+    return kickstart_template_info(name, template, source=True)
 
 
-@app.delete('/esxi/<string:iso_file>')
+@app.delete('/ks/templates/<string:name>')
 @app.auth_required(auth)
 @app.output({}, status_code=204)
-def delete_esxi_iso(iso_file):
-    """Delete an ESXi ISO file by filename."""
-    filename = secure_filename(iso_file)
-    if not filename:
-        abort(400, 'Invalid filename')
-    iso_path = os.path.join(app.config['ESXI_ISOS_PATH'], filename)
-    if not os.path.exists(iso_path):
-        abort(404, 'File not found')
-    os.remove(iso_path)
+def delete_kickstart_template(name):
+    """Remove a registered kickstart template. Admin tokens only."""
+    require_admin()
+    if name in kickstart_templates.builtin:
+        abort(403, 'Built-in templates cannot be removed')
+    if not kickstart_templates.delete(name):
+        abort(404, 'Template not found')
+    app.logger.info("Removed kickstart template %s", name)
     return ''
 
 
-@app.post('/esxi')
+@app.post('/ks')
 @app.auth_required(auth)
-@app.input(EsxiIsoIn, location='files')
-@app.output(EmptySchema,status_code=201)
-def post_esxi_iso(files_data):
-    """Upload an ESXi ISO, patch its boot configuration, and store it."""
-    file = files_data['file']
-    filename = secure_filename(file.filename or '')
-    if not filename:
-        abort(400, 'Invalid filename')
-    iso_path = os.path.join(app.config['ESXI_ISOS_PATH'], filename)
-    file.save(iso_path)
-    iso = pycdlib.PyCdlib()
-    iso_opened = False
+@app.input(KickstartFloppyIn, location='json')
+@app.output(KickstartFloppyOut, status_code=201)
+def create_kickstart_floppy(json_data):
+    """Create a kickstart floppy image and return its metadata."""
+    observe_request_stage('kickstart', 'validate')
     try:
+        floppy_data = add_kickstart_floppy(json_data)
+    except ValidationError as e:
+        abort(422, detail={'json': e.normalized_messages()})
+    except ImageStoreFull as e:
+        app.logger.warning("Rejected kickstart floppy: %s", e)
+        abort(503, 'Kickstart image storage is full')
+    with stage_seconds.time(operation='kickstart', stage='commit'):
+        if database_production_mode:
+            group_commit.commit(db.session)
+        else:
+            db.session.commit()
+    app.logger.info("Created %s with access for %s",
+                    floppy_data.image_file, floppy_data.allowed_ip)
+    return floppy_data
+
+
+group_commit = GroupCommit()
+
+
+def create_kickstart_batch(items):
+    """Create floppies for each item of a batch and yield a result dict per item.
+
+    Results for successfully created floppies are yielded only after the
+    transaction holding them has been committed.
+    """
+    schema = KickstartFloppyIn()
+    out_schema = KickstartFloppyOut()
+    pending = []
+    for index, item in enumerate(items):
         try:
-            iso.open(filename=iso_path, mode='r+b')
-            iso_opened = True
-            boot_cfg = BytesIO()
-            efi_boot_cfg = BytesIO()
-            iso.get_file_from_iso_fp(boot_cfg, iso_path='/BOOT.CFG;1')
-            iso.get_file_from_iso_fp(efi_boot_cfg, iso_path='/EFI/BOOT/BOOT.CFG;1')
-            boot_cfg_str = boot_cfg.getvalue().decode('ascii')
-            kernel_pattern = r'(kernelopt=.*)'
-            kernel_replacement = 'kernelopt=runweasel ks=usb'
-            boot_cfg_str_edit = re.sub(
-                kernel_pattern, kernel_replacement, boot_cfg_str)
-            efi_boot_cfg_str = efi_boot_cfg.getvalue().decode('ascii')
-            efi_boot_cfg_str_edit = re.sub(
-                kernel_pattern, kernel_replacement, efi_boot_cfg_str)
-            iso.modify_file_in_place(
-                BytesIO(boot_cfg_str_edit.encode()),
-                len(boot_cfg_str_edit),
-                '/BOOT.CFG;1')
-            iso.modify_file_in_place(
-                BytesIO(efi_boot_cfg_str_edit.encode()),
-                len(efi_boot_cfg_str_edit),
-                '/EFI/BOOT/BOOT.CFG;1')
-        finally:
-            if iso_opened:
-                iso.close()
-    except (PyCdlibException, UnicodeDecodeError) as e:
-        app.logger.warning("Invalid ISO rejected: %s", e)
-        if os.path.exists(iso_path):
-            os.remove(iso_path)
-        abort(400, 'Invalid or unsupported ISO file')
-    except Exception:
-        app.logger.exception("Unexpected error processing ISO upload")
-        if os.path.exists(iso_path):
-            os.remove(iso_path)
-        raise
+            floppy_data = add_kickstart_floppy(schema.load(item))
+        except ValidationError as e:
+            pending.append({'index': index, 'errors': e.normalized_messages()})
+            continue
+        except ImageStoreFull as e:
+            app.logger.warning("Rejected batch item %d: %s", index, e)
+            pending.append({'index': index,
+                            'errors': {'_schema': ['Kickstart image storage is full']}})
+            continue
+        pending.append({'index': index, 'floppy': floppy_data})
+        if request_wants_ndjson() and \
+                len(pending) >= app.config['KICKSTART_BATCH_COMMIT_SIZE']:
+            yield from _commit_batch_results(pending, out_schema)
+            pending = []
+    yield from _commit_batch_results(pending, out_schema)
+
+
+def _commit_batch_results(pending, out_schema):
+    """Commit the session and turn pending batch entries into result dicts."""
+    db.session.commit()
+    for entry in pending:
+        floppy_data = entry.pop('floppy', None)
+        if floppy_data is not None:
+            entry.update(out_schema.dump(floppy_data))
+            app.logger.info("Created %s with access for %s",
+                            floppy_data.image_file, floppy_data.allowed_ip)
+        yield entry
+
+
+def request_wants_ndjson():
+    """Return whether the client asked for newline-delimited JSON results."""
+    best = request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson'])
+    return best == 'application/x-ndjson'
+
+
+@app.post('/ks/batch')
+@app.auth_required(auth)
+@app.doc(responses={200: 'Per-item results, as a JSON object or NDJSON stream'})
+def create_kickstart_floppy_batch():
+    """Create kickstart floppy images for a list of hosts.
+
+    The body is a JSON list of objects in the same format as ``POST /ks``.
+    Each item gets a result carrying its ``index`` and either the created
+    floppy metadata or its validation ``errors``. Send
+    ``Accept: application/x-ndjson`` to have results streamed one per line as
+    they are committed; otherwise the whole batch is committed in a single
+    transaction and returned as ``{"results": [...]}``.
+    """
+    items = request.get_json(silent=True)
+    if not isinstance(items, list):
+        abort(400, 'Request body must be a JSON list')
+    if len(items) > app.config['KICKSTART_BATCH_MAX']:
+        abort(413, f"Batch exceeds {app.config['KICKSTART_BATCH_MAX']} items")
+    if request_wants_ndjson():
+        lines = (json.dumps(result) + '\n' for result in create_kickstart_batch(items))
+        return Response(stream_with_context(lines), mimetype='application/x-ndjson')
+    return {'results': list(create_kickstart_batch(items))}
+
+
+@app.get('/ks/<string:image_file>')
+@app.output(FileSchema,
+            content_type='application/octet-stream', status_code=200)
+def get_kickstart_floppy(image_file):
+    """Serve a kickstart floppy image to the requesting IP if authorized."""
+    filename = secure_filename(image_file)
+    record = floppy_cache.get(filename)
+
+    if record is None:
+        abort(404, 'File not found')
+
+    # Rows past their expiry are gone even if cleanup has not removed them yet.
+    if record.expires_at <= datetime.datetime.now():
+        abort(404, 'File not found')
+
+    if record.allowed_ip != request.remote_addr:
+        abort(401, f'{request.remote_addr} is not permitted')
+
+    # Hosts re-read the image while booting; revalidations are answered from
+    # the cached validators without opening the image.
+    if record.validators is None:
+        image = open_floppy_image(record.image_blob)
+        if image is None:
+            abort(404, 'File not found')
+        with image:
+            record.validators = floppy_image_validators(image)
+    etag, last_modified = record.validators
+    # Ranges are offsets into the image, so they are always served from the identity encoding.
+    use_gzip = (request.accept_encodings['gzip'] > 0 and 'Range' not in request.headers
+                and 'If-Range' not in request.headers)
+    if use_gzip:
+        # The compressed bytes are a different representation and need their own strong ETag.
+        etag += '-gzip'
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.vary.add('Accept-Encoding')
+        return response
+    image = floppy_image_body(filename, record, use_gzip)
+
+    app.logger.info("Serving %s for %s", filename, request.remote_addr)
+    response = send_file(image, mimetype='application/octet-stream', download_name=filename,
+                         etag=etag, last_modified=last_modified)
+    if use_gzip:
+        response.content_encoding = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def floppy_image_body(filename, record, use_gzip):
+    """Return the body to send for a cached floppy: a path, a file, or gzip bytes.
+
+    The gzipped image is compressed on first use and kept on the cache
+    entry. Aborts with 404 if the image no longer exists.
+    """
+    if use_gzip and record.gzipped is not None:
+        return BytesIO(record.gzipped)
+    image = open_floppy_image(record.image_blob)
+    if image is None:
+        floppy_cache.discard(filename)
+        abort(404, 'File not found')
+    if use_gzip:
+        with image:
+            record.gzipped = get_floppy_template().gzip(image.read())
+        return BytesIO(record.gzipped)
+    if isinstance(getattr(image, 'name', None), str):
+        # Send stored files by path, so Werkzeug knows their size and can serve ranges.
+        image.close()
+        return image.name
+    return image
+
+
+def floppy_image_validators(image):
+    """Return the strong ETag and Last-Modified time for an open floppy image.
+
+    The ETag is the SHA-256 of the image and the modification time is the
+    one stamped on ks.cfg, so every process and image store agrees on both.
+    """
+    data = image.read()
+    image.seek(0)
+    modified_at = get_floppy_template().modified_at(data)
+    if modified_at is not None:
+        modified_at = modified_at.astimezone(datetime.timezone.utc)
+    return hashlib.sha256(data).hexdigest(), modified_at
 
 
 if __name__ == '__main__':
@@ -0,0 +1,722 @@
+"""ESXi ISO endpoints: listing, uploading, patching and deleting ISOs.
+
+Uploaded ISOs have the kernelopt line of their BOOT.CFG files rewritten to
+boot from the kickstart floppy, either while they stream in or with pycdlib
+once they are complete, and are served as static files from ESXI_ISOS_PATH.
+Large ISOs can be sent in chunks as resumable uploads, and processed in
+background jobs.
+"""
+
+import datetime
+import hashlib
+import os
+import re
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from apiflask import APIBlueprint, EmptySchema, Schema, abort
+from apiflask.fields import DateTime, File, Integer, List, Nested, String
+from apiflask.validators import Range
+from flask import Request, current_app, g, jsonify, request, url_for
+from werkzeug.utils import secure_filename
+
+from extensions import auth, db, observe_request_stage, stage_seconds
+from imagestore import KeyedLocks
+from isostream import IsoUploadFile, rewrite_boot_cfg
+from models import EsxiIsoModel, EsxiJobModel, EsxiUploadModel
+
+bp = APIBlueprint('esxi', __name__, tag='ESXi')
+
+
+class EsxiIsoIn(Schema):
+    """Input schema for uploading an ESXi ISO file."""
+
+    file = File(required=True)
+
+
+class EsxiUploadIn(Schema):
+    """Input schema for starting a resumable ESXi ISO upload."""
+
+    filename = String(required=True)
+    size = Integer(required=True, validate=Range(min=1))
+
+
+class EsxiUploadOut(Schema):
+    """Output schema describing a resumable ESXi ISO upload."""
+
+    upload_id = String(required=True)
+    filename = String(required=True)
+    size = Integer(required=True)
+    offset = Integer(required=True)
+
+
+class EsxiJobOut(Schema):
+    """Output schema describing an asynchronous ISO processing job."""
+
+    job_id = String(required=True)
+    filename = String(required=True)
+    state = String(required=True)
+    error = String(allow_none=True)
+    created_at = DateTime(required=True)
+    started_at = DateTime(allow_none=True)
+    finished_at = DateTime(allow_none=True)
+
+
+class EsxiIsoOut(Schema):
+    """Output schema describing an available ESXi ISO."""
+
+    filename = String(required=True)
+    url = String(required=True)
+    size = Integer(required=True)
+    modified_at = DateTime(required=True)
+    upload_sha256 = String(allow_none=True)
+    version = String(allow_none=True)
+    build = String(allow_none=True)
+
+
+class EsxiIsosQuery(Schema):
+    """Query schema for filtering and paginating the ESXi ISO list."""
+
+    version = String(required=False)
+    build = String(required=False)
+    q = String(required=False)
+    page = Integer(required=False, validate=Range(min=1))
+    per_page = Integer(required=False, validate=Range(min=1, max=1000))
+
+
+class EsxiIsosOut(Schema):
+    """Output schema listing available ESXi ISO URLs."""
+
+    iso_urls = List(String(), required=True, allow_none=True)
+    isos = List(Nested(EsxiIsoOut), required=True)
+    total = Integer(required=True)
+
+
+class InvalidIsoError(Exception):
+    """Raised when an uploaded file is not an ISO whose BOOT.CFG can be patched."""
+
+
+class IsoCatalog:
+    """In-memory catalog of the ISOs in ESXI_ISOS_PATH and their indexed metadata.
+
+    The catalog is built from one scan of the directory joined with
+    EsxiIsoModel, and reused until the directory's mtime changes or it is
+    invalidated after an upload or delete. A directory modified within the
+    last second is rescanned on the next request, since a second change in
+    the same mtime tick would otherwise go unnoticed.
+    """
+
+    # Serialized responses kept per query, across all of them.
+    RESPONSE_CACHE_SIZE = 64
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = None
+        self.mtime_ns = None
+        self.responses = {}
+
+    def invalidate(self):
+        """Force the next ``list`` to rescan the directory."""
+        with self.lock:
+            self.entries = None
+            self.responses.clear()
+
+    def response(self, key, render):
+        """Return ``render(entries)`` for the current catalog, reused for ``key`` until it changes.
+
+        ``render`` builds a serialized response body from the list ``list``
+        returns; ``key`` must identify everything else the body depends on.
+        """
+        entries = self.list()
+        with self.lock:
+            cached = self.responses.get(key)
+            if cached is not None and cached[0] is entries:
+                return cached[1]
+        body = render(entries)
+        with self.lock:
+            if entries is self.entries:
+                if len(self.responses) >= self.RESPONSE_CACHE_SIZE:
+                    self.responses.clear()
+                self.responses[key] = (entries, body)
+        return body
+
+    def list(self):
+        """Return a dict for every ISO, sorted by filename."""
+        path = current_app.config['ESXI_ISOS_PATH']
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return []
+        with self.lock:
+            if self.entries is None or mtime_ns != self.mtime_ns:
+                self.entries = self._scan(path)
+                self.responses.clear()
+                racy = time.time_ns() - mtime_ns < 1_000_000_000
+                self.mtime_ns = None if racy else mtime_ns
+            return self.entries
+
+    @staticmethod
+    def _scan(path):
+        """Read the directory and the index into a list of catalog entries."""
+        indexed = {entry.filename: entry
+                   for entry in db.session.execute(db.select(EsxiIsoModel)).scalars()}
+        entries = []
+        with os.scandir(path) as it:
+            for dir_entry in it:
+                if not dir_entry.name.endswith('.iso') or not dir_entry.is_file():
+                    continue
+                stat = dir_entry.stat()
+                entry = indexed.get(dir_entry.name)
+                entries.append({
+                    'filename': dir_entry.name,
+                    'size': stat.st_size,
+                    'modified_at': datetime.datetime.fromtimestamp(
+                        stat.st_mtime, datetime.timezone.utc),
+                    'upload_sha256': entry.sha256 if entry else None,
+                    'version': entry.version if entry else None,
+                    'build': entry.build if entry else None,
+                })
+        return sorted(entries, key=lambda e: e['filename'])
+
+
+iso_catalog = IsoCatalog()
+
+
+@bp.get('/esxi')
+@bp.input(EsxiIsosQuery, location='query')
+@bp.output(EsxiIsosOut, status_code=200)
+def get_esxi_isos(query_data):
+    """Return the available ESXi ISO files with their size, hash, and ESXi build.
+
+    ``version`` matches a version or any release under it (``8.0`` matches
+    ``8.0.2``), ``build`` matches exactly, and ``q`` is a case-insensitive
+    filename substring. ``page`` and ``per_page`` paginate the results;
+    ``total`` counts every match.
+    """
+    # Use a configured BASE_URL to avoid Host header injection. Falls back to
+    # request.url_root only if BASE_URL is unset or blank (not recommended for production).
+    base_url = current_app.config.get('BASE_URL') or request.url_root
+    static_url = current_app.config['ESXI_STATIC_URL'].strip('/')
+    static_base = base_url.rstrip('/') + '/' + static_url + '/'
+    # Serializing thousands of ISOs dominates the request, so the body is kept with the catalog.
+    body = iso_catalog.response(
+        (static_base, tuple(sorted(query_data.items()))),
+        lambda isos: render_esxi_isos(isos, query_data, static_base))
+    return current_app.response_class(body, mimetype=current_app.json.mimetype)
+
+
+def render_esxi_isos(isos, query_data, static_base):
+    """Return the serialized GET /esxi body for the catalog entries ``isos``."""
+    version = query_data.get('version')
+    if version:
+        isos = [i for i in isos if i['version'] and
+                (i['version'] == version or i['version'].startswith(version + '.'))]
+    if query_data.get('build'):
+        isos = [i for i in isos if i['build'] == query_data['build']]
+    if query_data.get('q'):
+        isos = [i for i in isos if query_data['q'].lower() in i['filename'].lower()]
+    total = len(isos)
+    if 'page' in query_data or 'per_page' in query_data:
+        per_page = query_data.get('per_page', 100)
+        start = (query_data.get('page', 1) - 1) * per_page
+        isos = isos[start:start + per_page]
+    isos = [dict(i, url=static_base + i['filename']) for i in isos]
+    data = EsxiIsosOut().dump({'iso_urls': [i['url'] for i in isos], 'isos': isos,
+                               'total': total})
+    return current_app.json.response(data).get_data()
+
+
+@bp.delete('/esxi/<string:iso_file>')
+@bp.auth_required(auth)
+@bp.output({}, status_code=204)
+def delete_esxi_iso(iso_file):
+    """Delete an ESXi ISO file by filename."""
+    filename = secure_filename(iso_file)
+    if not filename:
+        abort(400, 'Invalid filename')
+    iso_path = os.path.join(current_app.config['ESXI_ISOS_PATH'], filename)
+    if not os.path.exists(iso_path):
+        abort(404, 'File not found')
+    # Deduplicated ISOs are hard links, so removing one name leaves the others intact.
+    os.remove(iso_path)
+    db.session.execute(db.delete(EsxiIsoModel).filter_by(filename=filename))
+    db.session.commit()
+    iso_catalog.invalidate()
+    return ''
+
+
+def patch_boot_cfg(iso_path):
+    """Rewrite the kernelopt line of both BOOT.CFG files in an ISO on disk with pycdlib.
+
+    Returns the original contents of /BOOT.CFG.
+    """
+    import pycdlib  # pylint: disable=import-outside-toplevel
+    iso = pycdlib.PyCdlib()
+    iso.open(filename=iso_path, mode='r+b')
+    contents = {}
+    try:
+        for boot_cfg_path in ('/BOOT.CFG;1', '/EFI/BOOT/BOOT.CFG;1'):
+            boot_cfg = BytesIO()
+            iso.get_file_from_iso_fp(boot_cfg, iso_path=boot_cfg_path)
+            contents[boot_cfg_path] = boot_cfg.getvalue()
+            boot_cfg_edit = rewrite_boot_cfg(boot_cfg.getvalue())
+            iso.modify_file_in_place(
+                BytesIO(boot_cfg_edit), len(boot_cfg_edit), boot_cfg_path)
+    finally:
+        iso.close()
+    return contents['/BOOT.CFG;1']
+
+
+def parse_esxi_build(boot_cfg):
+    """Return the (version, build) named by the ``build=`` line of a BOOT.CFG, or Nones.
+
+    ESXi writes e.g. ``build=8.0.2-0.0.22380479``, for version ``8.0.2``.
+    """
+    match = re.search(rb'^build=(\S+)', boot_cfg or b'', re.MULTILINE)
+    if match is None:
+        return None, None
+    build = match.group(1).decode('ascii', errors='replace')
+    return build.split('-')[0], build
+
+
+def find_patched_iso(sha256):
+    """Return the index entry of an existing patched ISO uploaded with the given hash, or None.
+
+    Index entries whose file has been removed outside the API are dropped.
+    """
+    for entry in db.session.execute(
+            db.select(EsxiIsoModel).filter_by(sha256=sha256)).scalars():
+        if os.path.exists(os.path.join(current_app.config['ESXI_ISOS_PATH'], entry.filename)):
+            return entry
+        db.session.delete(entry)
+    return None
+
+
+def link_patched_iso(existing_path, upload_path):
+    """Replace an upload with a hard link to an identical, already patched ISO.
+
+    Returns False, leaving the upload alone, if the file system cannot
+    hard link the two.
+    """
+    link_path = upload_path + '.link'
+    try:
+        os.link(existing_path, link_path)
+    except OSError as e:
+        current_app.logger.warning("Unable to link %s, keeping a separate copy: %s",
+                                   existing_path, e)
+        return False
+    os.replace(link_path, upload_path)
+    return True
+
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Streaming state of resumable uploads handled by this process, by upload id.
+resumable_uploads = {}
+resumable_uploads_lock = threading.Lock()
+# Held while a chunk is written, so a concurrent PATCH waits and then sees the new offset.
+resumable_upload_locks = KeyedLocks()
+iso_job_executor = None  # pylint: disable=invalid-name
+iso_job_executor_lock = threading.Lock()
+
+
+def iso_upload_path(filename):
+    """Return a temporary path in ESXI_ISOS_PATH for an upload of ``filename``."""
+    return os.path.join(current_app.config['ESXI_ISOS_PATH'],
+                        f'.{filename}.{secrets.token_hex(4)}.part')
+
+
+class KickstartRequest(Request):  # pylint: disable=too-few-public-methods
+    """Request class that streams ISO uploads straight into ESXI_ISOS_PATH."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None,
+                         content_length=None):
+        name = secure_filename(filename or '')
+        if self.endpoint == 'esxi.post_esxi_iso' and name:
+            upload_file = IsoUploadFile(iso_upload_path(name))
+            # Werkzeug drops the stream if the form cannot be parsed, so
+            # close_iso_uploads removes it when the request ends.
+            g.setdefault('iso_uploads', []).append(upload_file)
+            return upload_file
+        return super()._get_file_stream(
+            total_content_length, content_type, filename, content_length)
+
+
+
+@bp.teardown_app_request
+def close_iso_uploads(_exc):
+    """Remove the partial file of any ISO upload the request did not finish."""
+    for upload_file in g.pop('iso_uploads', []):
+        upload_file.close()
+
+
+@bp.post('/esxi')
+@bp.auth_required(auth)
+@bp.input(EsxiIsoIn, location='files')
+@bp.output(EmptySchema, status_code=201)
+@bp.doc(responses={202: 'Queued as a job, see GET /esxi/jobs/<job_id>'})
+def post_esxi_iso(files_data):
+    """Upload an ESXi ISO, patch its boot configuration, and store it.
+
+    The upload is written to disk and its BOOT.CFG files patched as it
+    streams in. ISOs the streaming patcher cannot handle are patched with
+    pycdlib once the upload is complete. With ``Prefer: respond-async`` (or
+    ESXI_ASYNC_JOBS) that work is queued and 202 is returned with the job.
+    """
+    file = files_data['file']
+    filename = secure_filename(file.filename or '')
+    if not filename:
+        abort(400, 'Invalid filename')
+    if isinstance(file.stream, IsoUploadFile):
+        upload_path = file.stream.path
+        boot_cfg = file.stream.patcher.boot_cfg if file.stream.finish() else None
+        sha256 = file.stream.sha256.hexdigest()
+    else:
+        upload_path = iso_upload_path(filename)
+        sha256 = hashlib.sha256()
+        try:
+            with open(upload_path, 'wb') as f:
+                for chunk in iter(lambda: file.stream.read(UPLOAD_CHUNK_SIZE), b''):
+                    sha256.update(chunk)
+                    f.write(chunk)
+        except Exception:
+            os.remove(upload_path)
+            raise
+        sha256 = sha256.hexdigest()
+        boot_cfg = None
+    # The upload is streamed to disk, hashed and patched while the form is parsed.
+    observe_request_stage('iso', 'receive')
+    return process_iso_upload(filename, upload_path, sha256, boot_cfg)
+
+
+def store_iso_upload(filename, upload_path, sha256, boot_cfg):
+    """Move a completed upload into place as ``filename``, patching it if needed.
+
+    ``sha256`` is the hash of the uploaded contents. ``boot_cfg`` is the
+    original /BOOT.CFG if it was already rewritten while streaming, or None
+    if the upload still has to be patched. Raises InvalidIsoError, after
+    removing the upload, if it is not a usable ISO.
+    """
+    iso_path = os.path.join(current_app.config['ESXI_ISOS_PATH'], filename)
+    existing = find_patched_iso(sha256)
+    if existing is not None and existing.filename == filename:
+        current_app.logger.info("%s is unchanged, discarding upload", filename)
+        os.remove(upload_path)
+        return
+    version = build = None
+    if existing is not None and link_patched_iso(
+            os.path.join(current_app.config['ESXI_ISOS_PATH'], existing.filename), upload_path):
+        current_app.logger.info("%s has the same contents as %s, linked instead of patched",
+                        filename, existing.filename)
+        version, build = existing.version, existing.build
+    else:
+        existing = None
+    # pycdlib is only needed here, for ISOs that could not be patched while streaming.
+    from pycdlib.pycdlibexception import PyCdlibException  # pylint: disable=import-outside-toplevel
+    try:
+        if existing is None and boot_cfg is None:
+            with stage_seconds.time(operation='iso', stage='patch'):
+                boot_cfg = patch_boot_cfg(upload_path)
+    except (PyCdlibException, UnicodeDecodeError) as e:
+        current_app.logger.warning("Invalid ISO rejected: %s", e)
+        os.remove(upload_path)
+        raise InvalidIsoError('Invalid or unsupported ISO file') from e
+    except Exception:
+        current_app.logger.exception("Unexpected error processing ISO upload")
+        os.remove(upload_path)
+        raise
+    if existing is None:
+        version, build = parse_esxi_build(boot_cfg)
+    with stage_seconds.time(operation='iso', stage='store'):
+        os.replace(upload_path, iso_path)
+        db.session.merge(EsxiIsoModel(filename, sha256, version, build))
+        db.session.commit()
+    iso_catalog.invalidate()
+
+
+def process_iso_upload(filename, upload_path, sha256, boot_cfg):
+    """Store a completed upload now, or queue a job for it if asynchronous processing is wanted.
+
+    Processing is asynchronous when ESXI_ASYNC_JOBS is set or the client
+    sends ``Prefer: respond-async``. Returns None once the ISO is stored,
+    or a 202 response describing the queued job.
+    """
+    if not (current_app.config['ESXI_ASYNC_JOBS']
+            or 'respond-async' in request.headers.get('Prefer', '')):
+        try:
+            store_iso_upload(filename, upload_path, sha256, boot_cfg)
+        except InvalidIsoError as e:
+            abort(400, str(e))
+        return None
+    job = EsxiJobModel(secrets.token_urlsafe(16), filename)
+    db.session.add(job)
+    db.session.commit()
+    flask_app = current_app._get_current_object()  # pylint: disable=protected-access
+    get_iso_job_executor().submit(run_iso_job, flask_app, job.job_id, upload_path, sha256,
+                                  boot_cfg)
+    current_app.logger.info("Queued job %s for %s", job.job_id, filename)
+    response = jsonify(EsxiJobOut().dump(job))
+    response.status_code = 202
+    response.headers['Location'] = url_for('.get_esxi_job', job_id=job.job_id)
+    return response
+
+
+def get_iso_job_executor():
+    """Return the thread pool that runs ISO processing jobs, creating it on first use."""
+    global iso_job_executor  # pylint: disable=global-statement
+    with iso_job_executor_lock:
+        if iso_job_executor is None:
+            iso_job_executor = ThreadPoolExecutor(
+                max_workers=current_app.config['ESXI_JOB_WORKERS'], thread_name_prefix='iso-job')
+    return iso_job_executor
+
+
+def run_iso_job(flask_app, job_id, upload_path, sha256, boot_cfg):
+    """Process a queued upload in a background thread and record the outcome on its job."""
+    with flask_app.app_context():
+        job = db.session.get(EsxiJobModel, job_id)
+        job.state = 'patching'
+        job.started_at = datetime.datetime.now()
+        db.session.commit()
+        try:
+            store_iso_upload(job.filename, upload_path, sha256, boot_cfg)
+            state, error = 'done', None
+        except InvalidIsoError as e:
+            state, error = 'failed', str(e)
+        except Exception:  # pylint: disable=broad-exception-caught
+            # store_iso_upload has already logged the traceback.
+            state, error = 'failed', 'Unexpected error processing ISO upload'
+        db.session.rollback()
+        job = db.session.get(EsxiJobModel, job_id)
+        job.state = state
+        job.error = error
+        job.finished_at = datetime.datetime.now()
+        db.session.commit()
+        flask_app.logger.info("Job %s for %s finished: %s", job_id, job.filename, state)
+
+
+@bp.get('/esxi/jobs/<string:job_id>')
+@bp.auth_required(auth)
+@bp.output(EsxiJobOut, status_code=200)
+def get_esxi_job(job_id):
+    """Return the state and timings of an asynchronous ISO processing job."""
+    job = db.session.get(EsxiJobModel, job_id)
+    if job is None:
+        abort(404, 'Job not found')
+    return job
+
+
+def resumable_upload_path(upload_id):
+    """Return the path a resumable upload is written to."""
+    return os.path.join(current_app.config['ESXI_ISOS_PATH'], f'.upload-{upload_id}.part')
+
+
+def get_resumable_upload(upload_id):
+    """Return the EsxiUploadModel for ``upload_id`` or abort with 404."""
+    upload = db.session.get(EsxiUploadModel, upload_id)
+    if upload is None:
+        abort(404, 'Upload not found')
+    return upload
+
+
+def discard_resumable_upload(upload):
+    """Delete an upload session, its partial file and any in-process streaming state."""
+    with resumable_uploads_lock:
+        upload_file = resumable_uploads.pop(upload.upload_id, None)
+    if upload_file is not None:
+        upload_file.close()
+    path = resumable_upload_path(upload.upload_id)
+    if os.path.exists(path):
+        os.remove(path)
+    db.session.delete(upload)
+
+
+@bp.post('/esxi/uploads')
+@bp.auth_required(auth)
+@bp.input(EsxiUploadIn, location='json')
+@bp.output(EsxiUploadOut, status_code=201)
+def create_esxi_upload(json_data):
+    """Start a resumable ISO upload and preallocate space for it.
+
+    Send the ISO with ``PATCH /esxi/uploads/<upload_id>`` requests carrying
+    an ``Upload-Offset`` header, then finish it with
+    ``POST /esxi/uploads/<upload_id>/complete``.
+    """
+    filename = secure_filename(json_data['filename'])
+    if not filename:
+        abort(400, 'Invalid filename')
+    if json_data['size'] > current_app.config['MAX_CONTENT_LENGTH']:
+        abort(413, 'ISO is larger than the maximum upload size')
+    upload = EsxiUploadModel(secrets.token_urlsafe(16), filename, json_data['size'])
+    upload_file = IsoUploadFile(resumable_upload_path(upload.upload_id), size=upload.size)
+    with resumable_uploads_lock:
+        resumable_uploads[upload.upload_id] = upload_file
+    db.session.add(upload)
+    db.session.commit()
+    current_app.logger.info("Started upload %s for %s", upload.upload_id, filename)
+    return upload
+
+
+@bp.get('/esxi/uploads/<string:upload_id>')
+@bp.auth_required(auth)
+@bp.output(EsxiUploadOut, status_code=200)
+def get_esxi_upload(upload_id):
+    """Return the progress of a resumable ISO upload."""
+    return get_resumable_upload(upload_id)
+
+
+@bp.patch('/esxi/uploads/<string:upload_id>')
+@bp.auth_required(auth)
+@bp.output(EsxiUploadOut, status_code=200)
+def patch_esxi_upload(upload_id):
+    """Append the request body to a resumable upload at the ``Upload-Offset`` header.
+
+    The offset must equal the number of bytes received so far; a mismatch
+    returns 409 so the client can query the progress and resume from there.
+    Of two PATCHes sent at the same offset, such as a retry racing the
+    original, only the first is written and the second gets 409.
+    """
+    offset = request.headers.get('Upload-Offset', type=int)
+    if offset is None:
+        abort(400, 'Upload-Offset header is required')
+    with resumable_upload_locks.hold(upload_id):
+        upload = get_resumable_upload(upload_id)
+        if offset != upload.offset:
+            abort(409, f'Upload is at offset {upload.offset}')
+        received = write_upload_chunk(upload, offset)
+        # Another process may have taken the same offset meanwhile; only one of them moves it on.
+        claimed = db.session.execute(
+            db.update(EsxiUploadModel)
+            .where(EsxiUploadModel.upload_id == upload_id, EsxiUploadModel.offset == offset)
+            .values(offset=offset + received)).rowcount
+        if not claimed:
+            db.session.rollback()
+            abort(409, 'Upload offset was moved on by another request')
+        db.session.commit()
+    return upload
+
+
+def write_upload_chunk(upload, offset):
+    """Write the request body to ``upload`` at ``offset`` and return its length."""
+    with resumable_uploads_lock:
+        upload_file = resumable_uploads.get(upload.upload_id)
+    if upload_file is not None and upload_file.position != offset:
+        # Another process took over this upload; finish it without streaming state.
+        with resumable_uploads_lock:
+            resumable_uploads.pop(upload.upload_id, None)
+        upload_file.finished = True
+        upload_file.close()
+        upload_file = None
+    remaining = upload.size - offset
+    # The new offset promises the chunk is on disk, for whichever process completes the upload.
+    if upload_file is None:
+        with open(resumable_upload_path(upload.upload_id), 'r+b') as f:
+            f.seek(offset)
+            received = copy_upload_chunk(f, remaining)
+            f.flush()
+            os.fsync(f.fileno())
+    else:
+        received = copy_upload_chunk(upload_file, remaining)
+        upload_file.sync()
+    return received
+
+
+def copy_upload_chunk(target, remaining):
+    """Copy the request body into ``target`` and return the number of bytes written.
+
+    Aborts with 400 if the body holds more than ``remaining`` bytes.
+    """
+    received = 0
+    while True:
+        chunk = request.stream.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            return received
+        if received + len(chunk) > remaining:
+            abort(400, 'Chunk extends past the declared upload size')
+        target.write(chunk)
+        received += len(chunk)
+
+
+@bp.post('/esxi/uploads/<string:upload_id>/complete')
+@bp.auth_required(auth)
+@bp.output(EmptySchema, status_code=201)
+@bp.doc(responses={202: 'Queued as a job, see GET /esxi/jobs/<job_id>'})
+def complete_esxi_upload(upload_id):
+    """Finish a resumable upload and store the ISO under its filename."""
+    upload = get_resumable_upload(upload_id)
+    if upload.offset != upload.size:
+        abort(409, f'Upload is at offset {upload.offset} of {upload.size}')
+    with resumable_uploads_lock:
+        upload_file = resumable_uploads.pop(upload_id, None)
+    upload_path = resumable_upload_path(upload_id)
+    if upload_file is not None and upload_file.position == upload.size:
+        boot_cfg = upload_file.patcher.boot_cfg if upload_file.finish() else None
+        sha256 = upload_file.sha256.hexdigest()
+    else:
+        # The upload was resumed in another process, so hash and patch it from disk.
+        if upload_file is not None:
+            upload_file.finished = True
+            upload_file.close()
+        sha256 = hashlib.sha256()
+        with open(upload_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+                sha256.update(chunk)
+        sha256 = sha256.hexdigest()
+        boot_cfg = None
+    filename = upload.filename
+    db.session.delete(upload)
+    db.session.commit()
+    return process_iso_upload(filename, upload_path, sha256, boot_cfg)
+
+
+@bp.delete('/esxi/uploads/<string:upload_id>')
+@bp.auth_required(auth)
+@bp.output({}, status_code=204)
+def delete_esxi_upload(upload_id):
+    """Abandon a resumable upload and remove its partial file."""
+    discard_resumable_upload(get_resumable_upload(upload_id))
+    db.session.commit()
+    return ''
+
+
+def cleanup_uploads(flask_app):
+    """Discard unfinished uploads and finished jobs older than ESXI_UPLOAD_TIMEOUT_HOURS.
+
+    Jobs that are still queued or patching after that long were interrupted
+    and are marked failed, to be discarded one timeout later.
+
+    Temporary ``.part`` files left in ESXI_ISOS_PATH by uploads that were
+    interrupted, such as by a crash mid-request, are removed once they are
+    that old too.
+    """
+    with flask_app.app_context():
+        cutoff = datetime.datetime.now() - datetime.timedelta(
+            hours=flask_app.config['ESXI_UPLOAD_TIMEOUT_HOURS'])
+        stale = db.session.execute(db.select(EsxiUploadModel).filter(
+            EsxiUploadModel.created_at < cutoff)).scalars().all()
+        for upload in stale:
+            flask_app.logger.info("Discarding unfinished upload %s", upload.upload_id)
+            discard_resumable_upload(upload)
+        db.session.execute(db.delete(EsxiJobModel).filter(
+            EsxiJobModel.finished_at < cutoff))
+        # Jobs of a process that exited mid-job never finish; fail them so clients stop waiting.
+        abandoned = db.session.execute(
+            db.update(EsxiJobModel)
+            .where(EsxiJobModel.finished_at.is_(None), EsxiJobModel.created_at < cutoff)
+            .values(state='failed', error='Interrupted before it finished',
+                    finished_at=datetime.datetime.now())).rowcount
+        if abandoned:
+            flask_app.logger.info("Failed %d unfinished ISO jobs", abandoned)
+        db.session.commit()
+        with os.scandir(flask_app.config['ESXI_ISOS_PATH']) as entries:
+            for entry in entries:
+                if (entry.name.startswith('.') and entry.name.endswith('.part')
+                        and entry.is_file()
+                        and entry.stat().st_mtime < cutoff.timestamp()):
+                    flask_app.logger.info("Removing stale upload file %s", entry.name)
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        pass
@@ -0,0 +1,146 @@
+"""Removing expired floppies on time, from the one process that runs background jobs."""
+
+import datetime
+import fcntl
+import heapq
+import threading
+
+from extensions import db, scheduler_lag
+from models import KickstartFloppyModel
+
+# How long the cleanup job waits before trying again after it failed.
+CLEANUP_RETRY_DELAY = datetime.timedelta(seconds=30)
+
+
+class ExpiryQueue:  # pylint: disable=too-many-instance-attributes
+    """Min-heap of floppy expiry times that runs cleanup when the earliest one is due.
+
+    Rather than polling, a single one-off cleanup job is kept on the
+    scheduler for the next deadline, and replaced by one for the following
+    deadline each time it runs. The heap is seeded from the database when the
+    process becomes the scheduler leader and fed as it creates floppies.
+    Floppies created by other processes are picked up from the database
+    whenever the job runs, which is at least every
+    KICKSTART_EXPIRY_RESYNC_SECONDS. Each run calls ``cleanup`` to remove the
+    floppies that have expired.
+    """
+
+    def __init__(self, flask_app, cleanup, flask_scheduler=None):
+        self.app = flask_app
+        self.cleanup = cleanup
+        self.scheduler = flask_scheduler
+        self.deadlines = []
+        self.next_run = None
+        self.active = False
+        self.lock = threading.Lock()
+        self.job_id = None
+        self.arms = 0
+
+    def seed(self):
+        """Load the expiry time of every existing floppy and start arming the cleanup job."""
+        with self.app.app_context():
+            deadlines = db.session.execute(
+                db.select(KickstartFloppyModel.expires_at)).scalars().all()
+        with self.lock:
+            self.deadlines = list(deadlines)
+            heapq.heapify(self.deadlines)
+            self.active = True
+            self._arm()
+
+    def push(self, expires_at):
+        """Schedule cleanup for a floppy expiring at ``expires_at``."""
+        with self.lock:
+            if not self.active:
+                # Another process runs cleanup and finds this row on its next run.
+                return
+            heapq.heappush(self.deadlines, expires_at)
+            if self.next_run is None or expires_at < self.next_run or \
+                    self.next_run < datetime.datetime.now():
+                self._arm()
+
+    def run(self):
+        """Remove expired floppies and wait for the next deadline."""
+        now = datetime.datetime.now()
+        if self.next_run is not None:
+            scheduler_lag.set(max((now - self.next_run).total_seconds(), 0.0))
+        next_expiry = None
+        try:
+            self.cleanup()
+            with self.app.app_context():
+                next_expiry = db.session.execute(
+                    db.select(db.func.min(KickstartFloppyModel.expires_at))).scalar()
+        except Exception:  # pylint: disable=broad-exception-caught
+            self.app.logger.exception("Cleanup failed, retrying in %s", CLEANUP_RETRY_DELAY)
+            next_expiry = now + CLEANUP_RETRY_DELAY
+        finally:
+            # Whatever happened, arm the job again, or nothing would ever be removed again.
+            with self.lock:
+                while self.deadlines and self.deadlines[0] < now:
+                    heapq.heappop(self.deadlines)
+                if next_expiry is not None and (
+                        not self.deadlines or next_expiry < self.deadlines[0]):
+                    heapq.heappush(self.deadlines, next_expiry)
+                self._arm()
+
+    def _arm(self):
+        """Point the cleanup job at the earliest pending deadline or resync time."""
+        self.next_run = self.deadlines[0] if self.deadlines else None
+        resync = self.app.config['KICKSTART_EXPIRY_RESYNC_SECONDS']
+        if resync:
+            latest = datetime.datetime.now() + datetime.timedelta(seconds=resync)
+            if self.next_run is None or latest < self.next_run:
+                self.next_run = latest
+        if self.next_run is None:
+            return
+        # Each arming gets a new job id: the scheduler removes a date job once it
+        # has fired, which must not take the job armed by that run with it.
+        if self.job_id is not None:
+            try:
+                self.scheduler.remove_job(self.job_id)
+            except LookupError:
+                pass  # already fired
+        self.arms += 1
+        self.job_id = f'cleanup-{self.arms}'
+        # Never skip a late run, or no later deadline would be armed.
+        self.scheduler.add_job(self.job_id, self.run, trigger='date', run_date=self.next_run,
+                               misfire_grace_time=None)
+
+
+class SchedulerLeader:
+    """Elects the one process that runs background jobs by locking a file.
+
+    Under a multi-process WSGI server only the process holding an exclusive
+    lock on SCHEDULER_LOCK_FILE starts the scheduler. The others block on
+    the lock in a daemon thread; the OS releases it however the leader
+    exits, and the next waiting process takes over.
+    """
+
+    def __init__(self, path, on_elected):
+        self.path = path
+        self.on_elected = on_elected
+        self.file = None
+        self.elected = threading.Event()
+
+    def start(self):
+        """Try to become the leader, waiting in the background if another process is."""
+        self.file = open(self.path, 'a', encoding='ascii')  # pylint: disable=consider-using-with
+        try:
+            fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            threading.Thread(target=self._wait, name='scheduler-leader', daemon=True).start()
+            return False
+        self._elect()
+        return True
+
+    def _wait(self):
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        self._elect()
+
+    def _elect(self):
+        self.elected.set()
+        self.on_elected()
+
+    def release(self):
+        """Give up the lock so another process can take over."""
+        if self.file is not None:
+            self.file.close()
@@ -0,0 +1,75 @@
+"""The database, token authentication and metrics shared by the app and its modules.
+
+They are created here without an application, so the blueprints and
+helpers split out of ``app.py`` can use them without importing it;
+``app.py`` binds them to the application.
+"""
+
+import time
+
+from apiflask import APIKeyHeaderAuth, abort
+from flask import current_app, g
+from flask_sqlalchemy import SQLAlchemy
+
+import metrics
+
+db = SQLAlchemy()
+auth = APIKeyHeaderAuth()
+
+
+def is_admin(identity):
+    """Return whether a token identity is listed in ADMIN_TOKEN_NAMES."""
+    return identity is not None and identity in current_app.config['ADMIN_TOKEN_NAMES']
+
+
+def require_admin():
+    """Abort with 403 unless the request was made with an admin token."""
+    if not is_admin(auth.current_user):
+        abort(403, 'An admin token is required')
+
+
+metrics_registry = metrics.Registry()
+http_requests = metrics_registry.counter(
+    'ksfloppy_http_requests_total', 'Requests handled, by endpoint and status.',
+    ('endpoint', 'method', 'status'))
+http_request_seconds = metrics_registry.histogram(
+    'ksfloppy_http_request_duration_seconds', 'Time to handle a request, by endpoint.',
+    ('endpoint',))
+stage_seconds = metrics_registry.histogram(
+    'ksfloppy_stage_duration_seconds',
+    'Time spent in each stage of creating a kickstart floppy or storing an ISO.',
+    ('operation', 'stage'))
+image_reuses = metrics_registry.counter(
+    'ksfloppy_image_reuses_total',
+    'Kickstart floppies that reused the stored image of an identical kickstart.')
+cleanup_deleted = metrics_registry.counter(
+    'ksfloppy_cleanup_deleted_total', 'Expired kickstart floppies removed by cleanup.')
+cleanup_reclaimed_bytes = metrics_registry.counter(
+    'ksfloppy_cleanup_reclaimed_bytes_total', 'Bytes of image data removed by cleanup.')
+scheduler_lag = metrics_registry.gauge(
+    'ksfloppy_scheduler_lag_seconds',
+    'How late the last cleanup run started after it was due, in the scheduler process.')
+live_images = metrics_registry.gauge(
+    'ksfloppy_live_images', 'Kickstart floppies that have not expired.')
+image_pool_claims = metrics_registry.counter(
+    'ksfloppy_image_pool_claims_total',
+    'Kickstart images written into a blank image claimed from the pool.')
+image_pool_misses = metrics_registry.counter(
+    'ksfloppy_image_pool_misses_total',
+    'Kickstart images written in full because the blank image pool was empty.')
+image_pool_depth = metrics_registry.gauge(
+    'ksfloppy_image_pool_depth', 'Blank images waiting in the pool.')
+stored_bytes = metrics_registry.gauge(
+    'ksfloppy_stored_bytes', 'Bytes used by stored kickstart images and ESXi ISOs.', ('kind',))
+
+
+def observe_request_stage(operation, stage):
+    """Observe the time from the start of the request to now as ``stage``.
+
+    Used at the top of views for the work APIFlask does before calling them:
+    authentication, parsing and validating the input, and for ISOs, receiving
+    the upload.
+    """
+    started = g.get('request_started')
+    if started is not None:
+        stage_seconds.observe(time.perf_counter() - started, operation=operation, stage=stage)
@@ -0,0 +1,330 @@
+"""Kickstart floppy image construction from a pre-parsed blank FAT image.
+
+``FloppyTemplate`` works on bytes alone, so rendering can be timed and
+tested without a request or an image store. Images are compared block by
+block as slices of bytes or bytearrays, which compare with memcmp, rather
+than memoryviews, which do not.
+"""
+
+import datetime
+import os
+import secrets
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+# Images are written in blocks of this size, with holes left for blocks of zeros.
+SPARSE_BLOCK_SIZE = 4096
+_SPARSE_MAGIC = b'KSSPARSE'
+# mtime 0, maximum compression, unknown OS.
+_GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x02\xff'
+
+
+class FloppyTemplate:  # pylint: disable=too-many-instance-attributes
+    """A blank FAT floppy image parsed once and stamped with ks.cfg per request.
+
+    The boot sector, FAT locations and root directory slot are resolved when
+    the template is loaded, so producing an image only copies the template
+    and patches the directory entry, FAT chain and data clusters for ks.cfg.
+    The result is byte-for-byte what pyfatfs writes for the same file (apart
+    from the timestamps, which record when each image was made).
+    """
+
+    FILENAME = 'ks.cfg'
+    # 8.3 name pyfatfs derives for "ks.cfg"; the lower-case long name is
+    # kept in a single LFN entry in front of it.
+    SHORT_NAME = b'KS      CFG'
+    DIR_ENTRY_SIZE = 32
+    FAT32_EOC = 0x0FFFFFFF
+    # Images are gzipped in independently compressed segments of this size.
+    GZIP_SEGMENT_SIZE = 32 * 1024
+
+    def __init__(self, path, offset=512):
+        with open(path, 'rb') as f:
+            self.image = f.read()
+        self.offset = offset
+        (self.bytes_per_sector, self.sectors_per_cluster, reserved_sectors,
+         num_fats) = struct.unpack_from('<HBHB', self.image, offset + 0x0B)
+        fat_size_16 = struct.unpack_from('<H', self.image, offset + 0x16)[0]
+        if fat_size_16 != 0:
+            # pyfatfs only treats the image as FAT32 when BPB_FATSz16 is zero.
+            raise ValueError(f'{path} is not a FAT32 image')
+        fat_sectors, = struct.unpack_from('<I', self.image, offset + 0x24)
+        root_cluster, = struct.unpack_from('<I', self.image, offset + 0x2C)
+        self.bytes_per_cluster = self.bytes_per_sector * self.sectors_per_cluster
+        fat_start = offset + reserved_sectors * self.bytes_per_sector
+        fat_bytes = fat_sectors * self.bytes_per_sector
+        self.fat_offsets = [fat_start + i * fat_bytes for i in range(num_fats)]
+        self.data_offset = fat_start + num_fats * fat_bytes
+        total_sectors = struct.unpack_from('<H', self.image, offset + 0x13)[0] or \
+            struct.unpack_from('<I', self.image, offset + 0x20)[0]
+        max_cluster = min(
+            (total_sectors * self.bytes_per_sector - (self.data_offset - offset))
+            // self.bytes_per_cluster + 1,
+            fat_bytes // 4 - 1)
+        fat = self.image[self.fat_offsets[0]:self.fat_offsets[0] + fat_bytes]
+        self.free_clusters = [
+            c for c in range(2, max_cluster + 1)
+            if struct.unpack_from('<I', fat, c * 4)[0] & 0x0FFFFFFF == 0]
+        self.dir_entry_offset = self._free_root_slot(root_cluster)
+        self.lfn_entry = self._lfn_entry()
+        self._gzip_segments = None
+
+    def cluster_offset(self, cluster):
+        """Return the absolute image offset of a data cluster."""
+        return self.data_offset + (cluster - 2) * self.bytes_per_cluster
+
+    def _free_root_slot(self, root_cluster):
+        """Return the offset of the first root directory slot pair that is unused."""
+        start = self.cluster_offset(root_cluster)
+        for pos in range(start, start + self.bytes_per_cluster - self.DIR_ENTRY_SIZE,
+                         self.DIR_ENTRY_SIZE):
+            if self.image[pos] == 0x00:
+                return pos
+        raise ValueError('No free root directory entry in blank floppy image')
+
+    def _lfn_entry(self):
+        """Build the long file name entry that precedes the ks.cfg short entry."""
+        checksum = 0
+        for char in self.SHORT_NAME:
+            checksum = (((checksum & 1) << 7) + (checksum >> 1) + char) & 0xFF
+        name = self.FILENAME.encode('utf-16-le') + b'\x00\x00'
+        name += b'\xff' * (26 - len(name))
+        return (bytes([0x41]) + name[0:10] + bytes([0x0F, 0x00, checksum])
+                + name[10:22] + b'\x00\x00' + name[22:26])
+
+    def patches(self, contents, now=None):  # pylint: disable=too-many-locals
+        """Return the ``(offset, data)`` writes that store ``contents`` as ks.cfg.
+
+        Applied to a copy of the template they produce the image ``render``
+        returns, so an image can be made from a pre-written blank one by
+        writing only these few kilobytes.
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        num_clusters = -(-len(contents) // self.bytes_per_cluster)
+        if num_clusters > len(self.free_clusters):
+            raise ValueError('Kickstart file does not fit on the floppy image')
+        clusters = self.free_clusters[:num_clusters]
+        writes = []
+        for i, cluster in enumerate(clusters):
+            next_cluster = clusters[i + 1] if i + 1 < len(clusters) else self.FAT32_EOC
+            entry = struct.pack('<I', next_cluster)
+            for fat_offset in self.fat_offsets:
+                writes.append((fat_offset + cluster * 4, entry))
+            chunk = contents[i * self.bytes_per_cluster:(i + 1) * self.bytes_per_cluster]
+            writes.append((self.cluster_offset(cluster), chunk))
+        first_cluster = clusters[0] if clusters else 0
+        fat_date = (now.year - 1980) << 9 | now.month << 5 | now.day
+        fat_time = now.hour << 11 | now.minute << 5 | now.second // 2
+        short_entry = self.SHORT_NAME + struct.pack(
+            '<BBBHHHHHHHI', 0x00, 0x00, 0, fat_time, fat_date, fat_date,
+            first_cluster >> 16, fat_time, fat_date, first_cluster & 0xFFFF,
+            len(contents))
+        writes.append((self.dir_entry_offset, self.lfn_entry + short_entry))
+        return writes
+
+    def apply(self, patches):
+        """Return a copy of the template with ``patches`` written into it."""
+        image = bytearray(self.image)
+        for offset, data in patches:
+            image[offset:offset + len(data)] = data
+        return image
+
+    def render(self, contents, now=None):
+        """Return a copy of the template with ``contents`` stored as ks.cfg."""
+        return self.apply(self.patches(contents, now))
+
+    @staticmethod
+    def _deflate(segment):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return compressor.compress(segment) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def gzip(self, image):
+        """Return ``image`` gzip-compressed, reusing the compressed template where they match.
+
+        Each segment of the image is compressed on its own and ends on a byte
+        boundary, so the deflate streams can be concatenated. The segments of
+        the template are compressed once; only those that ks.cfg was written
+        to are compressed again, instead of the whole 1.44 MB.
+        """
+        size = self.GZIP_SEGMENT_SIZE
+        if self._gzip_segments is None:
+            self._gzip_segments = [self._deflate(self.image[i:i + size])
+                                   for i in range(0, len(self.image), size)]
+        same_size = len(image) == len(self.image)
+        out = [_GZIP_HEADER]
+        for i in range(0, len(image), size):
+            segment = image[i:i + size]
+            if same_size and segment == self.image[i:i + size]:
+                out.append(self._gzip_segments[i // size])
+            else:
+                out.append(self._deflate(segment))
+        out.append(b'\x03\x00')  # an empty final block
+        out.append(struct.pack('<II', zlib.crc32(image), len(image) & 0xFFFFFFFF))
+        return b''.join(out)
+
+    def modified_at(self, image):
+        """Return the local time ks.cfg was written to a rendered ``image``.
+
+        FAT timestamps have a resolution of two seconds. Returns None if the
+        image holds no valid timestamp there.
+        """
+        pos = self.dir_entry_offset + self.DIR_ENTRY_SIZE
+        try:
+            fat_time, fat_date = struct.unpack_from('<HH', image, pos + 22)
+            return datetime.datetime(
+                (fat_date >> 9) + 1980, fat_date >> 5 & 0x0F, fat_date & 0x1F,
+                fat_time >> 11, fat_time >> 5 & 0x3F, (fat_time & 0x1F) * 2)
+        except (struct.error, ValueError):
+            return None
+
+
+def _extents(data):
+    """Yield ``(start, end)`` for each run of blocks of ``data`` that are not all zeros."""
+    zeros = bytes(SPARSE_BLOCK_SIZE)
+    start = None
+    for offset in range(0, len(data), SPARSE_BLOCK_SIZE):
+        block = data[offset:offset + SPARSE_BLOCK_SIZE]
+        if block != zeros[:len(block)]:
+            if start is None:
+                start = offset
+        elif start is not None:
+            yield start, offset
+            start = None
+    if start is not None:
+        yield start, len(data)
+
+
+def write_sparse(f, data):
+    """Write ``data`` to the empty file ``f``, leaving holes for blocks of zeros.
+
+    On filesystems with sparse files the holes take no disk space, and a
+    floppy image is almost all zeros.
+    """
+    for start, end in _extents(data):
+        f.seek(start)
+        f.write(data[start:end])
+    f.truncate(len(data))
+
+
+def pack_sparse(data):
+    """Return ``data`` as its length followed by its runs of non-zero blocks."""
+    out = [_SPARSE_MAGIC, struct.pack('<Q', len(data))]
+    for start, end in _extents(data):
+        out.append(struct.pack('<QQ', start, end - start))
+        out.append(data[start:end])
+    return b''.join(out)
+
+
+def unpack_sparse(packed):
+    """Return the data packed by ``pack_sparse``, or ``packed`` itself if it is not packed."""
+    if not packed.startswith(_SPARSE_MAGIC):
+        return packed
+    pos = len(_SPARSE_MAGIC)
+    size, = struct.unpack_from('<Q', packed, pos)
+    data = bytearray(size)
+    pos += 8
+    while pos < len(packed):
+        start, length = struct.unpack_from('<QQ', packed, pos)
+        pos += 16
+        data[start:start + length] = packed[pos:pos + length]
+        pos += length
+    return bytes(data)
+
+
+class BlankImagePool:  # pylint: disable=too-many-instance-attributes
+    """Pre-written blank floppy images waiting in a directory to be claimed.
+
+    Claiming an image renames it to its final name, which is atomic, so
+    processes sharing the directory never hand out the same image; the
+    directory must be on the same filesystem as the images it is claimed
+    into. A daemon thread writes new images until there are ``size`` of
+    them, but only once no image has been claimed for ``idle_seconds``, so
+    refilling does not compete with a burst of requests for the disk.
+    """
+
+    PREFIX = 'blank-'
+    SUFFIX = '.img'
+
+    def __init__(self, path, image, size, idle_seconds=0.1):
+        self.path = path
+        self.image = image
+        self.size = size
+        self.idle_seconds = idle_seconds
+        self.last_claim = 0.0
+        self.wake = threading.Event()
+        self.stopped = False
+        self.thread = None
+
+    def _names(self):
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+        return [n for n in names if n.startswith(self.PREFIX) and n.endswith(self.SUFFIX)]
+
+    def depth(self):
+        """Return the number of blank images waiting in the pool."""
+        return len(self._names())
+
+    def claim(self, target):
+        """Move a blank image to ``target``; return False if the pool is empty."""
+        self.last_claim = time.monotonic()
+        self.wake.set()
+        for name in self._names():
+            try:
+                os.rename(os.path.join(self.path, name), target)
+            except FileNotFoundError:
+                continue  # claimed by another process first
+            return True
+        return False
+
+    def add(self):
+        """Write one blank image into the pool."""
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.' + self.PREFIX)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write_sparse(f, self.image)
+            os.replace(tmp_path, os.path.join(
+                self.path, self.PREFIX + secrets.token_hex(8) + self.SUFFIX))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def fill(self):
+        """Add blank images until the pool is full; return False if a claim interrupted it."""
+        os.makedirs(self.path, exist_ok=True)
+        while not self.stopped and self.depth() < self.size:
+            if time.monotonic() - self.last_claim < self.idle_seconds:
+                return False
+            self.add()
+        return True
+
+    def _run(self):
+        timeout = None
+        while not self.stopped:
+            self.wake.wait(timeout)
+            self.wake.clear()
+            try:
+                full = self.fill()
+            except OSError:
+                # Out of disk space, say; requests fall back to writing whole
+                # images and the next claim tries again.
+                full = True
+            # Retry once requests have been quiet for a while.
+            timeout = None if full else self.idle_seconds
+
+    def start(self):
+        """Start the thread that keeps the pool full."""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='blank-image-pool', daemon=True)
+            self.thread.start()
+        self.wake.set()
+
+    def stop(self):
+        """Stop the filling thread after the image it is writing, if any."""
+        self.stopped = True
+        self.wake.set()
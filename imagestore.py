@@ -0,0 +1,322 @@
+"""Kickstart image stores, and building the images they hold.
+
+An image store keeps floppy images by name as files, database BLOBs or
+process memory; ``get_image_store`` returns the one KICKSTART_IMAGE_STORE
+selects. Images are built from the blank floppy template, written into a
+pre-made blank image when the pool has one, and lazily created images are
+built on their first download.
+"""
+
+import contextlib
+import os
+import secrets
+import threading
+from io import BytesIO
+
+from apiflask import abort
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+
+import floppy
+from extensions import db, image_pool_claims, image_pool_misses, stage_seconds
+from floppy import FloppyTemplate
+from models import KickstartFloppyImageModel, KickstartSourceModel
+
+
+class ImageStoreFull(Exception):
+    """Raised when an image store has no room left for another image."""
+
+
+class FilesystemImageStore:
+    """Keep floppy images as files in KICKSTART_IMAGE_PATH.
+
+    Images are written under a temporary name and renamed into place, so a
+    concurrent download never sees a partly written image.
+    """
+
+    def __init__(self, config):
+        self.config = config
+
+    def _path(self, image_file):
+        return os.path.join(self.config['KICKSTART_IMAGE_PATH'], image_file)
+
+    def _temp_path(self, image_file):
+        return self._path(f'.{image_file}.{secrets.token_hex(4)}.tmp')
+
+    def put(self, image_file, data):
+        """Store ``data`` under ``image_file`` as a sparse file."""
+        tmp_path = self._temp_path(image_file)
+        try:
+            with open(tmp_path, 'xb') as f:
+                floppy.write_sparse(f, data)
+            os.replace(tmp_path, self._path(image_file))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def put_patches(self, image_file, patches, pool):
+        """Store ``image_file`` as a blank image claimed from ``pool`` with ``patches`` written.
+
+        Returns False, storing nothing, when the pool is empty.
+        """
+        tmp_path = self._temp_path(image_file)
+        if not pool.claim(tmp_path):
+            return False
+        try:
+            with open(tmp_path, 'r+b') as f:
+                for offset, data in patches:
+                    f.seek(offset)
+                    f.write(data)
+            os.replace(tmp_path, self._path(image_file))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return True
+
+    def open(self, image_file):
+        """Return a binary file object for ``image_file``, or None if it is missing."""
+        try:
+            return open(self._path(image_file), 'rb')  # pylint: disable=consider-using-with
+        except FileNotFoundError:
+            return None
+
+    def delete_many(self, image_files):
+        """Remove ``image_files`` and return the disk space each one that existed used, by name."""
+        removed = {}
+        for image_file in image_files:
+            path = self._path(image_file)
+            try:
+                size = os.stat(path).st_blocks * 512
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            removed[image_file] = size
+        return removed
+
+
+class DatabaseImageStore:
+    """Keep floppy images as BLOBs alongside KickstartFloppyModel.
+
+    Only the non-zero blocks of an image are stored. Writes and deletes join
+    the caller's session and are committed with it.
+    """
+
+    def __init__(self, config):
+        self.config = config
+
+    def put(self, image_file, data):
+        """Store ``data`` under ``image_file``."""
+        db.session.add(KickstartFloppyImageModel(image_file, floppy.pack_sparse(data)))
+
+    def open(self, image_file):
+        """Return a binary file object for ``image_file``, or None if it is missing."""
+        data = db.session.execute(
+            db.select(KickstartFloppyImageModel.data).filter_by(
+                image_file=image_file)).scalar_one_or_none()
+        if data is None:
+            return None
+        return BytesIO(floppy.unpack_sparse(data))
+
+    def delete_many(self, image_files):
+        """Remove ``image_files`` and return the size of each one that existed, by name."""
+        result = db.session.execute(
+            db.delete(KickstartFloppyImageModel)
+            .where(KickstartFloppyImageModel.image_file.in_(image_files))
+            .returning(KickstartFloppyImageModel.image_file,
+                       db.func.length(KickstartFloppyImageModel.data)))
+        return dict(result.all())
+
+
+class MemoryImageStore:
+    """Keep floppy images in process memory, up to KICKSTART_IMAGE_MEMORY_BUDGET bytes.
+
+    Only the non-zero blocks of an image are kept. Images are only visible
+    to the process that created them, so this store is meant for
+    single-process deployments.
+    """
+
+    def __init__(self, config):
+        self.budget = config['KICKSTART_IMAGE_MEMORY_BUDGET']
+        self.used = 0
+        self.images = {}
+        self.lock = threading.Lock()
+
+    def put(self, image_file, data):
+        """Store ``data`` under ``image_file``."""
+        data = floppy.pack_sparse(data)
+        with self.lock:
+            if self.used + len(data) > self.budget:
+                raise ImageStoreFull(
+                    f'Memory image store budget of {self.budget} bytes exhausted')
+            self.images[image_file] = data
+            self.used += len(data)
+
+    def open(self, image_file):
+        """Return a binary file object for ``image_file``, or None if it is missing."""
+        data = self.images.get(image_file)
+        if data is None:
+            return None
+        return BytesIO(floppy.unpack_sparse(data))
+
+    def delete_many(self, image_files):
+        """Remove ``image_files`` and return the size of each one that existed, by name."""
+        removed = {}
+        with self.lock:
+            for image_file in image_files:
+                data = self.images.pop(image_file, None)
+                if data is not None:
+                    self.used -= len(data)
+                    removed[image_file] = len(data)
+        return removed
+
+
+IMAGE_STORE_BACKENDS = {
+    'filesystem': FilesystemImageStore,
+    'database': DatabaseImageStore,
+    'memory': MemoryImageStore,
+}
+image_stores = {}
+
+
+class KeyedLocks:  # pylint: disable=too-few-public-methods
+    """One lock per key, created on first use and dropped once nobody holds or waits for it."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.locks = {}
+
+    @contextlib.contextmanager
+    def hold(self, key):
+        """Hold the lock for ``key`` for the duration of a ``with`` block."""
+        with self.lock:
+            entry = self.locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.locks[key]
+
+
+# Builds of different lazy images run in parallel; only downloads of the same one wait.
+materialize_locks = KeyedLocks()
+
+
+def get_image_store():
+    """Return the image store selected by KICKSTART_IMAGE_STORE."""
+    name = current_app.config['KICKSTART_IMAGE_STORE']
+    store = image_stores.get(name)
+    if store is None:
+        store = image_stores[name] = IMAGE_STORE_BACKENDS[name](current_app.config)
+    return store
+
+
+floppy_template = None  # pylint: disable=invalid-name
+blank_pool = None  # pylint: disable=invalid-name
+blank_pool_lock = threading.Lock()
+
+
+def get_floppy_template():
+    """Return the blank floppy template, parsing blank.img on first use."""
+    global floppy_template  # pylint: disable=global-statement
+    if floppy_template is None:
+        floppy_template = FloppyTemplate(os.path.join(current_app.root_path, 'blank.img'))
+    return floppy_template
+
+
+def get_blank_pool():
+    """Return the pool of blank images for the filesystem store, or None if it is disabled.
+
+    The pool lives in ``.pool`` under KICKSTART_IMAGE_PATH, so that claiming
+    an image is a rename within one filesystem, and is filled by a thread
+    started on first use.
+    """
+    global blank_pool  # pylint: disable=global-statement
+    size = current_app.config['KICKSTART_IMAGE_POOL_SIZE']
+    if not size or not isinstance(get_image_store(), FilesystemImageStore):
+        return None
+    path = os.path.join(current_app.config['KICKSTART_IMAGE_PATH'], '.pool')
+    with blank_pool_lock:
+        if blank_pool is None or blank_pool.path != path:
+            if blank_pool is not None:
+                blank_pool.stop()
+            blank_pool = floppy.BlankImagePool(path, get_floppy_template().image, size)
+            blank_pool.start()
+        blank_pool.size = size
+        blank_pool.idle_seconds = current_app.config['KICKSTART_IMAGE_POOL_IDLE_SECONDS']
+    return blank_pool
+
+
+def store_floppy_image(image_file, kickstart_contents):
+    """Build the floppy image for ``kickstart_contents`` and put it in the image store.
+
+    Raises ImageStoreFull when the active image store has no room left.
+    """
+    pool = get_blank_pool()
+    if pool is None:
+        with stage_seconds.time(operation='kickstart', stage='build_image'):
+            image = get_floppy_template().render(kickstart_contents.encode('ascii'))
+        with stage_seconds.time(operation='kickstart', stage='store_image'):
+            get_image_store().put(image_file, image)
+        return
+    # Only the few kilobytes that differ from a blank image are written.
+    template = get_floppy_template()
+    with stage_seconds.time(operation='kickstart', stage='build_image'):
+        patches = template.patches(kickstart_contents.encode('ascii'))
+    with stage_seconds.time(operation='kickstart', stage='store_image'):
+        if get_image_store().put_patches(image_file, patches, pool):
+            image_pool_claims.inc()
+            return
+        image_pool_misses.inc()
+        get_image_store().put(image_file, template.apply(patches))
+
+
+def open_floppy_image(image_file):
+    """Open a stored floppy image, building it first if it was created lazily.
+
+    ``image_file`` is the name the image is stored under, which differs from
+    the floppy's own name when it reuses the image of an identical kickstart.
+
+    Returns None when there is neither a stored image nor a kickstart source
+    to build one from.
+    """
+    image_store = get_image_store()
+    image = image_store.open(image_file)
+    if image is not None:
+        return image
+    with materialize_locks.hold(image_file):
+        image = image_store.open(image_file)
+        if image is not None:
+            return image
+        source = db.session.get(KickstartSourceModel, image_file)
+        if source is None:
+            return None
+        try:
+            store_floppy_image(image_file, source.kickstart)
+        except ImageStoreFull as e:
+            current_app.logger.warning("Unable to materialize %s: %s", image_file, e)
+            abort(503, 'Kickstart image storage is full')
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Another process stored the image first.
+            db.session.rollback()
+        current_app.logger.info("Materialized %s on first download", image_file)
+        return image_store.open(image_file)
+
+
+def image_store_bytes():
+    """Return the bytes used by the stored kickstart images of the active image store."""
+    image_store = get_image_store()
+    if isinstance(image_store, MemoryImageStore):
+        return image_store.used
+    if isinstance(image_store, DatabaseImageStore):
+        return db.session.execute(
+            db.select(db.func.sum(db.func.length(KickstartFloppyImageModel.data)))).scalar() or 0
+    with os.scandir(current_app.config['KICKSTART_IMAGE_PATH']) as entries:
+        # Images are sparse files, so count the blocks they use rather than their size.
+        return sum(entry.stat().st_blocks * 512 for entry in entries if entry.is_file())
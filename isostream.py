@@ -0,0 +1,291 @@
+"""Patch the BOOT.CFG files of an ESXi ISO while it is being uploaded.
+
+The upload is written straight to disk. Its bytes are also fed to
+``BootCfgPatcher``, which parses the volume descriptors and directory
+records as they go by, finds both BOOT.CFG files, and rewrites each one
+(and the data length in every directory record that points at it) as soon
+as the file's data has been received. The file is never read back.
+
+Anything the patcher cannot handle while streaming, such as a directory
+that is stored after the data it lists, or a UDF bridge ISO whose file
+entries would also need updating, leaves ``BootCfgPatcher.complete``
+False. The caller then falls back to patching the finished file with
+pycdlib.
+"""
+
+import hashlib
+import os
+import re
+import struct
+import time
+
+SECTOR_SIZE = 2048
+KERNELOPT_PATTERN = re.compile(r'(kernelopt=.*)')
+KERNELOPT_REPLACEMENT = 'kernelopt=runweasel ks=usb'
+BOOT_CFG_PATHS = (('BOOT.CFG',), ('EFI', 'BOOT', 'BOOT.CFG'))
+
+_FIRST_VOLUME_DESCRIPTOR = 16
+_JOLIET_ESCAPES = (b'%/@', b'%/C', b'%/E')
+_UDF_IDENTIFIERS = (b'NSR02', b'NSR03')
+_VOLUME_RECOGNITION_IDENTIFIERS = (b'BEA01', b'TEA01', b'BOOT2', b'CDW02') + _UDF_IDENTIFIERS
+
+
+def rewrite_boot_cfg(contents):
+    """Return BOOT.CFG ``contents`` with the kernelopt line set for a ks=usb install.
+
+    Raises UnicodeDecodeError if the file is not ASCII.
+    """
+    text = contents.decode('ascii')
+    return KERNELOPT_PATTERN.sub(KERNELOPT_REPLACEMENT, text).encode('ascii')
+
+
+class _Extent:  # pylint: disable=too-few-public-methods
+    """A byte range of the ISO being collected for a handler."""
+
+    def __init__(self, length, handler):
+        self.length = length
+        self.handler = handler
+        self.data = bytearray()
+
+
+class _BootCfgFile:  # pylint: disable=too-few-public-methods
+    """A BOOT.CFG data extent and the directory records that point at it."""
+
+    def __init__(self):
+        self.records = []
+        self.new_length = None
+
+
+class BootCfgPatcher:  # pylint: disable=too-many-instance-attributes
+    """Find and rewrite the BOOT.CFG files of an ISO from a stream of its bytes.
+
+    Call ``feed`` with consecutive chunks of the image; it returns a list of
+    ``(offset, data)`` patches to write over bytes that have already been
+    fed. After the last chunk ``complete`` says whether every BOOT.CFG was
+    patched, and ``boot_cfg`` holds the original contents of /BOOT.CFG.
+    """
+
+    def __init__(self):
+        self.position = 0
+        self.chunk_start = 0
+        self.wanted = {}
+        self.files = {}
+        self.patches = []
+        self.patched_paths = set()
+        self.volume_descriptors = []
+        self.boot_cfg = None
+        self.supported = True
+        self._want(_FIRST_VOLUME_DESCRIPTOR, SECTOR_SIZE, self._volume_descriptor)
+
+    @property
+    def complete(self):
+        """Whether both BOOT.CFG files were found and patched while streaming."""
+        return (self.supported and not self.wanted
+                and self.patched_paths == set(BOOT_CFG_PATHS))
+
+    def feed(self, data):
+        """Consume the next chunk of the image and return any patches it produced."""
+        self.chunk_start = self.position
+        self.position += len(data)
+        progressed = True
+        while progressed and self.supported:
+            progressed = False
+            for lba, extent in sorted(self.wanted.items()):
+                start = lba * SECTOR_SIZE + len(extent.data)
+                end = min(lba * SECTOR_SIZE + extent.length, self.position)
+                if start < end:
+                    extent.data += data[start - self.chunk_start:end - self.chunk_start]
+                if len(extent.data) == extent.length:
+                    del self.wanted[lba]
+                    extent.handler(lba, bytes(extent.data))
+                    progressed = True
+        patches, self.patches = self.patches, []
+        return patches
+
+    def _want(self, lba, length, handler):
+        """Collect ``length`` bytes from sector ``lba`` and pass them to ``handler``."""
+        if lba * SECTOR_SIZE < self.chunk_start:
+            # The data has already gone by.
+            self.supported = False
+        elif lba not in self.wanted:
+            self.wanted[lba] = _Extent(length, handler)
+
+    def _volume_descriptor(self, lba, sector):
+        """Handle a volume descriptor or volume recognition sequence sector."""
+        vd_type, identifier = sector[0], sector[1:6]
+        if identifier in _UDF_IDENTIFIERS:
+            self.supported = False
+            return
+        if identifier == b'CD001':
+            if vd_type == 1:
+                self.volume_descriptors.append(lba)
+                self._want_root(sector, 'ascii')
+            elif vd_type == 2 and sector[88:91] in _JOLIET_ESCAPES:
+                self.volume_descriptors.append(lba)
+                self._want_root(sector, 'utf-16-be')
+            elif vd_type == 2 and sector[6] == 2:
+                # ISO 9660:1999 enhanced volume descriptor.
+                self.volume_descriptors.append(lba)
+        elif identifier not in _VOLUME_RECOGNITION_IDENTIFIERS:
+            return
+        self._want(lba + 1, SECTOR_SIZE, self._volume_descriptor)
+
+    def _want_root(self, sector, encoding):
+        """Collect the root directory named by a primary or Joliet volume descriptor."""
+        lba, length = struct.unpack_from('<I4xI', sector, 156 + 2)
+        self._want(lba, length, self._directory_handler((), encoding))
+
+    def _directory_handler(self, path, encoding):
+        """Return a handler that looks for BOOT.CFG paths in the directory at ``path``."""
+        def handler(lba, data):
+            for offset, name, child_lba, is_dir in self._directory_records(data, encoding):
+                child_path = path + (name,)
+                if is_dir and any(p[:len(child_path)] == child_path for p in BOOT_CFG_PATHS):
+                    child_length = struct.unpack_from('<I', data, offset + 10)[0]
+                    self._want(child_lba, child_length,
+                               self._directory_handler(child_path, encoding))
+                elif not is_dir and child_path in BOOT_CFG_PATHS:
+                    self._boot_cfg_record(child_path, child_lba,
+                                          lba * SECTOR_SIZE + offset, data, offset)
+        return handler
+
+    @staticmethod
+    def _directory_records(data, encoding):
+        """Yield (offset, normalized name, extent, is directory) for each child record."""
+        offset = 0
+        while offset < len(data):
+            length = data[offset]
+            if length == 0:
+                # Records never span sectors; skip the padding to the next one.
+                offset = (offset // SECTOR_SIZE + 1) * SECTOR_SIZE
+                continue
+            lba = struct.unpack_from('<I', data, offset + 2)[0]
+            flags = data[offset + 25]
+            raw_name = data[offset + 33:offset + 33 + data[offset + 32]]
+            if raw_name not in (b'\x00', b'\x01'):
+                name = raw_name.decode(encoding, errors='replace').upper()
+                name = name.split(';')[0].rstrip('.')
+                yield offset, name, lba, bool(flags & 0x02)
+            offset += length
+
+    def _boot_cfg_record(self, path, lba, record_offset, data, offset):
+        """Remember a directory record for a BOOT.CFG file and collect its data."""
+        boot_cfg = self.files.get(lba)
+        if boot_cfg is None:
+            boot_cfg = self.files[lba] = _BootCfgFile()
+            self._want(lba, struct.unpack_from('<I', data, offset + 10)[0],
+                       lambda lba, contents: self._boot_cfg_data(path, lba, contents))
+        boot_cfg.records.append(record_offset)
+        if boot_cfg.new_length is not None:
+            self._patch_record(record_offset, boot_cfg.new_length)
+
+    def _boot_cfg_data(self, path, lba, contents):
+        """Rewrite a BOOT.CFG file once all of its data has been received."""
+        try:
+            new_contents = rewrite_boot_cfg(contents)
+        except UnicodeDecodeError:
+            self.supported = False
+            return
+        extents = -(-len(contents) // SECTOR_SIZE)
+        if extents == 0 or -(-len(new_contents) // SECTOR_SIZE) != extents:
+            self.supported = False
+            return
+        self.patches.append((lba * SECTOR_SIZE, new_contents))
+        if len(new_contents) % SECTOR_SIZE:
+            # Matches pycdlib, which only zeroes the last byte of the final extent.
+            self.patches.append(((lba + extents) * SECTOR_SIZE - 1, b'\x00'))
+        if path == BOOT_CFG_PATHS[0]:
+            self.boot_cfg = contents
+        boot_cfg = self.files[lba]
+        boot_cfg.new_length = len(new_contents)
+        for record_offset in boot_cfg.records:
+            self._patch_record(record_offset, boot_cfg.new_length)
+        self.patched_paths.add(path)
+        if self.patched_paths == set(BOOT_CFG_PATHS):
+            # pycdlib stamps the volume modification date when it modifies a file.
+            from pycdlib.dates import VolumeDescriptorDate  # pylint: disable=import-outside-toplevel
+            modified = VolumeDescriptorDate()
+            modified.new(time.time())
+            for vd_lba in self.volume_descriptors:
+                self.patches.append((vd_lba * SECTOR_SIZE + 830, modified.record()))
+
+    def _patch_record(self, record_offset, length):
+        """Queue an update of the both-endian data length of a directory record."""
+        both_endian = struct.pack('<I', length) + struct.pack('>I', length)
+        self.patches.append((record_offset + 10, both_endian))
+
+
+class IsoUploadFile:
+    """Writable upload target that patches BOOT.CFG as the ISO is written.
+
+    Used as the stream Werkzeug writes a multipart file part into. Data is
+    written to ``path`` and fed through a ``BootCfgPatcher``; ``finish``
+    flushes and closes the file. ``sha256`` hashes the data as uploaded,
+    before any patching. If the upload is closed without being finished,
+    the partial file is removed.
+    """
+
+    def __init__(self, path, buffer_size=1024 * 1024, size=None):
+        self.path = path
+        self.patcher = BootCfgPatcher()
+        self.sha256 = hashlib.sha256()
+        self.file = open(path, 'w+b', buffering=buffer_size)  # pylint: disable=consider-using-with
+        self.finished = False
+        if size:
+            # Reserve the space up front when the final size is known.
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(self.file.fileno(), 0, size)
+            else:
+                self.file.truncate(size)
+
+    @property
+    def position(self):
+        """Number of bytes written so far."""
+        return self.patcher.position
+
+    def write(self, data):
+        """Write the next chunk of the upload and apply any patches it completes."""
+        written = self.file.write(data)
+        self.sha256.update(data)
+        patches = self.patcher.feed(data)
+        if patches:
+            end = self.file.tell()
+            for offset, patch in patches:
+                self.file.seek(offset)
+                self.file.write(patch)
+            self.file.seek(end)
+        return written
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """Seek the underlying file."""
+        return self.file.seek(offset, whence)
+
+    def tell(self):
+        """Return the position in the underlying file."""
+        return self.file.tell()
+
+    def read(self, size=-1):
+        """Read from the underlying file."""
+        return self.file.read(size)
+
+    def readline(self, size=-1):
+        """Read a line from the underlying file."""
+        return self.file.readline(size)
+
+    def sync(self):
+        """Flush buffered writes and wait for them to reach the disk."""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def finish(self):
+        """Close the written file and return whether BOOT.CFG was patched while streaming."""
+        self.file.close()
+        self.finished = True
+        return self.patcher.complete
+
+    def close(self):
+        """Close the file, removing it if the upload was never finished."""
+        if not self.file.closed:
+            self.file.close()
+        if not self.finished and os.path.exists(self.path):
+            os.remove(self.path)
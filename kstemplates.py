@@ -0,0 +1,177 @@
+"""Named kickstart templates, compiled once and reloaded when their files change.
+
+Templates are plain kickstart files in which ``{{ field }}`` is replaced by
+the value of a validated request field. The double braces leave the
+``$VAR`` and ``${VAR}`` of shell scripts in ``%pre``, ``%post`` and
+``%firstboot`` sections alone. A template is split into its literal text
+and field names once, when it is first loaded, so rendering is a join.
+"""
+
+import hashlib
+import os
+import re
+import tempfile
+import threading
+
+TEMPLATE_NAME = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+TEMPLATE_SUFFIX = '.ks'
+_FIELD = re.compile(r'\{\{\s*([A-Za-z_][A-Za-z0-9_]*)\s*\}\}')
+
+
+class TemplateError(ValueError):
+    """Raised when a template cannot be compiled or stored."""
+
+
+class KickstartTemplate:  # pylint: disable=too-few-public-methods
+    """A kickstart template split into literal text and the fields between it."""
+
+    def __init__(self, source, fields):
+        try:
+            source.encode('ascii')
+        except UnicodeEncodeError as e:
+            raise TemplateError('Template must only contain ASCII characters') from e
+        parts = _FIELD.split(source)
+        self.literals = parts[0::2]
+        self.fields = parts[1::2]
+        unknown = sorted(set(self.fields) - set(fields))
+        if unknown:
+            raise TemplateError(f"Unknown template field(s): {', '.join(unknown)}")
+        self.source = source
+        self.sha256 = hashlib.sha256(source.encode('ascii')).hexdigest()
+
+    def render(self, values):
+        """Return the template with every field replaced by its entry in ``values``."""
+        out = [self.literals[0]]
+        for field, literal in zip(self.fields, self.literals[1:]):
+            out.append(values[field])
+            out.append(literal)
+        return ''.join(out)
+
+
+class TemplateRegistry:  # pylint: disable=too-many-instance-attributes
+    """Kickstart templates by name, from built-in sources and a directory of files.
+
+    ``<name>.ks`` files in ``path`` are added to the built-in templates; a
+    file named after a built-in template is ignored, and reported in
+    ``errors``, rather than replacing it. Looking a template up stats the directory, to notice added
+    and removed files, and the one file, to notice edits; only a changed
+    file is read again. Compiled templates are shared by the SHA-256 of
+    their source, so reloading an unchanged file does not compile it again.
+    """
+
+    def __init__(self, path, fields, builtin=None):
+        self.path = path
+        self.fields = frozenset(fields)
+        self.builtin = {name: self.compile(source) for name, source in (builtin or {}).items()}
+        self.lock = threading.Lock()
+        self.names = frozenset()
+        self.dir_signature = None
+        self.loaded = {}
+        self.compiled = {}
+        self.errors = {}
+
+    def compile(self, source):
+        """Compile ``source``, raising TemplateError if it is not a valid template."""
+        return KickstartTemplate(source, self.fields)
+
+    def _file(self, name):
+        return os.path.join(self.path, name + TEMPLATE_SUFFIX)
+
+    def _scan_if_changed(self):
+        """Refresh the names of the template files if the directory has changed."""
+        try:
+            stat = os.stat(self.path)
+            signature = (stat.st_ino, stat.st_mtime_ns)
+        except FileNotFoundError:
+            signature = None
+        if signature == self.dir_signature:
+            return
+        names = set()
+        shadowing = set()
+        if signature is not None:
+            for filename in os.listdir(self.path):
+                name = filename[:-len(TEMPLATE_SUFFIX)]
+                if filename.endswith(TEMPLATE_SUFFIX) and TEMPLATE_NAME.match(name):
+                    (shadowing if name in self.builtin else names).add(name)
+        with self.lock:
+            self.names = frozenset(names)
+            self.dir_signature = signature
+            for name in set(self.loaded) - names:
+                del self.loaded[name]
+            for name in set(self.errors) - names:
+                del self.errors[name]
+            for name in shadowing:
+                self.errors[name] = (f'{name}{TEMPLATE_SUFFIX} is ignored, '
+                                     'built-in templates cannot be replaced')
+
+    def get(self, name):
+        """Return the compiled template called ``name``, or None if there is none."""
+        self._scan_if_changed()
+        if name not in self.names:
+            return self.builtin.get(name)
+        path = self._file(name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return self.builtin.get(name)
+        signature = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        loaded = self.loaded.get(name)
+        if loaded is not None and loaded[0] == signature:
+            return loaded[1]
+        with open(path, 'rb') as f:
+            data = f.read()
+        with self.lock:
+            template = self.compiled.get(hashlib.sha256(data).hexdigest())
+        if template is None:
+            try:
+                template = self.compile(data.decode('ascii'))
+            except (UnicodeDecodeError, TemplateError) as e:
+                # Keep serving the previous version of a file that was broken by hand.
+                template = loaded[1] if loaded else self.builtin.get(name)
+                with self.lock:
+                    self.loaded[name] = (signature, template)
+                    self.errors[name] = str(e)
+                return template
+        with self.lock:
+            self.compiled[template.sha256] = template
+            self.loaded[name] = (signature, template)
+            self.errors.pop(name, None)
+        return template
+
+    def list(self):
+        """Return ``{name: template}`` for every template, built-in ones included."""
+        self._scan_if_changed()
+        templates = dict(self.builtin)
+        for name in sorted(self.names):
+            template = self.get(name)
+            if template is not None:
+                templates[name] = template
+        return dict(sorted(templates.items()))
+
+    def put(self, name, source):
+        """Compile ``source`` and atomically store it as the template ``name``."""
+        if not TEMPLATE_NAME.match(name):
+            raise TemplateError('Template names may only contain letters, digits, - and _')
+        if name in self.builtin:
+            raise TemplateError(f'{name} is a built-in template and cannot be replaced')
+        template = self.compile(source)
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.template-')
+        try:
+            with os.fdopen(fd, 'w', encoding='ascii') as f:
+                f.write(source)
+            os.replace(tmp_path, self._file(name))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return template
+
+    def delete(self, name):
+        """Remove the template file ``name``; return False if there was none."""
+        if not TEMPLATE_NAME.match(name) or name in self.builtin:
+            return False
+        try:
+            os.remove(self._file(name))
+        except FileNotFoundError:
+            return False
+        return True
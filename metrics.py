@@ -0,0 +1,172 @@
+"""Counters, gauges and histograms rendered in the Prometheus text format.
+
+A small subset of what prometheus_client offers, kept free of Flask so it
+can be used from request handlers and background jobs alike. Every metric
+keeps its values in a dict keyed by label values behind its own lock, so
+recording a sample costs a dict lookup and, for histograms, a bisect.
+Values are per process; each process of a multi-process server reports
+its own.
+"""
+
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds, from a millisecond up to ten minutes for the slowest ISO uploads.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 600.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_value(value):
+    """Format a sample value the way Prometheus parses it."""
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+def _format_labels(names, values):
+    """Format label names and values as ``{name="value",...}``."""
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class _Metric:  # pylint: disable=too-few-public-methods
+    """A named metric with a fixed set of label names."""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} takes labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self, key, value):
+        """Yield ``(suffix, label names, label values, value)`` for one set of labels."""
+        yield '', self.labelnames, key, value
+
+    def render(self):
+        """Return the metric in the Prometheus text format."""
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            items = sorted((key, list(value) if isinstance(value, list) else value)
+                           for key, value in self.values.items())
+        for key, value in items:
+            for suffix, names, values, sample in self._samples(key, value):
+                lines.append(f'{self.name}{suffix}{_format_labels(names, values)} '
+                             f'{_format_value(sample)}')
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(_Metric):
+    """A value that only goes up, such as a number of requests."""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        if not self.labelnames:
+            # Report zero rather than nothing until the first increment.
+            self.values[()] = 0
+
+    def inc(self, amount=1, **labels):
+        """Add ``amount`` to the counter for ``labels``."""
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that is set to its current level, such as bytes in use."""
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        """Set the gauge for ``labels`` to ``value``."""
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(_Metric):
+    """Counts of observations, such as durations, in cumulative buckets."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        """Record one observation of ``value`` for ``labels``."""
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # One count per bucket plus +Inf, followed by the sum.
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the body of a ``with`` block takes, in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self, key, value):
+        names = self.labelnames + ('le',)
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), value[:-1]):
+            cumulative += count
+            yield '_bucket', names, key + (_format_value(float(bound)),), cumulative
+        yield '_sum', self.labelnames, key, value[-1]
+        yield '_count', self.labelnames, key, cumulative
+
+
+class Registry:
+    """The metrics exposed together by one endpoint."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        """Create and register a Counter."""
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        """Create and register a Gauge."""
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """Create and register a Histogram."""
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        """Return every registered metric in the Prometheus text format."""
+        return ''.join(metric.render() for metric in self.metrics)
@@ -0,0 +1,187 @@
+"""SQLAlchemy models, and the group commits that insert them under load."""
+
+import datetime
+import threading
+
+from extensions import db
+
+
+class KickstartFloppyModel(db.Model):  # pylint: disable=too-few-public-methods
+    """SQLAlchemy model for tracking kickstart floppy images."""
+
+    id = db.Column(db.Integer, primary_key=True)
+    image_file = db.Column(db.String(12), unique=True, nullable=False)
+    image_url = db.Column(db.String(255), unique=True, nullable=False)
+    allowed_ip = db.Column(db.String(39), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    # The stored image this floppy serves, shared by floppies with the same
+    # kickstart. Rows from older versions leave it empty and use image_file.
+    image_blob = db.Column(db.String(12), index=True)
+    content_hash = db.Column(db.String(64), index=True)  # SHA-256 of ks.cfg
+
+    def __init__(self, image_file, image_url, allowed_ip, expires_at,  # pylint: disable=too-many-arguments
+                 *, image_blob=None, content_hash=None):
+        self.image_file = image_file
+        self.image_url = image_url
+        self.allowed_ip = allowed_ip
+        self.expires_at = expires_at
+        self.image_blob = image_blob
+        self.content_hash = content_hash
+
+
+class KickstartFloppyImageModel(db.Model):  # pylint: disable=too-few-public-methods
+    """SQLAlchemy model holding floppy image contents for the database image store."""
+
+    image_file = db.Column(db.String(12), primary_key=True)
+    data = db.Column(db.LargeBinary, nullable=False)
+
+    def __init__(self, image_file, data):
+        self.image_file = image_file
+        self.data = data
+
+
+class EsxiIsoModel(db.Model):  # pylint: disable=too-few-public-methods
+    """SQLAlchemy model cataloguing uploaded ISOs.
+
+    ISOs are indexed by the SHA-256 of their uploaded contents; ISOs with
+    the same contents are hard links to one patched file. The ESXi version
+    and build are read from BOOT.CFG when the ISO is uploaded.
+    """
+
+    filename = db.Column(db.String(255), primary_key=True)
+    sha256 = db.Column(db.String(64), index=True, nullable=False)
+    version = db.Column(db.String(32), nullable=True)
+    build = db.Column(db.String(64), nullable=True)
+
+    def __init__(self, filename, sha256, version=None, build=None):
+        self.filename = filename
+        self.sha256 = sha256
+        self.version = version
+        self.build = build
+
+
+class EsxiUploadModel(db.Model):  # pylint: disable=too-few-public-methods
+    """SQLAlchemy model tracking resumable ESXi ISO uploads."""
+
+    upload_id = db.Column(db.String(32), primary_key=True)
+    filename = db.Column(db.String(255), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    offset = db.Column(db.BigInteger, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    def __init__(self, upload_id, filename, size):
+        self.upload_id = upload_id
+        self.filename = filename
+        self.size = size
+        self.offset = 0
+        self.created_at = datetime.datetime.now()
+
+
+class EsxiJobModel(db.Model):  # pylint: disable=too-few-public-methods
+    """SQLAlchemy model tracking asynchronous ISO processing jobs."""
+
+    job_id = db.Column(db.String(32), primary_key=True)
+    filename = db.Column(db.String(255), nullable=False)
+    state = db.Column(db.String(16), nullable=False)  # queued, patching, done or failed
+    error = db.Column(db.String(255), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    def __init__(self, job_id, filename):
+        self.job_id = job_id
+        self.filename = filename
+        self.state = 'queued'
+        self.created_at = datetime.datetime.now()
+
+
+class KickstartSourceModel(db.Model):  # pylint: disable=too-few-public-methods
+    """SQLAlchemy model holding rendered ks.cfg contents for lazily built images."""
+
+    image_file = db.Column(db.String(12), primary_key=True)
+    kickstart = db.Column(db.Text, nullable=False)
+
+    def __init__(self, image_file, kickstart):
+        self.image_file = image_file
+        self.kickstart = kickstart
+
+
+class _GroupCommitItem:  # pylint: disable=too-few-public-methods
+    """The new objects of one request waiting for a group commit."""
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.done = False
+        self.error = None
+
+
+class GroupCommit:  # pylint: disable=too-few-public-methods
+    """Coalesce the inserts of concurrent requests into shared transactions.
+
+    Each request hands the new objects in its session to ``commit``. If no
+    commit is in progress the request writes everything pending in one
+    transaction; otherwise it waits, and the next request to take over
+    writes the whole queue that built up meanwhile. An idle process commits
+    straight away, while under load many requests share each transaction.
+    If a shared transaction fails, each request's rows are retried on their
+    own so one bad insert does not fail the others.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.pending = []
+        self.committing = False
+
+    def commit(self, session):
+        """Insert the new objects in ``session``, sharing a transaction with other requests."""
+        objects = list(session.new)
+        for obj in objects:
+            session.expunge(obj)
+        # End the session's read transaction before writing on another connection.
+        session.commit()
+        item = _GroupCommitItem(objects)
+        with self.cond:
+            self.pending.append(item)
+            while not item.done:
+                if self.committing:
+                    self.cond.wait()
+                    continue
+                batch, self.pending = self.pending, []
+                self.committing = True
+                self.cond.release()
+                try:
+                    self._write(batch)
+                finally:
+                    self.cond.acquire()
+                    self.committing = False
+                    self.cond.notify_all()
+        if item.error is not None:
+            raise item.error
+
+    def _write(self, batch):
+        """Insert the objects of every item in ``batch``, recording per-item errors."""
+        try:
+            with db.engine.begin() as connection:
+                self._insert(connection, [obj for item in batch for obj in item.objects])
+        except Exception:  # pylint: disable=broad-exception-caught
+            for item in batch:
+                try:
+                    with db.engine.begin() as connection:
+                        self._insert(connection, item.objects)
+                except Exception as e:  # pylint: disable=broad-exception-caught
+                    item.error = e
+        for item in batch:
+            item.done = True
+
+    @staticmethod
+    def _insert(connection, objects):
+        """Insert ``objects`` with one executemany per table, parents first."""
+        rows = {}
+        for obj in objects:
+            values = {column.key: getattr(obj, column.key) for column in obj.__table__.columns
+                      if getattr(obj, column.key) is not None}
+            rows.setdefault((obj.__table__, tuple(values)), []).append(values)
+        for table in db.metadata.sorted_tables:
+            for (row_table, _), table_rows in rows.items():
+                if row_table is table:
+                    connection.execute(table.insert(), table_rows)
@@ -0,0 +1,163 @@
+"""Request profiling: ``X-Profile: 1`` from an admin token profiles a request with cProfile.
+
+The profiles are kept in PROFILE_PATH and listed and downloaded through
+``GET /profiles``.
+"""
+
+import cProfile
+import datetime
+import io
+import os
+import pstats
+import re
+import secrets
+import threading
+
+from apiflask import APIBlueprint, FileSchema, Schema, abort
+from apiflask.fields import DateTime, Integer, List, Nested, String
+from apiflask.validators import OneOf, Range
+from flask import Response, current_app, g, request, send_file
+
+from extensions import auth, is_admin, require_admin
+
+bp = APIBlueprint('profiles', __name__)
+
+
+class ProfileOut(Schema):
+    """Output schema describing a stored request profile."""
+
+    profile_id = String(required=True)
+    endpoint = String(required=True)
+    created_at = DateTime(required=True)
+    size = Integer(required=True)
+
+
+class ProfilesOut(Schema):
+    """Output schema listing the stored request profiles."""
+
+    profiles = List(Nested(ProfileOut), required=True)
+
+
+class ProfileQuery(Schema):
+    """Query schema choosing how a request profile is downloaded."""
+
+    format = String(load_default='pstats', validate=OneOf(['pstats', 'text']))
+    limit = Integer(load_default=50, validate=Range(min=1, max=1000))
+
+
+
+# Only one request is profiled at a time; from Python 3.12 cProfile cannot
+# run two profilers at once.
+profile_lock = threading.Lock()
+PROFILE_ID = re.compile(r'^\d{8}T\d{12}-[\w.]+-[0-9a-f]{8}$')
+
+
+@bp.before_app_request
+def start_profiler():
+    """Profile the request if an admin token asks for it with ``X-Profile: 1``."""
+    if request.headers.get('X-Profile') != '1' or not current_app.config['ADMIN_TOKEN_NAMES']:
+        return
+    if not is_admin(auth.verify_token_callback(request.headers.get(auth.header, ''))):
+        current_app.logger.warning("Ignored X-Profile from a token that is not an admin token")
+        return
+    # Held until save_profile or stop_profiler, so it cannot be taken with ``with``.
+    if not profile_lock.acquire(blocking=False):  # pylint: disable=consider-using-with
+        current_app.logger.warning("Not profiling %s, another request is being profiled",
+                                   request.path)
+        return
+    g.profiler = cProfile.Profile()
+    g.profiler.enable()
+
+
+@bp.after_app_request
+def save_profile(response):
+    """Store the profile of a profiled request and name it in ``X-Profile-Id``."""
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return response
+    try:
+        profiler.disable()
+    finally:
+        profile_lock.release()
+    profile_id = (f"{datetime.datetime.now().strftime('%Y%m%dT%H%M%S%f')}-"
+                  f"{request.endpoint or 'none'}-{secrets.token_hex(4)}")
+    path = current_app.config['PROFILE_PATH']
+    os.makedirs(path, exist_ok=True)
+    profiler.dump_stats(os.path.join(path, profile_id + '.prof'))
+    # The IDs sort by time, so the oldest profiles are the first ones listed.
+    for old_profile in sorted(list_profile_ids())[:-current_app.config['PROFILE_KEEP']]:
+        try:
+            os.remove(os.path.join(path, old_profile + '.prof'))
+        except FileNotFoundError:
+            pass
+    current_app.logger.info("Profiled %s %s as %s", request.method, request.path, profile_id)
+    response.headers['X-Profile-Id'] = profile_id
+    return response
+
+
+@bp.teardown_app_request
+def stop_profiler(_exc):
+    """Stop the profiler of a request that failed before its profile was saved."""
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        profile_lock.release()
+
+
+
+
+def list_profile_ids():
+    """Return the IDs of the stored request profiles."""
+    try:
+        names = os.listdir(current_app.config['PROFILE_PATH'])
+    except FileNotFoundError:
+        return []
+    return [name[:-len('.prof')] for name in names
+            if name.endswith('.prof') and PROFILE_ID.match(name[:-len('.prof')])]
+
+
+
+@bp.get('/profiles')
+@bp.auth_required(auth)
+@bp.output(ProfilesOut, status_code=200)
+def get_profiles():
+    """List the stored request profiles, newest first. Admin tokens only."""
+    require_admin()
+    profiles = []
+    for profile_id in sorted(list_profile_ids(), reverse=True):
+        created_at, endpoint, _ = profile_id.split('-')
+        try:
+            size = os.stat(os.path.join(current_app.config['PROFILE_PATH'],
+                                        profile_id + '.prof')).st_size
+        except FileNotFoundError:
+            continue
+        profiles.append({
+            'profile_id': profile_id,
+            'endpoint': endpoint,
+            'created_at': datetime.datetime.strptime(created_at, '%Y%m%dT%H%M%S%f'),
+            'size': size,
+        })
+    return {'profiles': profiles}
+
+
+@bp.get('/profiles/<string:profile_id>')
+@bp.auth_required(auth)
+@bp.input(ProfileQuery, location='query')
+@bp.output(FileSchema, content_type='application/octet-stream', status_code=200)
+def get_profile(profile_id, query_data):
+    """Download a stored request profile. Admin tokens only.
+
+    The profile is in the ``pstats`` format, for ``python -m pstats`` or
+    snakeviz. With ``?format=text`` the slowest functions by cumulative time
+    are returned as text instead.
+    """
+    require_admin()
+    path = os.path.join(current_app.config['PROFILE_PATH'], profile_id + '.prof')
+    if not PROFILE_ID.match(profile_id) or not os.path.exists(path):
+        abort(404, 'Profile not found')
+    if query_data['format'] == 'text':
+        out = io.StringIO()
+        pstats.Stats(path, stream=out).sort_stats('cumulative').print_stats(query_data['limit'])
+        return Response(out.getvalue(), content_type='text/plain; charset=utf-8')
+    return send_file(path, mimetype='application/octet-stream',
+                     download_name=profile_id + '.prof')
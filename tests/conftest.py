@@ -3,9 +3,9 @@ Pytest fixtures for the esxi-kickstart-floppy test suite.
 
 The Flask app module is imported once per session.  Key challenges handled here:
 
-1. APScheduler – ``scheduler.start()`` is called at module-import time.
-   We patch ``APScheduler.start`` *before* the import so no background thread
-   is ever started.
+1. Background jobs – the first request a process handles joins the scheduler
+   election and starts APScheduler in the winner.  ``BACKGROUND_JOBS`` is
+   turned off so no background thread is ever started.
 
 2. Flask-SQLAlchemy engine caching – ``db.init_app(app)`` bakes the engine for
    ``SQLALCHEMY_DATABASE_URI`` at call-time and caches it.  After we swap the
@@ -16,21 +16,30 @@ The Flask app module is imported once per session.  Key challenges handled here:
 3. Filesystem isolation – ``KICKSTART_IMAGE_PATH`` and ``ESXI_ISOS_PATH`` are
    redirected to ``tmp_path_factory`` directories so generated floppies and
    uploaded ISOs never touch the real ``instance/`` tree.
+
+4. Benchmarks – the tests in ``test_benchmarks.py`` are skipped unless
+   ``--benchmark-json`` is given, and their results are written to that file.
 """
 
+import datetime
+import json
 import os
+import platform
+import sqlite3
+import sys
 from io import BytesIO
-from unittest.mock import patch
 
 import pycdlib
 import pytest
 
-# ── 1. Patch the scheduler before importing app ───────────────────────────────
-with patch("flask_apscheduler.APScheduler.start"):
-    import app as app_module
-    from app import db
+# ── 1. Import the app ─────────────────────────────────────────────────────────
+import app as app_module
+import esxi
+import imagestore
+from app import db
 
 TEST_TOKEN = "test-token"
+ADMIN_TOKEN = "admin-token"
 
 
 # ── 2. Session-scoped application fixture ────────────────────────────────────
@@ -51,8 +60,14 @@ def app(tmp_path_factory):
             "KICKSTART_IMAGE_PATH": ks_path,
             "ESXI_ISOS_PATH": esxi_path,
             "BASE_URL": "http://localhost",
+            "TOKEN_FILE": str(tmp_path_factory.mktemp("tokens") / "token_hashes.json"),
+            "BACKGROUND_JOBS": False,
+            "PROFILE_PATH": str(tmp_path_factory.mktemp("profiles")),
+            "KICKSTART_TEMPLATE_PATH": str(tmp_path_factory.mktemp("templates")),
         }
     )
+    app_module.token_store.path = inst.config["TOKEN_FILE"]
+    app_module.kickstart_templates.path = inst.config["KICKSTART_TEMPLATE_PATH"]
 
     # ``tokens`` in app.py is a module-level variable bound to the dict object
     # that existed at import time.  Assigning to app.config['TOKENS'] creates a
@@ -100,7 +115,14 @@ def _clean_db(app):  # pylint: disable=redefined-outer-name
 def _clean_files(app):  # pylint: disable=redefined-outer-name
     """Remove any files written to the temp ks/esxi directories after each test."""
     yield
-    for directory in [app.config["KICKSTART_IMAGE_PATH"], app.config["ESXI_ISOS_PATH"]]:
+    imagestore.image_stores.clear()
+    app_module.floppy_cache.clear()
+    esxi.iso_catalog.invalidate()
+    for upload_file in esxi.resumable_uploads.values():
+        upload_file.close()
+    esxi.resumable_uploads.clear()
+    for directory in [app.config["KICKSTART_IMAGE_PATH"], app.config["ESXI_ISOS_PATH"],
+                      app.config["KICKSTART_TEMPLATE_PATH"]]:
         for filename in os.listdir(directory):
             filepath = os.path.join(directory, filename)
             if os.path.isfile(filepath):
@@ -120,6 +142,14 @@ def auth_headers():
     return {"X-API-Key": TEST_TOKEN}
 
 
+@pytest.fixture
+def admin_headers(app, monkeypatch):  # pylint: disable=redefined-outer-name
+    """Register a token named in ADMIN_TOKEN_NAMES and return headers using it."""
+    monkeypatch.setitem(app_module.tokens, ADMIN_TOKEN, "ops")
+    monkeypatch.setitem(app.config, "ADMIN_TOKEN_NAMES", ["ops"])
+    return {"X-API-Key": ADMIN_TOKEN}
+
+
 @pytest.fixture
 def blank_img(app):  # pylint: disable=redefined-outer-name
     """
@@ -166,3 +196,67 @@ def sample_iso(tmp_path):
     iso.close()
 
     yield str(iso_path)
+
+
+# ── 6. Benchmarks ─────────────────────────────────────────────────────────────
+BENCHMARK_RESULTS = {}
+
+
+def pytest_addoption(parser):
+    """Add the options that run the benchmarks and compare their results."""
+    group = parser.getgroup("benchmarks")
+    group.addoption("--benchmark-json", metavar="PATH",
+                    help="run the benchmarks and write their results to PATH")
+    group.addoption("--benchmark-compare", metavar="PATH",
+                    help="compare the benchmark results with an earlier --benchmark-json file")
+
+
+def pytest_collection_modifyitems(config, items):
+    """Skip the benchmarks unless their results are going to be saved."""
+    if config.getoption("benchmark_json"):
+        return
+    skip = pytest.mark.skip(reason="benchmarks only run with --benchmark-json")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest.fixture
+def record_benchmark():
+    """Return a function that records the metrics of a benchmark under a name."""
+    def record(name, **metrics):
+        BENCHMARK_RESULTS[name] = metrics
+    return record
+
+
+def pytest_sessionfinish(session):
+    """Write the recorded benchmark results, with the environment they were measured in."""
+    path = session.config.getoption("benchmark_json")
+    if not path or not BENCHMARK_RESULTS:
+        return
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({
+            "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "sqlite": sqlite3.sqlite_version,
+            "benchmarks": dict(sorted(BENCHMARK_RESULTS.items())),
+        }, f, indent=2)
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    """Show how each benchmark metric changed since the --benchmark-compare results."""
+    path = config.getoption("benchmark_compare")
+    if not path or not BENCHMARK_RESULTS:
+        return
+    with open(path, encoding="utf-8") as f:
+        baseline = json.load(f)["benchmarks"]
+    terminalreporter.section("benchmark comparison")
+    for name, metrics in sorted(BENCHMARK_RESULTS.items()):
+        for metric, value in metrics.items():
+            old = baseline.get(name, {}).get(metric)
+            if old is None:
+                terminalreporter.write_line(f"{name}.{metric}: {value:.4g} (new)")
+            elif old:
+                terminalreporter.write_line(
+                    f"{name}.{metric}: {old:.4g} -> {value:.4g} ({(value - old) / old:+.1%})")
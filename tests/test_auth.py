@@ -4,6 +4,8 @@ import io
 
 import pytest
 
+import tokenstore
+
 # A minimal valid payload for POST /ks.
 _KS_PAYLOAD = {
     "hostname": "esxi01.example.com",
@@ -63,3 +65,87 @@ def test_delete_esxi_rejects_bad_auth(client, headers):
     """DELETE /esxi/<file> returns 401 when the token is missing or invalid."""
     resp = client.delete("/esxi/test.iso", headers=headers)
     assert resp.status_code == 401
+
+
+@pytest.mark.parametrize(
+    "headers",
+    [
+        {},
+        {"X-API-Key": "wrong-token"},
+    ],
+    ids=["no_token", "wrong_token"],
+)
+def test_post_ks_batch_rejects_bad_auth(client, headers):
+    """POST /ks/batch returns 401 when the token is missing or invalid."""
+    resp = client.post("/ks/batch", json=[_KS_PAYLOAD], headers=headers)
+    assert resp.status_code == 401
+
+
+@pytest.mark.parametrize(
+    "method, path",
+    [
+        ("post", "/esxi/uploads"),
+        ("get", "/esxi/uploads/abc"),
+        ("patch", "/esxi/uploads/abc"),
+        ("post", "/esxi/uploads/abc/complete"),
+        ("delete", "/esxi/uploads/abc"),
+        ("get", "/esxi/jobs/abc"),
+    ],
+)
+def test_upload_and_job_endpoints_reject_bad_auth(client, method, path):
+    """Resumable upload and ISO job endpoints return 401 without a valid token."""
+    resp = getattr(client, method)(path, headers={"X-API-Key": "wrong-token"})
+    assert resp.status_code == 401
+
+
+# ── Hashed token file ─────────────────────────────────────────────────────────
+
+
+def test_hashed_token_file_is_reloaded(client, app):
+    """Tokens added to or removed from TOKEN_FILE take effect without a restart."""
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["add-token", "pipeline-1"])
+    assert result.exit_code == 0
+    token = result.output.strip()
+    with open(app.config["TOKEN_FILE"], encoding="utf-8") as f:
+        assert token not in f.read()
+
+    assert client.get("/esxi/jobs/abc", headers={"X-API-Key": token}).status_code == 404
+
+    result = runner.invoke(args=["remove-token", "pipeline-1"])
+    assert "Removed 1 token(s)" in result.output
+    assert client.get("/esxi/jobs/abc", headers={"X-API-Key": token}).status_code == 401
+
+
+def test_hashed_token_verification_is_cached(tmp_path, monkeypatch):
+    """A verified token is only hashed once until the cache entry expires."""
+    path = str(tmp_path / "token_hashes.json")
+    token = tokenstore.add_token(path, "pipeline-1", b"key")
+    store = tokenstore.HashedTokenStore(path, b"key", cache_ttl=60)
+    hashes = []
+    real_token_hash = tokenstore.token_hash
+    monkeypatch.setattr(tokenstore, "token_hash",
+                        lambda *args: hashes.append(True) or real_token_hash(*args))
+
+    assert store.verify(token) == "pipeline-1"
+    assert store.verify(token) == "pipeline-1"
+    assert len(hashes) == 1
+    assert store.verify(token + "x") is None
+    assert tokenstore.HashedTokenStore(path, b"other-key").verify(token) is None
+
+
+def test_hashed_token_removed_while_hashing_is_rejected(tmp_path, monkeypatch):
+    """A token removed from the file while its hash is being checked is not accepted."""
+    path = str(tmp_path / "token_hashes.json")
+    token = tokenstore.add_token(path, "pipeline-1", b"key")
+    store = tokenstore.HashedTokenStore(path, b"key")
+    real_token_hash = tokenstore.token_hash
+
+    def token_hash(*args):
+        # Another request reloads the file after the token is removed.
+        tokenstore.remove_tokens(path, "pipeline-1")
+        store._reload_if_changed()  # pylint: disable=protected-access
+        return real_token_hash(*args)
+
+    monkeypatch.setattr(tokenstore, "token_hash", token_hash)
+    assert store.verify(token) is None
@@ -0,0 +1,286 @@
+"""Benchmarks for the request hot paths.
+
+These only run with ``pytest --benchmark-json=results.json``, which writes the
+metrics recorded here to ``results.json``; pass ``--benchmark-compare`` with
+the file from an earlier release to see how each one changed. Timings are in
+milliseconds and throughputs in operations per second. Everything runs
+offline against the Flask test client, like the rest of the suite.
+"""
+
+import datetime
+import io
+import itertools
+import os
+import statistics
+import threading
+import time
+
+import pycdlib
+import pytest
+
+import app as app_module
+import esxi
+import extensions
+import imagestore
+import models
+from app import db
+from models import KickstartFloppyImageModel, KickstartFloppyModel
+
+pytestmark = pytest.mark.benchmark
+
+_PAYLOAD = {
+    "hostname": "esxi01.example.com",
+    "rootpw": "$1$salt$hashedpassword",
+    "disk": "sda",
+    "ip": "192.168.1.10",
+    "netmask": "255.255.255.0",
+    "gateway": "192.168.1.1",
+    "nameserver": ["8.8.8.8"],
+    "allowed_ip": "127.0.0.1",  # Flask test client default REMOTE_ADDR
+}
+
+REQUESTS = 200
+THREADS = 8
+ISO_SIZES_MIB = (16, 64, 256)
+CATALOG_ISOS = 5000
+
+
+def _timed(func, count):
+    """Call ``func`` ``count`` times and return how long each call took in seconds."""
+    times = []
+    for _ in range(count):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def _latency(times):
+    """Summarize call durations in seconds as millisecond statistics."""
+    times = sorted(times)
+    return {
+        "count": len(times),
+        "mean_ms": statistics.fmean(times) * 1000,
+        "median_ms": statistics.median(times) * 1000,
+        "p95_ms": times[int(len(times) * 0.95) - 1] * 1000,
+        "min_ms": times[0] * 1000,
+    }
+
+
+def _throughput(app, func, threads, per_thread):
+    """Run ``func(client)`` from several threads and return calls per second."""
+    barrier = threading.Barrier(threads + 1)
+
+    def worker():
+        client = app.test_client()
+        barrier.wait()
+        for _ in range(per_thread):
+            func(client)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    return threads * per_thread / (time.perf_counter() - start)
+
+
+@pytest.mark.parametrize("backend", ["filesystem", "database", "memory"])
+def test_benchmark_post_ks(app, client, auth_headers, monkeypatch, record_benchmark, backend):
+    """POST /ks latency from one client and throughput from several threads."""
+    monkeypatch.setitem(app.config, "KICKSTART_IMAGE_STORE", backend)
+    # Room for every floppy the benchmark creates.
+    monkeypatch.setitem(app.config, "KICKSTART_IMAGE_MEMORY_BUDGET", 1024 * 1024 * 1024)
+
+    hosts = itertools.count()
+
+    def post(c=client, payload=None):
+        # A new hostname per request, so no floppy reuses the image of another.
+        payload = payload or {**_PAYLOAD, "hostname": f"esxi{next(hosts)}.example.com"}
+        assert c.post("/ks", json=payload, headers=auth_headers).status_code == 201
+
+    post()  # warm up the template and the image store
+    times = _timed(post, REQUESTS)
+    rate = _throughput(app, post, THREADS, REQUESTS // THREADS)
+    record_benchmark(f"post_ks[{backend}]", **_latency(times), threads=THREADS,
+                     throughput_per_s=rate)
+    post(payload=_PAYLOAD)
+    record_benchmark(f"post_ks_reused_image[{backend}]",
+                     **_latency(_timed(lambda: post(payload=_PAYLOAD), REQUESTS)))
+
+
+def test_benchmark_post_ks_pooled(app, client, auth_headers, monkeypatch, record_benchmark,
+                                  tmp_path):
+    """POST /ks latency on the filesystem store with a full blank image pool."""
+    monkeypatch.setitem(app.config, "KICKSTART_IMAGE_PATH", str(tmp_path))
+    monkeypatch.setitem(app.config, "KICKSTART_IMAGE_POOL_SIZE", REQUESTS)
+    with app.app_context():
+        pool = imagestore.get_blank_pool()
+    pool.fill()
+    hosts = itertools.count()
+
+    def post():
+        payload = {**_PAYLOAD, "hostname": f"esxi{next(hosts)}.example.com"}
+        assert client.post("/ks", json=payload, headers=auth_headers).status_code == 201
+
+    # Claims alone, without the thread refilling the pool in between.
+    monkeypatch.setitem(app.config, "KICKSTART_IMAGE_POOL_IDLE_SECONDS", 3600)
+    misses = extensions.image_pool_misses.values[()]
+    times = _timed(post, REQUESTS - 1)
+    record_benchmark("post_ks_pooled[filesystem]", **_latency(times),
+                     misses=extensions.image_pool_misses.values[()] - misses)
+
+
+@pytest.mark.parametrize("backend", ["filesystem", "database", "memory"])
+def test_benchmark_get_ks(app, client, auth_headers, monkeypatch, record_benchmark, backend):
+    """GET /ks latency for a full download and for a conditional re-fetch."""
+    monkeypatch.setitem(app.config, "KICKSTART_IMAGE_STORE", backend)
+    image_file = client.post("/ks", json=_PAYLOAD, headers=auth_headers).get_json()["image_file"]
+    etag = client.get(f"/ks/{image_file}").headers["ETag"]
+
+    def get():
+        assert client.get(f"/ks/{image_file}").status_code == 200
+
+    def revalidate():
+        resp = client.get(f"/ks/{image_file}", headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+
+    times = _timed(get, REQUESTS)
+    rate = _throughput(app, lambda c: c.get(f"/ks/{image_file}").close(),
+                       THREADS, REQUESTS // THREADS)
+    record_benchmark(f"get_ks[{backend}]", **_latency(times), threads=THREADS,
+                     throughput_per_s=rate)
+    record_benchmark(f"get_ks_not_modified[{backend}]", **_latency(_timed(revalidate, REQUESTS)))
+
+    def get_gzip():
+        resp = client.get(f"/ks/{image_file}", headers={"Accept-Encoding": "gzip"})
+        assert resp.headers["Content-Encoding"] == "gzip"
+        return resp
+
+    record_benchmark(f"get_ks_gzip[{backend}]", **_latency(_timed(get_gzip, REQUESTS)),
+                     size_bytes=len(get_gzip().data))
+
+
+def _build_iso(path, size_mib):
+    """Write an ISO with ESXi's two BOOT.CFG files padded out to about ``size_mib``."""
+    boot_cfg = b"bootstate=0\nbuild=8.0.2-0.0.22380479\nkernelopt=runweasel cdromBoot\n"
+    payload = b"\0" * (size_mib * 1024 * 1024)
+    iso = pycdlib.PyCdlib()
+    iso.new(joliet=3)
+    iso.add_directory("/EFI", joliet_path="/EFI")
+    iso.add_directory("/EFI/BOOT", joliet_path="/EFI/BOOT")
+    iso.add_fp(io.BytesIO(boot_cfg), len(boot_cfg), "/BOOT.CFG;1", joliet_path="/BOOT.CFG")
+    iso.add_fp(io.BytesIO(boot_cfg), len(boot_cfg), "/EFI/BOOT/BOOT.CFG;1",
+               joliet_path="/EFI/BOOT/BOOT.CFG")
+    iso.add_fp(io.BytesIO(payload), len(payload), "/PAYLOAD.V00;1", joliet_path="/PAYLOAD.V00")
+    iso.write(str(path))
+    iso.close()
+
+
+@pytest.mark.parametrize("size_mib", ISO_SIZES_MIB)
+def test_benchmark_post_esxi(app, client, auth_headers, tmp_path, record_benchmark, size_mib):
+    """POST /esxi time to stream, hash, and patch an ISO of a given size."""
+    iso_path = tmp_path / "bench.iso"
+    _build_iso(iso_path, size_mib)
+    size = os.path.getsize(iso_path)
+
+    def upload():
+        with open(iso_path, "rb") as f:
+            resp = client.post("/esxi", data={"file": (f, "bench.iso")},
+                               content_type="multipart/form-data", headers=auth_headers)
+        assert resp.status_code == 201
+        assert client.delete("/esxi/bench.iso", headers=auth_headers).status_code == 204
+
+    times = _timed(upload, 3)
+    record_benchmark(f"post_esxi[{size_mib}MiB]", **_latency(times), size_bytes=size,
+                     mib_per_s=size / 1024 / 1024 / statistics.median(times))
+
+
+def test_benchmark_get_esxi(app, client, record_benchmark):
+    """GET /esxi with thousands of catalogued ISOs, cold and cached, with and without filters."""
+    with app.app_context():
+        for i in range(CATALOG_ISOS):
+            filename = f"esxi-{i:05d}.iso"
+            with open(os.path.join(app.config["ESXI_ISOS_PATH"], filename), "wb"):
+                pass
+            version = f"{7 + i % 2}.0.{i % 4}"
+            db.session.add(models.EsxiIsoModel(filename, f"{i:064x}", version,
+                                                   f"{version}-0.0.{i}"))
+        db.session.commit()
+
+    def get(query=""):
+        resp = client.get("/esxi" + query)
+        assert resp.status_code == 200
+        return resp
+
+    def cold():
+        esxi.iso_catalog.invalidate()
+        get()
+
+    assert get().get_json()["total"] == CATALOG_ISOS
+    record_benchmark("get_esxi_cold", **_latency(_timed(cold, 20)), isos=CATALOG_ISOS)
+    record_benchmark("get_esxi_cached", **_latency(_timed(get, REQUESTS)), isos=CATALOG_ISOS)
+    record_benchmark("get_esxi_filtered",
+                     **_latency(_timed(lambda: get("?version=8.0&q=1&per_page=50"), REQUESTS)),
+                     isos=CATALOG_ISOS)
+
+
+def _insert_floppies(first, count, expires_at):
+    """Insert ``count`` floppy rows with a 512-byte image each into the database store."""
+    for start in range(first, first + count, 10_000):
+        names = [f"{i:08x}.img" for i in range(start, min(start + 10_000, first + count))]
+        db.session.execute(db.insert(KickstartFloppyModel), [
+            {"image_file": name, "image_url": f"http://localhost/ks/{name}",
+             "allowed_ip": "192.168.1.5", "expires_at": expires_at}
+            for name in names])
+        db.session.execute(db.insert(KickstartFloppyImageModel),
+                           [{"image_file": name, "data": b"x" * 512} for name in names])
+
+
+@pytest.mark.parametrize("rows", [10_000, 100_000])
+def test_benchmark_cleanup(app, monkeypatch, record_benchmark, rows):
+    """cleanup() removing expired rows and their images from the database store."""
+    monkeypatch.setitem(app.config, "KICKSTART_IMAGE_STORE", "database")
+    now = datetime.datetime.now()
+    with app.app_context():
+        _insert_floppies(0, rows, now - datetime.timedelta(minutes=1))
+        db.session.commit()
+
+    start = time.perf_counter()
+    entries, reclaimed = app_module.cleanup()
+    elapsed = time.perf_counter() - start
+    assert (entries, reclaimed) == (rows, rows * 512)
+    record_benchmark(f"cleanup[{rows}]", rows=rows, total_ms=elapsed * 1000,
+                     rows_per_s=rows / elapsed)
+
+
+def test_benchmark_cleanup_live_table(app, monkeypatch, record_benchmark):
+    """cleanup() finding the few expired rows among 100k live ones, the usual case."""
+    monkeypatch.setitem(app.config, "KICKSTART_IMAGE_STORE", "database")
+    live, expired = 100_000, 10
+    now = datetime.datetime.now()
+    with app.app_context():
+        _insert_floppies(0, live, now + datetime.timedelta(hours=1))
+        _insert_floppies(live, expired, now - datetime.timedelta(minutes=1))
+        db.session.commit()
+
+    start = time.perf_counter()
+    entries, reclaimed = app_module.cleanup()
+    elapsed = time.perf_counter() - start
+    assert (entries, reclaimed) == (expired, expired * 512)
+    record_benchmark("cleanup_live[100000]", rows=live + expired, expired=expired,
+                     total_ms=elapsed * 1000)
+
+
+@pytest.mark.parametrize("templates", [1, 1000])
+def test_benchmark_render_kickstart(app, record_benchmark, templates):
+    """render_kickstart() with a growing number of registered templates."""
+    path = app.config["KICKSTART_TEMPLATE_PATH"]
+    for i in range(templates):
+        with open(os.path.join(path, f"site-{i}.ks"), "w", encoding="ascii") as f:
+            f.write(app_module.DEFAULT_KICKSTART_TEMPLATE + f"# site {i}\n")
+    data = app_module.KickstartFloppyIn().load({**_PAYLOAD, "template": "site-0"})
+    times = _timed(lambda: app_module.render_kickstart(data), REQUESTS * 10)
+    record_benchmark(f"render_kickstart[{templates}_templates]", **_latency(times))
@@ -1,11 +1,21 @@
 """Tests for the ESXi ISO endpoints: GET /esxi, POST /esxi, DELETE /esxi/<iso_file>."""
 
+import datetime
+import hashlib
 import io
 import os
+import shutil
+import threading
+import time
 
 import pycdlib
 import pytest
 
+import app as app_module
+import esxi
+import models
+from isostream import BootCfgPatcher
+
 
 # ── GET /esxi ─────────────────────────────────────────────────────────────────
 
@@ -43,6 +53,63 @@ def test_get_esxi_isos_ignores_non_iso_files(client, app):
     assert not any("readme.txt" in url for url in urls)
 
 
+def test_get_esxi_isos_filters_and_paginates(client, app):
+    """GET /esxi filters on version, build, and filename, and paginates the matches."""
+    isos = {"a-7.iso": ("7.0.3", "7.0.3-0.95.23794027"),
+            "b-8.iso": ("8.0.2", "8.0.2-0.0.22380479"),
+            "c-8.iso": ("8.0.3", "8.0.3-0.0.24022510"),
+            "manual.iso": (None, None)}
+    with app.app_context():
+        for filename, (version, build) in isos.items():
+            with open(os.path.join(app.config["ESXI_ISOS_PATH"], filename), "wb") as f:
+                f.write(b"dummy")
+            if version:
+                app_module.db.session.add(
+                    models.EsxiIsoModel(filename, "0" * 64, version, build))
+        app_module.db.session.commit()
+
+    def names(query):
+        resp = client.get("/esxi" + query)
+        assert resp.status_code == 200
+        return [i["filename"] for i in resp.get_json()["isos"]], resp.get_json()["total"]
+
+    assert names("") == (sorted(isos), 4)
+    assert names("?version=8.0") == (["b-8.iso", "c-8.iso"], 2)
+    assert names("?version=8.0.3") == (["c-8.iso"], 1)
+    assert names("?version=8") == (["b-8.iso", "c-8.iso"], 2)
+    assert names("?build=7.0.3-0.95.23794027") == (["a-7.iso"], 1)
+    assert names("?q=MAN") == (["manual.iso"], 1)
+    assert names("?per_page=3&page=2") == (["manual.iso"], 4)
+    assert client.get("/esxi?page=0").status_code == 422
+
+
+def test_get_esxi_isos_reuses_serialized_response(client, app, auth_headers, monkeypatch):
+    """The GET /esxi body is serialized once per query until the catalog changes."""
+    esxi_path = app.config["ESXI_ISOS_PATH"]
+    for filename in ("a.iso", "b.iso"):
+        with open(os.path.join(esxi_path, filename), "wb") as f:
+            f.write(b"dummy")
+    # A directory changed within the last second is rescanned on every request.
+    stale = time.time() - 10
+    os.utime(esxi_path, (stale, stale))
+    renders = []
+    real_render = esxi.render_esxi_isos
+    monkeypatch.setattr(esxi, "render_esxi_isos",
+                        lambda *args: renders.append(args[1]) or real_render(*args))
+
+    first = client.get("/esxi")
+    assert client.get("/esxi").data == first.data
+    assert first.headers["Content-Type"] == "application/json"
+    assert [i["filename"] for i in first.get_json()["isos"]] == ["a.iso", "b.iso"]
+    assert client.get("/esxi?q=b").get_json()["total"] == 1
+    assert client.get("/esxi?q=b").get_json()["total"] == 1
+    assert len(renders) == 2
+
+    assert client.delete("/esxi/a.iso", headers=auth_headers).status_code == 204
+    assert [i["filename"] for i in client.get("/esxi").get_json()["isos"]] == ["b.iso"]
+    assert len(renders) == 3
+
+
 # ── DELETE /esxi/<iso_file> ───────────────────────────────────────────────────
 
 
@@ -88,6 +155,53 @@ def test_post_esxi_rejects_empty_filename(client, auth_headers):
     assert resp.status_code == 400
 
 
+def test_post_esxi_truncated_upload_removes_partial_file(client, app, auth_headers):
+    """A multipart body cut off mid-file is rejected without leaving its .part file."""
+    body = (b'--xyz\r\nContent-Disposition: form-data; name="file"; filename="esxi.iso"\r\n'
+            b"Content-Type: application/octet-stream\r\n\r\n" + b"a" * 5000)
+    resp = client.post(
+        "/esxi",
+        data=body,
+        content_type="multipart/form-data; boundary=xyz",
+        headers=auth_headers,
+    )
+    assert resp.status_code == 422
+    assert os.listdir(app.config["ESXI_ISOS_PATH"]) == []
+
+
+def test_cleanup_uploads_removes_stale_part_files(app):
+    """cleanup_uploads removes .part files older than ESXI_UPLOAD_TIMEOUT_HOURS only."""
+    esxi_path = app.config["ESXI_ISOS_PATH"]
+    for name in (".old.iso.0badf00d.part", ".new.iso.0badf00d.part", "old.iso"):
+        with open(os.path.join(esxi_path, name), "wb") as f:
+            f.write(b"data")
+    stale = time.time() - (app.config["ESXI_UPLOAD_TIMEOUT_HOURS"] + 1) * 3600
+    for name in (".old.iso.0badf00d.part", "old.iso"):
+        os.utime(os.path.join(esxi_path, name), (stale, stale))
+    esxi.cleanup_uploads(app)
+    assert sorted(os.listdir(esxi_path)) == [".new.iso.0badf00d.part", "old.iso"]
+
+
+def test_cleanup_uploads_fails_abandoned_jobs(client, app, auth_headers):
+    """Jobs left queued or patching past ESXI_UPLOAD_TIMEOUT_HOURS are marked failed."""
+    stale = datetime.datetime.now() - datetime.timedelta(
+        hours=app.config["ESXI_UPLOAD_TIMEOUT_HOURS"] + 1)
+    with app.app_context():
+        for job_id, created_at in (("abandoned", stale), ("running", datetime.datetime.now())):
+            job = models.EsxiJobModel(job_id, f"{job_id}.iso")
+            job.state = "patching"
+            job.created_at = created_at
+            app_module.db.session.add(job)
+        app_module.db.session.commit()
+    esxi.cleanup_uploads(app)
+
+    abandoned = client.get("/esxi/jobs/abandoned", headers=auth_headers).get_json()
+    assert abandoned["state"] == "failed"
+    assert abandoned["error"] == "Interrupted before it finished"
+    assert abandoned["finished_at"] is not None
+    assert client.get("/esxi/jobs/running", headers=auth_headers).get_json()["state"] == "patching"
+
+
 @pytest.mark.integration
 def test_post_esxi_valid_iso_returns_201(client, auth_headers, sample_iso):
     """A valid ISO is accepted and returns 201."""
@@ -132,3 +246,439 @@ def test_post_esxi_modifies_boot_cfg(client, app, auth_headers, sample_iso):
     assert b"kernelopt=runweasel ks=usb" in efi_boot_cfg.getvalue()
     # Original cdromBoot option must be gone.
     assert b"cdromBoot" not in boot_cfg.getvalue()
+
+
+# ── Streaming BOOT.CFG patching ───────────────────────────────────────────────
+
+_BOOT_CFG = (b"bootstate=0\ntitle=Loading ESXi installer\nkernelopt=runweasel cdromBoot\n"
+             b"build=8.0.2-0.0.22380479\n")
+
+
+def _build_iso(path, **new_kwargs):
+    """Write an ISO with both BOOT.CFG files using the given pycdlib ``new`` options."""
+    iso = pycdlib.PyCdlib()
+    iso.new(**new_kwargs)
+    joliet = "joliet" in new_kwargs
+    rock_ridge = "rock_ridge" in new_kwargs
+    udf = "udf" in new_kwargs
+    iso.add_fp(io.BytesIO(b"x" * 5000), 5000, "/AAA.BIN;1",
+               rr_name="aaa.bin" if rock_ridge else None,
+               joliet_path="/aaa.bin" if joliet else None,
+               udf_path="/aaa.bin" if udf else None)
+    for parent in ("/EFI", "/EFI/BOOT"):
+        iso.add_directory(parent, rr_name=parent.rsplit("/", 1)[1].lower() if rock_ridge else None,
+                          joliet_path=parent.lower() if joliet else None,
+                          udf_path=parent.lower() if udf else None)
+    for boot_cfg in ("/BOOT.CFG;1", "/EFI/BOOT/BOOT.CFG;1"):
+        name = boot_cfg[:-2].lower()
+        iso.add_fp(io.BytesIO(_BOOT_CFG), len(_BOOT_CFG), boot_cfg,
+                   rr_name=name.rsplit("/", 1)[1] if rock_ridge else None,
+                   joliet_path=name if joliet else None,
+                   udf_path=name if udf else None)
+    iso.write(str(path))
+    iso.close()
+    return str(path)
+
+
+def _without_modification_dates(data):
+    """Return ISO ``data`` with the volume descriptor modification dates zeroed.
+
+    Patching stamps these with the current time, so they differ between runs.
+    """
+    data = bytearray(data)
+    for sector in range(16, 32):
+        offset = sector * 2048
+        if data[offset + 1:offset + 6] == b"CD001":
+            data[offset + 830:offset + 847] = bytes(17)
+    return bytes(data)
+
+
+def _pycdlib_patched(iso_path, tmp_path):
+    """Return the bytes of ``iso_path`` after patching it with pycdlib."""
+    patched = str(tmp_path / "pycdlib.iso")
+    shutil.copyfile(iso_path, patched)
+    esxi.patch_boot_cfg(patched)
+    with open(patched, "rb") as f:
+        return _without_modification_dates(f.read())
+
+
+def _stored_iso(app, name):
+    """Return the bytes of a stored ISO with its modification dates zeroed."""
+    with open(os.path.join(app.config["ESXI_ISOS_PATH"], name), "rb") as f:
+        return _without_modification_dates(f.read())
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize(
+    "new_kwargs",
+    [{}, {"joliet": 3}, {"rock_ridge": "1.09"}, {"joliet": 3, "rock_ridge": "1.09"}],
+    ids=["iso9660", "joliet", "rock_ridge", "joliet_rock_ridge"],
+)
+def test_post_esxi_streams_boot_cfg_patch(client, app, auth_headers, tmp_path,
+                                          monkeypatch, new_kwargs):
+    """The streaming upload produces the same file as patching with pycdlib afterwards."""
+    iso_path = _build_iso(tmp_path / "source.iso", **new_kwargs)
+    expected = _pycdlib_patched(iso_path, tmp_path)
+
+    def _no_fallback(_):
+        raise AssertionError("pycdlib fallback should not be used")
+
+    monkeypatch.setattr(esxi, "patch_boot_cfg", _no_fallback)
+    with open(iso_path, "rb") as f:
+        resp = client.post(
+            "/esxi",
+            data={"file": (f, "stream.iso")},
+            content_type="multipart/form-data",
+            headers=auth_headers,
+        )
+    assert resp.status_code == 201
+    assert _stored_iso(app, "stream.iso") == expected
+
+
+@pytest.mark.integration
+def test_boot_cfg_patcher_small_chunks(tmp_path):
+    """The patcher finds both BOOT.CFG files when the ISO arrives in tiny chunks."""
+    iso_path = _build_iso(tmp_path / "source.iso", joliet=3)
+    with open(iso_path, "rb") as f:
+        data = bytearray(f.read())
+
+    patcher = BootCfgPatcher()
+    patches = []
+    for offset in range(0, len(data), 333):
+        patches += patcher.feed(bytes(data[offset:offset + 333]))
+    assert patcher.complete
+    for offset, patch in patches:
+        data[offset:offset + len(patch)] = patch
+    assert _without_modification_dates(data) == _pycdlib_patched(iso_path, tmp_path)
+
+
+@pytest.mark.integration
+def test_post_esxi_udf_iso_falls_back_to_pycdlib(client, app, auth_headers, tmp_path):
+    """ISOs with UDF file entries are patched with pycdlib after the upload."""
+    iso_path = _build_iso(tmp_path / "source.iso", udf="2.60")
+    expected = _pycdlib_patched(iso_path, tmp_path)
+
+    with open(iso_path, "rb") as f:
+        resp = client.post(
+            "/esxi",
+            data={"file": (f, "udf.iso")},
+            content_type="multipart/form-data",
+            headers=auth_headers,
+        )
+    assert resp.status_code == 201
+    assert _stored_iso(app, "udf.iso") == expected
+
+
+def test_post_esxi_invalid_upload_keeps_existing_iso(client, app, auth_headers):
+    """A rejected upload leaves no partial file and does not replace an existing ISO."""
+    existing = os.path.join(app.config["ESXI_ISOS_PATH"], "keep.iso")
+    with open(existing, "wb") as f:
+        f.write(b"existing")
+
+    resp = client.post(
+        "/esxi",
+        data={"file": (io.BytesIO(b"this is not an iso file"), "keep.iso")},
+        content_type="multipart/form-data",
+        headers=auth_headers,
+    )
+    assert resp.status_code == 400
+    assert os.listdir(app.config["ESXI_ISOS_PATH"]) == ["keep.iso"]
+    with open(existing, "rb") as f:
+        assert f.read() == b"existing"
+
+
+# ── Content-addressed deduplication ───────────────────────────────────────────
+
+
+def _upload(client, auth_headers, iso_path, name):
+    """POST the ISO at ``iso_path`` under ``name``."""
+    with open(iso_path, "rb") as f:
+        return client.post(
+            "/esxi",
+            data={"file": (f, name)},
+            content_type="multipart/form-data",
+            headers=auth_headers,
+        )
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("new_kwargs", [{"joliet": 3}, {"udf": "2.60"}], ids=["streamed", "pycdlib"])
+def test_get_esxi_isos_reports_upload_metadata(client, app, auth_headers, tmp_path, new_kwargs):
+    """Uploaded ISOs are listed with their size, upload hash, and ESXi build."""
+    iso_path = _build_iso(tmp_path / "source.iso", **new_kwargs)
+    assert _upload(client, auth_headers, iso_path, "esxi.iso").status_code == 201
+    with open(iso_path, "rb") as f:
+        sha256 = hashlib.sha256(f.read()).hexdigest()
+
+    resp = client.get("/esxi")
+    (iso,) = resp.get_json()["isos"]
+    assert iso["filename"] == "esxi.iso"
+    assert iso["url"] == "http://localhost/esxi-static/esxi.iso"
+    assert iso["size"] == os.path.getsize(os.path.join(app.config["ESXI_ISOS_PATH"], "esxi.iso"))
+    assert iso["upload_sha256"] == sha256
+    # The served file has been patched, so its hash differs from the upload's.
+    with open(os.path.join(app.config["ESXI_ISOS_PATH"], "esxi.iso"), "rb") as f:
+        assert hashlib.sha256(f.read()).hexdigest() != sha256
+    assert iso["version"] == "8.0.2"
+    assert iso["build"] == "8.0.2-0.0.22380479"
+
+    assert client.delete("/esxi/esxi.iso", headers=auth_headers).status_code == 204
+    assert client.get("/esxi").get_json()["isos"] == []
+
+
+@pytest.mark.integration
+def test_post_esxi_deduplicates_identical_uploads(client, app, auth_headers, sample_iso,
+                                                  monkeypatch):
+    """A second upload of the same ISO is hard linked to the first patched copy."""
+    assert _upload(client, auth_headers, sample_iso, "first.iso").status_code == 201
+
+    def _no_patch(_):
+        raise AssertionError("a known ISO should not be patched again")
+
+    monkeypatch.setattr(esxi, "patch_boot_cfg", _no_patch)
+    assert _upload(client, auth_headers, sample_iso, "second.iso").status_code == 201
+
+    first = os.path.join(app.config["ESXI_ISOS_PATH"], "first.iso")
+    second = os.path.join(app.config["ESXI_ISOS_PATH"], "second.iso")
+    assert os.path.samefile(first, second)
+    assert sorted(os.listdir(app.config["ESXI_ISOS_PATH"])) == ["first.iso", "second.iso"]
+
+
+@pytest.mark.integration
+def test_post_esxi_reupload_same_name(client, app, auth_headers, sample_iso):
+    """Re-uploading an unchanged ISO under its own name leaves a single file."""
+    assert _upload(client, auth_headers, sample_iso, "same.iso").status_code == 201
+    assert _upload(client, auth_headers, sample_iso, "same.iso").status_code == 201
+    assert os.listdir(app.config["ESXI_ISOS_PATH"]) == ["same.iso"]
+
+
+@pytest.mark.integration
+def test_delete_esxi_deduplicated_iso_keeps_other_names(client, app, auth_headers, sample_iso):
+    """Deleting one name of a deduplicated ISO leaves the other names working."""
+    _upload(client, auth_headers, sample_iso, "first.iso")
+    _upload(client, auth_headers, sample_iso, "second.iso")
+
+    assert client.delete("/esxi/first.iso", headers=auth_headers).status_code == 204
+
+    second = os.path.join(app.config["ESXI_ISOS_PATH"], "second.iso")
+    iso = pycdlib.PyCdlib()
+    iso.open(second)
+    boot_cfg = io.BytesIO()
+    iso.get_file_from_iso_fp(boot_cfg, iso_path="/BOOT.CFG;1")
+    iso.close()
+    assert b"kernelopt=runweasel ks=usb" in boot_cfg.getvalue()
+
+    # A new upload of the same content still deduplicates against the remaining name.
+    _upload(client, auth_headers, sample_iso, "third.iso")
+    assert os.path.samefile(second, os.path.join(app.config["ESXI_ISOS_PATH"], "third.iso"))
+
+
+# ── Resumable uploads ─────────────────────────────────────────────────────────
+
+
+def _start_upload(client, auth_headers, size, filename="resumed.iso"):
+    """Start a resumable upload and return its id."""
+    resp = client.post("/esxi/uploads", json={"filename": filename, "size": size},
+                       headers=auth_headers)
+    assert resp.status_code == 201
+    assert resp.get_json()["offset"] == 0
+    return resp.get_json()["upload_id"]
+
+
+def _send_chunk(client, auth_headers, upload_id, offset, chunk):
+    """PATCH one chunk of a resumable upload."""
+    return client.patch(f"/esxi/uploads/{upload_id}", data=chunk,
+                        headers={**auth_headers, "Upload-Offset": str(offset),
+                                 "Content-Type": "application/offset+octet-stream"})
+
+
+@pytest.mark.integration
+def test_resumable_upload(client, app, auth_headers, tmp_path, monkeypatch):
+    """An ISO sent in several chunks is patched while streaming and stored on completion."""
+    iso_path = _build_iso(tmp_path / "source.iso", joliet=3)
+    expected = _pycdlib_patched(iso_path, tmp_path)
+    with open(iso_path, "rb") as f:
+        data = f.read()
+
+    def _no_fallback(_):
+        raise AssertionError("pycdlib fallback should not be used")
+
+    monkeypatch.setattr(esxi, "patch_boot_cfg", _no_fallback)
+    upload_id = _start_upload(client, auth_headers, len(data))
+    for offset in range(0, len(data), 20000):
+        resp = _send_chunk(client, auth_headers, upload_id, offset, data[offset:offset + 20000])
+        assert resp.status_code == 200
+        assert resp.get_json()["offset"] == min(offset + 20000, len(data))
+
+    resp = client.post(f"/esxi/uploads/{upload_id}/complete", headers=auth_headers)
+    assert resp.status_code == 201
+    assert os.listdir(app.config["ESXI_ISOS_PATH"]) == ["resumed.iso"]
+    assert _stored_iso(app, "resumed.iso") == expected
+    assert client.get(f"/esxi/uploads/{upload_id}", headers=auth_headers).status_code == 404
+
+
+@pytest.mark.integration
+def test_resumable_upload_resumed_in_another_process(client, app, auth_headers, tmp_path):
+    """An upload whose streaming state was lost is still hashed and patched on completion."""
+    iso_path = _build_iso(tmp_path / "source.iso")
+    expected = _pycdlib_patched(iso_path, tmp_path)
+    with open(iso_path, "rb") as f:
+        data = f.read()
+
+    upload_id = _start_upload(client, auth_headers, len(data))
+    # Up to the primary volume descriptor: nothing to patch yet, and smaller than the
+    # write buffer, so the chunk stays in memory unless it is flushed.
+    first = 17 * 2048
+    _send_chunk(client, auth_headers, upload_id, 0, data[:first])
+    # The acknowledged chunk is on disk while this process still has the upload open.
+    with app.app_context():
+        path = esxi.resumable_upload_path(upload_id)
+    with open(path, "rb") as f:
+        assert f.read(first) == data[:first]
+    # Simulate the rest of the upload landing on a different worker process.
+    esxi.resumable_uploads.pop(upload_id).finished = True
+    _send_chunk(client, auth_headers, upload_id, first, data[first:])
+
+    resp = client.post(f"/esxi/uploads/{upload_id}/complete", headers=auth_headers)
+    assert resp.status_code == 201
+    assert _stored_iso(app, "resumed.iso") == expected
+
+
+def test_resumable_upload_offset_mismatch(client, auth_headers):
+    """A chunk sent at the wrong offset is rejected with 409 and progress is reported."""
+    upload_id = _start_upload(client, auth_headers, 100)
+    assert _send_chunk(client, auth_headers, upload_id, 0, b"a" * 40).status_code == 200
+    assert _send_chunk(client, auth_headers, upload_id, 0, b"a" * 40).status_code == 409
+    assert _send_chunk(client, auth_headers, upload_id, 40, b"a" * 61).status_code == 400
+    resp = client.get(f"/esxi/uploads/{upload_id}", headers=auth_headers)
+    assert resp.get_json()["offset"] == 40
+
+
+def test_resumable_upload_concurrent_chunks_at_same_offset(client, app, auth_headers,
+                                                           monkeypatch):
+    """Of two PATCHes at the same offset only the first is written; the other gets 409."""
+    upload_id = _start_upload(client, auth_headers, 100)
+    writing = threading.Event()
+    release = threading.Event()
+    real_copy = esxi.copy_upload_chunk
+    copies = []
+
+    def copy_upload_chunk(target, remaining):
+        copies.append(remaining)
+        writing.set()
+        release.wait(5)
+        return real_copy(target, remaining)
+
+    monkeypatch.setattr(esxi, "copy_upload_chunk", copy_upload_chunk)
+    statuses = []
+
+    def send(data):
+        statuses.append(_send_chunk(app.test_client(), auth_headers, upload_id, 0,
+                                    data).status_code)
+
+    first = threading.Thread(target=send, args=(b"a" * 40,))
+    second = threading.Thread(target=send, args=(b"b" * 40,))
+    first.start()
+    assert writing.wait(5)
+    second.start()
+    time.sleep(0.1)
+    release.set()
+    first.join(5)
+    second.join(5)
+
+    assert sorted(statuses) == [200, 409]
+    assert copies == [100]
+    resp = client.get(f"/esxi/uploads/{upload_id}", headers=auth_headers)
+    assert resp.get_json()["offset"] == 40
+    with app.app_context():
+        path = esxi.resumable_upload_path(upload_id)
+    with open(path, "rb") as f:
+        assert f.read(40) == b"a" * 40
+
+
+def test_resumable_upload_complete_before_all_data(client, auth_headers):
+    """Completing an upload that has not received all of its bytes returns 409."""
+    upload_id = _start_upload(client, auth_headers, 100)
+    _send_chunk(client, auth_headers, upload_id, 0, b"a" * 40)
+    resp = client.post(f"/esxi/uploads/{upload_id}/complete", headers=auth_headers)
+    assert resp.status_code == 409
+
+
+def test_resumable_upload_invalid_iso(client, app, auth_headers):
+    """A completed upload that is not an ISO is rejected and leaves no files behind."""
+    upload_id = _start_upload(client, auth_headers, 23)
+    _send_chunk(client, auth_headers, upload_id, 0, b"this is not an iso file")
+    resp = client.post(f"/esxi/uploads/{upload_id}/complete", headers=auth_headers)
+    assert resp.status_code == 400
+    assert os.listdir(app.config["ESXI_ISOS_PATH"]) == []
+
+
+def test_delete_resumable_upload(client, app, auth_headers):
+    """Abandoning an upload removes its preallocated file."""
+    upload_id = _start_upload(client, auth_headers, 4096)
+    assert len(os.listdir(app.config["ESXI_ISOS_PATH"])) == 1
+    assert client.delete(f"/esxi/uploads/{upload_id}", headers=auth_headers).status_code == 204
+    assert os.listdir(app.config["ESXI_ISOS_PATH"]) == []
+    assert client.get(f"/esxi/uploads/{upload_id}", headers=auth_headers).status_code == 404
+
+
+def test_resumable_upload_rejects_oversized(client, auth_headers, app):
+    """Uploads larger than MAX_CONTENT_LENGTH are refused up front."""
+    resp = client.post("/esxi/uploads",
+                       json={"filename": "big.iso", "size": app.config["MAX_CONTENT_LENGTH"] + 1},
+                       headers=auth_headers)
+    assert resp.status_code == 413
+
+
+# ── Asynchronous processing jobs ──────────────────────────────────────────────
+
+
+def _wait_for_job(client, auth_headers, status_url):
+    """Poll a job until it has finished and return its final state."""
+    for _ in range(200):
+        job = client.get(status_url, headers=auth_headers).get_json()
+        if job["state"] in ("done", "failed"):
+            return job
+        time.sleep(0.02)
+    raise AssertionError("job did not finish")
+
+
+@pytest.mark.integration
+def test_post_esxi_async_job(client, app, auth_headers, sample_iso):
+    """With Prefer: respond-async the upload is stored by a background job."""
+    with open(sample_iso, "rb") as f:
+        resp = client.post(
+            "/esxi",
+            data={"file": (f, "async.iso")},
+            content_type="multipart/form-data",
+            headers={**auth_headers, "Prefer": "respond-async"},
+        )
+    assert resp.status_code == 202
+    assert resp.get_json()["state"] == "queued"
+
+    job = _wait_for_job(client, auth_headers, resp.headers["Location"])
+    assert job["state"] == "done"
+    assert job["started_at"] is not None and job["finished_at"] is not None
+    assert os.path.exists(os.path.join(app.config["ESXI_ISOS_PATH"], "async.iso"))
+
+
+def test_post_esxi_async_job_failure(client, app, auth_headers, monkeypatch):
+    """An invalid ISO processed by a job is reported as failed and removed."""
+    monkeypatch.setitem(app.config, "ESXI_ASYNC_JOBS", True)
+    resp = client.post(
+        "/esxi",
+        data={"file": (io.BytesIO(b"this is not an iso file"), "bad.iso")},
+        content_type="multipart/form-data",
+        headers=auth_headers,
+    )
+    assert resp.status_code == 202
+
+    job = _wait_for_job(client, auth_headers, resp.headers["Location"])
+    assert job["state"] == "failed"
+    assert job["error"] == "Invalid or unsupported ISO file"
+    assert os.listdir(app.config["ESXI_ISOS_PATH"]) == []
+
+
+def test_get_esxi_job_not_found(client, auth_headers):
+    """GET /esxi/jobs/<id> returns 404 for an unknown job."""
+    assert client.get("/esxi/jobs/unknown", headers=auth_headers).status_code == 404
@@ -1,13 +1,26 @@
 """Tests for the kickstart floppy endpoints: POST /ks and GET /ks/<image_file>."""
 
 import datetime
+import gzip
+import hashlib
+import json
 import os
 import shutil
+import threading
+import time
 
 import fs as pyfs
 import pytest
+import sqlalchemy
 
+import app as app_module
+import expiry
+import extensions
+import imagestore
+import models
 from app import KickstartFloppyModel, db
+from floppy import BlankImagePool, FloppyTemplate, pack_sparse, unpack_sparse, write_sparse
+from kstemplates import KickstartTemplate, TemplateError, TemplateRegistry
 
 # ── Shared test data ──────────────────────────────────────────────────────────
 
@@ -301,6 +314,83 @@ def test_post_ks_rootpw_with_embedded_flag(client, auth_headers):
     assert client.post("/ks", json=payload, headers=auth_headers).status_code == 422
 
 
+# ── Floppy template engine ────────────────────────────────────────────────────
+
+
+def _pyfatfs_floppy(blank_img, path, contents):
+    """Write ``contents`` as ks.cfg into a copy of blank.img the way pyfatfs does."""
+    shutil.copyfile(blank_img, path)
+    floppy_fs = pyfs.open_fs(f"fat://{path}?offset=512")
+    floppy_fs.create("ks.cfg")
+    floppy_fs.writebytes("ks.cfg", contents)
+    floppy_fs.close()
+    with open(path, "rb") as f:
+        return f.read()
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("size", [1, 511, 512, 513, 1500, 4096])
+def test_floppy_template_matches_pyfatfs(blank_img, tmp_path, size):
+    """FloppyTemplate output is byte-identical to pyfatfs apart from timestamps."""
+    contents = bytes(ord("a") + i % 26 for i in range(size))
+    expected = _pyfatfs_floppy(blank_img, str(tmp_path / "pyfatfs.img"), contents)
+
+    template = FloppyTemplate(blank_img)
+    actual = template.render(contents)
+
+    # Copy the create/access/write timestamps of the short entry across.
+    short_entry = template.dir_entry_offset + FloppyTemplate.DIR_ENTRY_SIZE
+    for start, end in [(14, 20), (22, 26)]:
+        actual[short_entry + start:short_entry + end] = \
+            expected[short_entry + start:short_entry + end]
+    assert bytes(actual) == expected
+
+
+@pytest.mark.integration
+def test_floppy_template_readable_by_pyfatfs(blank_img, tmp_path):
+    """Images written by FloppyTemplate can be read back through pyfatfs."""
+    path = str(tmp_path / "template.img")
+    with open(path, "wb") as f:
+        f.write(FloppyTemplate(blank_img).render(b"vmaccepteula\n"))
+
+    floppy_fs = pyfs.open_fs(f"fat://{path}?offset=512")
+    assert floppy_fs.readbytes("ks.cfg") == b"vmaccepteula\n"
+    floppy_fs.close()
+
+
+@pytest.mark.parametrize("size", [0, 13, 5000, 200_000])
+def test_floppy_template_gzip_round_trips(blank_img, size):
+    """gzip() output decompresses to the image, whether or not it came from the template."""
+    template = FloppyTemplate(blank_img)
+    image = template.render(bytes(ord("a") + i % 26 for i in range(size)))
+    assert gzip.decompress(template.gzip(image)) == image
+    assert gzip.decompress(template.gzip(b"not a floppy")) == b"not a floppy"
+
+
+def test_write_sparse_leaves_holes(blank_img, tmp_path):
+    """write_sparse() skips blocks of zeros, which take no disk space where holes are supported."""
+    image = FloppyTemplate(blank_img).render(b"vmaccepteula\n")
+    packed = pack_sparse(image)
+    assert len(packed) < len(image) // 10
+    assert unpack_sparse(packed) == image
+    assert unpack_sparse(bytes(image)) == image  # stored whole by an older version
+    path = tmp_path / "sparse.img"
+    with open(path, "wb") as f:
+        write_sparse(f, image)
+    assert path.read_bytes() == image
+    with open(tmp_path / "probe", "wb") as f:
+        f.truncate(len(image))
+    if os.stat(tmp_path / "probe").st_blocks:
+        pytest.skip("the filesystem does not support sparse files")
+    assert os.stat(path).st_blocks * 512 < len(image) // 10
+
+
+def test_floppy_template_rejects_oversized_contents(blank_img):
+    """Contents larger than the free space on the floppy raise ValueError."""
+    with pytest.raises(ValueError):
+        FloppyTemplate(blank_img).render(b"x" * 2 * 1024 * 1024)
+
+
 # ── GET /ks/<image_file> ──────────────────────────────────────────────────────
 
 
@@ -346,3 +436,915 @@ def test_get_kickstart_floppy_correct_ip(client, app, blank_img):
     resp = client.get(f"/ks/{floppy_name}")
     assert resp.status_code == 200
     assert resp.content_type == "application/octet-stream"
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("backend", ["filesystem", "database", "memory"])
+def test_get_kickstart_floppy_conditional_and_range(client, auth_headers, app, monkeypatch,
+                                                    backend):
+    """GET /ks serves byte ranges, a content ETag, and 304 for unchanged images."""
+    monkeypatch.setitem(app.config, "KICKSTART_IMAGE_STORE", backend)
+    payload = {**_VALID_PAYLOAD, "allowed_ip": "127.0.0.1"}
+    image_file = client.post("/ks", json=payload, headers=auth_headers).get_json()["image_file"]
+
+    resp = client.get(f"/ks/{image_file}")
+    assert resp.status_code == 200
+    assert resp.headers["Accept-Ranges"] == "bytes"
+    assert resp.get_etag() == (hashlib.sha256(resp.data).hexdigest(), False)
+    image = resp.data
+
+    resp = client.get(f"/ks/{image_file}", headers={"Range": "bytes=512-1023"})
+    assert resp.status_code == 206
+    assert resp.headers["Content-Range"] == f"bytes 512-1023/{len(image)}"
+    assert resp.data == image[512:1024]
+
+    def not_opened(_):
+        raise AssertionError("revalidation opened the image")
+
+    monkeypatch.setattr(app_module, "open_floppy_image", not_opened)
+    etag = hashlib.sha256(image).hexdigest()
+    resp = client.get(f"/ks/{image_file}", headers={"If-None-Match": f'"{etag}"'})
+    assert resp.status_code == 304
+    assert resp.data == b""
+    last_modified = imagestore.get_floppy_template().modified_at(image).astimezone(
+        datetime.timezone.utc)
+    resp = client.get(f"/ks/{image_file}", headers={
+        "If-Modified-Since": last_modified.strftime("%a, %d %b %Y %H:%M:%S GMT")})
+    assert resp.status_code == 304
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("backend", ["filesystem", "database", "memory"])
+def test_get_kickstart_floppy_gzip(client, auth_headers, app, monkeypatch, backend):
+    """GET /ks sends the image gzipped, with its own ETag, to clients that accept gzip."""
+    monkeypatch.setitem(app.config, "KICKSTART_IMAGE_STORE", backend)
+    payload = {**_VALID_PAYLOAD, "allowed_ip": "127.0.0.1"}
+    image_file = client.post("/ks", json=payload, headers=auth_headers).get_json()["image_file"]
+    image = client.get(f"/ks/{image_file}").data
+
+    resp = client.get(f"/ks/{image_file}", headers={"Accept-Encoding": "gzip, deflate"})
+    assert resp.status_code == 200
+    assert resp.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in resp.headers["Vary"]
+    assert len(resp.data) < len(image) // 10
+    assert gzip.decompress(resp.data) == image
+    etag = hashlib.sha256(image).hexdigest()
+    assert resp.get_etag() == (etag + "-gzip", False)
+
+    resp = client.get(f"/ks/{image_file}", headers={
+        "Accept-Encoding": "gzip", "If-None-Match": f'"{etag}-gzip"'})
+    assert resp.status_code == 304
+    # The uncompressed ETag does not match the compressed representation.
+    resp = client.get(f"/ks/{image_file}", headers={
+        "Accept-Encoding": "gzip", "If-None-Match": f'"{etag}"'})
+    assert resp.status_code == 200
+    resp = client.get(f"/ks/{image_file}", headers={"Accept-Encoding": "gzip;q=0"})
+    assert "Content-Encoding" not in resp.headers
+    assert resp.data == image
+
+
+@pytest.mark.integration
+def test_get_kickstart_floppy_range_is_not_gzipped(client, auth_headers):
+    """Range and If-Range requests get the uncompressed image even when gzip is accepted."""
+    payload = {**_VALID_PAYLOAD, "allowed_ip": "127.0.0.1"}
+    image_file = client.post("/ks", json=payload, headers=auth_headers).get_json()["image_file"]
+    image = client.get(f"/ks/{image_file}").data
+    etag = hashlib.sha256(image).hexdigest()
+
+    resp = client.get(f"/ks/{image_file}", headers={
+        "Accept-Encoding": "gzip", "Range": "bytes=512-1023"})
+    assert resp.status_code == 206
+    assert "Content-Encoding" not in resp.headers
+    assert resp.get_etag() == (etag, False)
+    assert resp.data == image[512:1024]
+
+    resp = client.get(f"/ks/{image_file}", headers={
+        "Accept-Encoding": "gzip", "Range": "bytes=512-1023", "If-Range": f'"{etag}"'})
+    assert resp.status_code == 206
+    assert resp.data == image[512:1024]
+    resp = client.get(f"/ks/{image_file}", headers={
+        "Accept-Encoding": "gzip", "If-Range": f'"{etag}"'})
+    assert "Content-Encoding" not in resp.headers
+    assert resp.data == image
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("backend", ["filesystem", "database", "memory"])
+def test_get_kickstart_floppy_closes_validator_image(client, auth_headers, app, monkeypatch,
+                                                     backend):
+    """The image opened to compute validators is closed on 304 and gzip responses."""
+    monkeypatch.setitem(app.config, "KICKSTART_IMAGE_STORE", backend)
+    payload = {**_VALID_PAYLOAD, "allowed_ip": "127.0.0.1"}
+    image_file = client.post("/ks", json=payload, headers=auth_headers).get_json()["image_file"]
+    etag = hashlib.sha256(client.get(f"/ks/{image_file}").data).hexdigest()
+    opened = []
+    open_floppy_image = app_module.open_floppy_image
+
+    def record_open(image_blob):
+        image = open_floppy_image(image_blob)
+        opened.append(image)
+        return image
+
+    monkeypatch.setattr(app_module, "open_floppy_image", record_open)
+    app_module.floppy_cache.discard(image_file)
+    resp = client.get(f"/ks/{image_file}", headers={"If-None-Match": f'"{etag}"'})
+    assert resp.status_code == 304
+    app_module.floppy_cache.discard(image_file)
+    resp = client.get(f"/ks/{image_file}", headers={"Accept-Encoding": "gzip"})
+    assert resp.headers["Content-Encoding"] == "gzip"
+    assert len(opened) == 3
+    assert all(image.closed for image in opened)
+
+
+@pytest.fixture(name="statements")
+def _statements(app):
+    """Collect the SQL statements run against the app's database during a test."""
+    statements = []
+    with app.app_context():
+        engine = db.engine
+
+    def before_cursor_execute(conn, cursor, statement, *args):  # pylint: disable=unused-argument
+        statements.append(statement)
+
+    sqlalchemy.event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    yield statements
+    sqlalchemy.event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+@pytest.mark.integration
+def test_get_kickstart_floppy_metadata_is_cached(client, auth_headers, app, statements):
+    """Repeated downloads of a floppy are answered without querying the database."""
+    payload = {**_VALID_PAYLOAD, "allowed_ip": "127.0.0.1"}
+    image_file = client.post("/ks", json=payload, headers=auth_headers).get_json()["image_file"]
+    assert client.get(f"/ks/{image_file}").status_code == 200
+
+    statements.clear()
+    assert client.get(f"/ks/{image_file}").status_code == 200
+    assert client.get(f"/ks/{image_file}", environ_base={"REMOTE_ADDR": "10.0.0.1"}).status_code == 401
+    assert not statements
+
+    _expire_all(app)
+    app_module.cleanup()
+    assert client.get(f"/ks/{image_file}").status_code == 404
+
+
+def test_get_kickstart_floppy_caches_not_found(client, app, monkeypatch, statements):
+    """Unknown image names are looked up once per negative cache period."""
+    assert client.get("/ks/random.img").status_code == 404
+    assert client.get("/ks/random.img").status_code == 404
+    assert len(statements) == 1
+
+    monkeypatch.setitem(app.config, "KICKSTART_NEGATIVE_CACHE_SECONDS", 0)
+    app_module.floppy_cache.clear()
+    assert client.get("/ks/random.img").status_code == 404
+    assert client.get("/ks/random.img").status_code == 404
+    assert len(statements) == 3
+
+
+# ── Image store backends ──────────────────────────────────────────────────────
+
+
+def _expire_all(app):
+    """Move every floppy record's expiry into the past."""
+    with app.app_context():
+        for record in db.session.execute(db.select(KickstartFloppyModel)).scalars():
+            record.expires_at = datetime.datetime.now() - datetime.timedelta(minutes=1)
+        db.session.commit()
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("backend", ["filesystem", "database", "memory"])
+def test_image_store_round_trip(client, auth_headers, app, monkeypatch, tmp_path, backend):
+    """Each backend stores the image on POST, serves it on GET and drops it on cleanup."""
+    monkeypatch.setitem(app.config, "KICKSTART_IMAGE_STORE", backend)
+    payload = {**_VALID_PAYLOAD, "allowed_ip": "127.0.0.1"}
+    data = client.post("/ks", json=payload, headers=auth_headers).get_json()
+    image_file = data["image_file"]
+
+    on_disk = os.path.join(app.config["KICKSTART_IMAGE_PATH"], image_file)
+    assert os.path.exists(on_disk) == (backend == "filesystem")
+
+    resp = client.get(f"/ks/{image_file}")
+    assert resp.status_code == 200
+    floppy_path = tmp_path / "served.img"
+    floppy_path.write_bytes(resp.data)
+    floppy_fs = pyfs.open_fs(f"fat://{floppy_path}?offset=512")
+    assert _VALID_PAYLOAD["hostname"] in floppy_fs.readtext("ks.cfg")
+    floppy_fs.close()
+
+    _expire_all(app)
+    app_module.cleanup()
+    with app.app_context():
+        assert imagestore.get_image_store().open(image_file) is None
+        assert db.session.execute(db.select(KickstartFloppyModel)).first() is None
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("pool_size", [0, 1])
+def test_filesystem_image_store_renames_complete_images(client, auth_headers, app, monkeypatch,
+                                                        tmp_path, pool_size):
+    """Images are written under a temporary name, so their own name only shows complete images."""
+    ks_path = tmp_path / "ks"
+    ks_path.mkdir()
+    monkeypatch.setitem(app.config, "KICKSTART_IMAGE_PATH", str(ks_path))
+    monkeypatch.setitem(app.config, "KICKSTART_IMAGE_POOL_SIZE", pool_size)
+    monkeypatch.setitem(app.config, "KICKSTART_IMAGE_POOL_IDLE_SECONDS", 0)
+    if pool_size:
+        with app.app_context():
+            pool = imagestore.get_blank_pool()
+        assert _wait_for(lambda: pool.depth() == 1)
+    images = []
+    real_open = open
+
+    def checked_open(path, mode="r", *args, **kwargs):
+        if "b" in mode and mode != "rb":
+            # Only temporary names are opened for writing.
+            assert os.path.basename(path).startswith(".") and path.endswith(".tmp")
+            images.append(path)
+        return real_open(path, mode, *args, **kwargs)
+
+    monkeypatch.setattr("builtins.open", checked_open)
+    resp = client.post("/ks", json=_VALID_PAYLOAD, headers=auth_headers)
+    monkeypatch.undo()
+    assert resp.status_code == 201
+    assert images
+    assert resp.get_json()["image_file"] in os.listdir(ks_path)
+    assert not [name for name in os.listdir(ks_path) if name.endswith(".tmp")]
+
+
+@pytest.mark.integration
+def test_memory_image_store_budget(client, auth_headers, app, monkeypatch):
+    """POST /ks returns 503 once the memory store budget is exhausted."""
+    monkeypatch.setitem(app.config, "KICKSTART_IMAGE_STORE", "memory")
+    assert client.post("/ks", json=_VALID_PAYLOAD, headers=auth_headers).status_code == 201
+    with app.app_context():
+        store = imagestore.get_image_store()
+    # Only the few non-zero blocks of each image are kept.
+    assert store.used < 1474560 // 10
+    store.budget = store.used * 5 // 2
+
+    # Distinct hosts, so that each floppy needs an image of its own.
+    for i, status in enumerate([201, 503]):
+        payload = {**_VALID_PAYLOAD, "hostname": f"esxi{i}.example.com"}
+        assert client.post("/ks", json=payload, headers=auth_headers).status_code == status
+
+
+# ── Blank image pool ──────────────────────────────────────────────────────────
+
+
+def _wait_for(predicate, timeout=5):
+    """Poll ``predicate`` until it is true or ``timeout`` seconds have passed."""
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_blank_image_pool_claim_matches_rendered_image(blank_img, tmp_path):
+    """Patching a claimed blank image gives the image render() returns."""
+    template = FloppyTemplate(blank_img)
+    pool = BlankImagePool(str(tmp_path / "pool"), template.image, size=1)
+    assert pool.fill() and pool.depth() == 1
+
+    now = datetime.datetime(2024, 5, 17, 12, 30)
+    target = tmp_path / "claimed.img"
+    assert pool.claim(str(target))
+    with open(target, "r+b") as f:
+        for offset, data in template.patches(b"vmaccepteula\n", now):
+            f.seek(offset)
+            f.write(data)
+    assert target.read_bytes() == template.render(b"vmaccepteula\n", now)
+    assert pool.depth() == 0
+    assert not pool.claim(str(tmp_path / "missed.img"))
+
+
+@pytest.mark.integration
+def test_post_ks_claims_from_blank_image_pool(client, auth_headers, app, monkeypatch, tmp_path):
+    """POST /ks claims pooled blank images, falls back when the pool is empty, and refills it."""
+    # Keep .pool out of the image directory the other tests list.
+    ks_path = tmp_path / "ks"
+    ks_path.mkdir()
+    monkeypatch.setitem(app.config, "KICKSTART_IMAGE_PATH", str(ks_path))
+    monkeypatch.setitem(app.config, "KICKSTART_IMAGE_POOL_SIZE", 1)
+    monkeypatch.setitem(app.config, "KICKSTART_IMAGE_POOL_IDLE_SECONDS", 0)
+    with app.app_context():
+        pool = imagestore.get_blank_pool()
+    assert _wait_for(lambda: pool.depth() == 1)
+    # Keep the pool empty after the first claim until the idle time is shortened again.
+    monkeypatch.setitem(app.config, "KICKSTART_IMAGE_POOL_IDLE_SECONDS", 60)
+    claims = extensions.image_pool_claims.values[()]
+    misses = extensions.image_pool_misses.values[()]
+
+    payload = {**_VALID_PAYLOAD, "allowed_ip": "127.0.0.1"}
+    for i in range(2):
+        data = client.post("/ks", json={**payload, "hostname": f"esxi{i}.example.com"},
+                           headers=auth_headers).get_json()
+        floppy_path = tmp_path / f"served{i}.img"
+        floppy_path.write_bytes(client.get(f"/ks/{data['image_file']}").data)
+        floppy_fs = pyfs.open_fs(f"fat://{floppy_path}?offset=512")
+        assert f"esxi{i}.example.com" in floppy_fs.readtext("ks.cfg")
+        floppy_fs.close()
+    assert extensions.image_pool_claims.values[()] - claims == 1
+    assert extensions.image_pool_misses.values[()] - misses == 1
+    assert pool.depth() == 0
+
+    monkeypatch.setitem(app.config, "KICKSTART_IMAGE_POOL_IDLE_SECONDS", 0)
+    with app.app_context():
+        imagestore.get_blank_pool().start()
+    assert _wait_for(lambda: pool.depth() == 1)
+    assert "\nksfloppy_image_pool_depth 1\n" in client.get("/metrics").get_data(as_text=True)
+
+
+# ── Image reuse ───────────────────────────────────────────────────────────────
+
+
+def _set_expiry(app, image_file, expires_at):
+    with app.app_context():
+        db.session.execute(db.update(KickstartFloppyModel).filter_by(image_file=image_file)
+                           .values(expires_at=expires_at))
+        db.session.commit()
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("backend", ["filesystem", "database", "memory"])
+def test_identical_kickstarts_share_an_image(client, auth_headers, app, monkeypatch, backend):
+    """Floppies with the same kickstart share one stored image until the last one expires."""
+    monkeypatch.setitem(app.config, "KICKSTART_IMAGE_STORE", backend)
+    first = client.post("/ks", json={**_VALID_PAYLOAD, "allowed_ip": "127.0.0.1"},
+                        headers=auth_headers).get_json()
+    second = client.post("/ks", json={**_VALID_PAYLOAD, "allowed_ip": "127.0.0.2"},
+                         headers=auth_headers).get_json()
+    assert first["image_file"] != second["image_file"]
+    with app.app_context():
+        rows = {r.image_file: r for r in db.session.execute(
+            db.select(KickstartFloppyModel)).scalars()}
+        assert rows[second["image_file"]].image_blob == first["image_file"]
+        assert imagestore.get_image_store().open(second["image_file"]) is None
+
+    image = client.get(f"/ks/{first['image_file']}").data
+    resp = client.get(f"/ks/{second['image_file']}", environ_base={"REMOTE_ADDR": "127.0.0.2"})
+    assert resp.status_code == 200
+    assert resp.data == image
+    assert client.get(f"/ks/{second['image_file']}").status_code == 401
+
+    # The image outlives the floppy that built it while another floppy uses it.
+    _set_expiry(app, first["image_file"], datetime.datetime.now() - datetime.timedelta(minutes=1))
+    assert app_module.cleanup() == (1, 0)
+    resp = client.get(f"/ks/{second['image_file']}", environ_base={"REMOTE_ADDR": "127.0.0.2"})
+    assert resp.data == image
+
+    with app.app_context():
+        stored = imagestore.image_store_bytes()
+    _expire_all(app)
+    assert app_module.cleanup() == (1, stored)
+    with app.app_context():
+        assert imagestore.get_image_store().open(first["image_file"]) is None
+
+
+def test_image_not_reused_when_about_to_expire(client, auth_headers, app):
+    """An image whose floppies all expire within REUSE_MIN_REMAINING is not reused."""
+    first = client.post("/ks", json=_VALID_PAYLOAD, headers=auth_headers).get_json()
+    _set_expiry(app, first["image_file"], datetime.datetime.now() + datetime.timedelta(seconds=30))
+    second = client.post("/ks", json=_VALID_PAYLOAD, headers=auth_headers).get_json()
+    with app.app_context():
+        row = db.session.execute(db.select(KickstartFloppyModel).filter_by(
+            image_file=second["image_file"])).scalar_one()
+    assert row.image_blob == second["image_file"]
+    assert os.path.exists(os.path.join(app.config["KICKSTART_IMAGE_PATH"], second["image_file"]))
+
+
+def test_image_reuse_can_be_disabled(client, auth_headers, app, monkeypatch):
+    """With KICKSTART_REUSE_IMAGES off every floppy gets its own image."""
+    monkeypatch.setitem(app.config, "KICKSTART_REUSE_IMAGES", False)
+    for _ in range(2):
+        client.post("/ks", json=_VALID_PAYLOAD, headers=auth_headers)
+    assert len(os.listdir(app.config["KICKSTART_IMAGE_PATH"])) == 2
+
+
+# ── Lazy image materialization ────────────────────────────────────────────────
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("backend", ["filesystem", "database", "memory"])
+def test_lazy_image_built_on_first_download(client, auth_headers, app, monkeypatch, backend):
+    """With KICKSTART_LAZY_IMAGES the image is only built when it is first fetched."""
+    monkeypatch.setitem(app.config, "KICKSTART_LAZY_IMAGES", True)
+    monkeypatch.setitem(app.config, "KICKSTART_IMAGE_STORE", backend)
+    payload = {**_VALID_PAYLOAD, "allowed_ip": "127.0.0.1"}
+    resp = client.post("/ks", json=payload, headers=auth_headers)
+    assert resp.status_code == 201
+    image_file = resp.get_json()["image_file"]
+
+    with app.app_context():
+        assert imagestore.get_image_store().open(image_file) is None
+        source = db.session.get(models.KickstartSourceModel, image_file)
+        assert _VALID_PAYLOAD["hostname"] in source.kickstart
+
+    first = client.get(f"/ks/{image_file}")
+    second = client.get(f"/ks/{image_file}")
+    assert first.status_code == 200
+    assert second.data == first.data
+    with app.app_context():
+        image = imagestore.get_image_store().open(image_file)
+        assert image is not None
+        image.close()
+
+
+@pytest.mark.integration
+def test_lazy_image_cleanup_without_download(client, auth_headers, app, monkeypatch):
+    """Cleanup removes the stored kickstart source of a never-downloaded lazy image."""
+    monkeypatch.setitem(app.config, "KICKSTART_LAZY_IMAGES", True)
+    client.post("/ks", json=_VALID_PAYLOAD, headers=auth_headers)
+
+    _expire_all(app)
+    app_module.cleanup()
+    with app.app_context():
+        assert db.session.execute(db.select(models.KickstartSourceModel)).first() is None
+
+
+def test_lazy_image_wrong_ip_not_built(client, auth_headers, app, monkeypatch):
+    """A download attempt from the wrong IP does not build the image."""
+    monkeypatch.setitem(app.config, "KICKSTART_LAZY_IMAGES", True)
+    image_file = client.post(
+        "/ks", json=_VALID_PAYLOAD, headers=auth_headers).get_json()["image_file"]
+
+    assert client.get(f"/ks/{image_file}").status_code == 401
+    with app.app_context():
+        assert imagestore.get_image_store().open(image_file) is None
+
+
+@pytest.mark.integration
+def test_lazy_images_materialize_in_parallel(client, auth_headers, app, monkeypatch):
+    """Building one lazy image does not hold up the first download of another."""
+    monkeypatch.setitem(app.config, "KICKSTART_LAZY_IMAGES", True)
+    monkeypatch.setitem(app.config, "KICKSTART_REUSE_IMAGES", False)
+    payload = {**_VALID_PAYLOAD, "allowed_ip": "127.0.0.1"}
+    slow, fast = (client.post("/ks", json=payload, headers=auth_headers).get_json()["image_file"]
+                  for _ in range(2))
+    building = threading.Event()
+    release = threading.Event()
+    real_store = imagestore.store_floppy_image
+
+    def store_floppy_image(image_file, kickstart):
+        if image_file == slow:
+            building.set()
+            release.wait(5)
+        real_store(image_file, kickstart)
+
+    monkeypatch.setattr(imagestore, "store_floppy_image", store_floppy_image)
+    statuses = []
+    thread = threading.Thread(
+        target=lambda: statuses.append(app.test_client().get(f"/ks/{slow}").status_code))
+    thread.start()
+    try:
+        assert building.wait(5)
+        assert client.get(f"/ks/{fast}").status_code == 200
+        assert not statuses
+    finally:
+        release.set()
+        thread.join(5)
+    assert statuses == [200]
+
+
+# ── Kickstart templates ───────────────────────────────────────────────────────
+
+_SITE_TEMPLATE = (
+    "vmaccepteula\n"
+    "rootpw --iscrypted {{ rootpw }}\n"
+    "install {{ disk_option }}\n"
+    "network --bootproto=static --ip={{ip}} --hostname={{ hostname }}\n"
+    "%firstboot --interpreter=busybox\n"
+    "esxcli system hostname set --fqdn=${HOSTNAME:-{{ hostname }}}\n"
+)
+
+
+def _kickstart_source(app, image_file):
+    with app.app_context():
+        return db.session.get(models.KickstartSourceModel, image_file).kickstart
+
+
+def test_kickstart_template_compiles_once_and_reloads(tmp_path):
+    """Template files are compiled once per content and reloaded when they change."""
+    registry = TemplateRegistry(str(tmp_path), ("hostname",), {"default": "host {{ hostname }}\n"})
+    assert registry.get("default").render({"hostname": "a"}) == "host a\n"
+    assert registry.get("site") is None
+
+    (tmp_path / "site.ks").write_text("# ${X} {{hostname}}\n")
+    (tmp_path / "copy.ks").write_text("# ${X} {{hostname}}\n")
+    site = registry.get("site")
+    assert site.render({"hostname": "b"}) == "# ${X} b\n"
+    assert registry.get("copy") is site
+    assert registry.get("site") is site
+
+    (tmp_path / "site.ks").write_text("{{ hostname }} again\n")
+    assert registry.get("site").render({"hostname": "c"}) == "c again\n"
+
+    # A file broken by hand keeps the last good version and reports why.
+    (tmp_path / "site.ks").write_text("{{ password }}\n")
+    assert registry.get("site").render({"hostname": "c"}) == "c again\n"
+    assert "password" in registry.errors["site"]
+
+    # A file cannot replace a built-in template.
+    (tmp_path / "default.ks").write_text("override {{ hostname }}\n")
+    assert registry.get("default").render({"hostname": "d"}) == "host d\n"
+    assert "built-in" in registry.errors["default"]
+    with pytest.raises(TemplateError):
+        registry.put("default", "override {{ hostname }}\n")
+    assert not registry.delete("default")
+    os.remove(tmp_path / "default.ks")
+    assert registry.get("default").render({"hostname": "d"}) == "host d\n"
+    assert "default" not in registry.errors
+    assert sorted(registry.list()) == ["copy", "default", "site"]
+
+
+def test_kickstart_template_rejects_unknown_fields():
+    """Templates may only use the fields POST /ks validates."""
+    with pytest.raises(TemplateError, match="rootpassword"):
+        KickstartTemplate("{{ rootpassword }}", ("rootpw",))
+    with pytest.raises(TemplateError, match="ASCII"):
+        KickstartTemplate("caf\u00e9", ())
+
+
+def test_default_template_matches_builtin_kickstart(client, auth_headers, app, monkeypatch):
+    """Without a template, POST /ks renders the built-in kickstart."""
+    monkeypatch.setitem(app.config, "KICKSTART_LAZY_IMAGES", True)
+    payload = {**_VALID_PAYLOAD, "vlanid": 12, "clearpart": True}
+    image_file = client.post("/ks", json=payload, headers=auth_headers).get_json()["image_file"]
+    kickstart = _kickstart_source(app, image_file)
+    assert kickstart.startswith("vmaccepteula\nrootpw --iscrypted $1$salt$hashedpassword\n"
+                                "clearpart --drives=sda\ninstall --disk=sda --preservevmfs\n")
+    assert (" --netmask=255.255.255.0 --hostname=esxi01.example.com"
+            " --addvmportgroup=1 --vlanid=12\n") in kickstart
+    assert kickstart.endswith("/opt/ilorest/bin/ilorest.sh virtualmedia 1 --remove\nfi\n")
+
+
+def test_post_ks_with_registered_template(client, auth_headers, admin_headers, app,
+                                         monkeypatch):
+    """A template registered with PUT /ks/templates/<name> is used by POST /ks."""
+    monkeypatch.setitem(app.config, "KICKSTART_LAZY_IMAGES", True)
+    resp = client.put("/ks/templates/site", json={"template": _SITE_TEMPLATE},
+                      headers=admin_headers)
+    assert resp.status_code == 200
+    assert resp.get_json()["sha256"] == hashlib.sha256(_SITE_TEMPLATE.encode()).hexdigest()
+    assert os.path.exists(os.path.join(app.config["KICKSTART_TEMPLATE_PATH"], "site.ks"))
+
+    payload = {**_VALID_PAYLOAD, "template": "site"}
+    image_file = client.post("/ks", json=payload, headers=auth_headers).get_json()["image_file"]
+    assert _kickstart_source(app, image_file) == (
+        "vmaccepteula\n"
+        "rootpw --iscrypted $1$salt$hashedpassword\n"
+        "install --disk=sda\n"
+        "network --bootproto=static --ip=192.168.1.10 --hostname=esxi01.example.com\n"
+        "%firstboot --interpreter=busybox\n"
+        "esxcli system hostname set --fqdn=${HOSTNAME:-esxi01.example.com}\n"
+    )
+
+    templates = client.get("/ks/templates", headers=auth_headers).get_json()["templates"]
+    assert [(t["name"], t["builtin"]) for t in templates] == [("default", True), ("site", False)]
+    resp = client.get("/ks/templates/site", headers=auth_headers)
+    assert resp.get_json()["template"] == _SITE_TEMPLATE
+
+    assert client.delete("/ks/templates/site", headers=admin_headers).status_code == 204
+    assert client.post("/ks", json=payload, headers=auth_headers).status_code == 422
+    assert client.get("/ks/templates/site", headers=auth_headers).status_code == 404
+
+
+def test_put_kickstart_template_rejects_invalid_templates(client, admin_headers):
+    """Templates with unknown fields or invalid names are refused."""
+    resp = client.put("/ks/templates/site", json={"template": "{{ secret }}\n"},
+                      headers=admin_headers)
+    assert resp.status_code == 400
+    resp = client.put("/ks/templates/bad.name", json={"template": "x\n"}, headers=admin_headers)
+    assert resp.status_code == 400
+    assert client.put("/ks/templates/site", json={"template": "x"}).status_code == 401
+
+
+def test_kickstart_templates_are_changed_by_admin_tokens_only(client, auth_headers,
+                                                              admin_headers, app):
+    """Other tokens get 403, and nobody can replace or remove the built-in template."""
+    resp = client.put("/ks/templates/site", json={"template": _SITE_TEMPLATE},
+                      headers=auth_headers)
+    assert resp.status_code == 403
+    assert client.get("/ks/templates/site", headers=auth_headers).status_code == 404
+    assert client.put("/ks/templates/site", json={"template": _SITE_TEMPLATE},
+                      headers=admin_headers).status_code == 200
+    assert client.delete("/ks/templates/site", headers=auth_headers).status_code == 403
+    assert client.get("/ks/templates/site", headers=auth_headers).status_code == 200
+
+    for headers in (auth_headers, admin_headers):
+        resp = client.put("/ks/templates/default", json={"template": "%pre\nreboot\n"},
+                          headers=headers)
+        assert resp.status_code == 403
+        assert client.delete("/ks/templates/default", headers=headers).status_code == 403
+    assert not os.path.exists(os.path.join(app.config["KICKSTART_TEMPLATE_PATH"], "default.ks"))
+
+    # A default.ks dropped into the directory does not replace it either.
+    with open(os.path.join(app.config["KICKSTART_TEMPLATE_PATH"], "default.ks"), "w",
+              encoding="ascii") as f:
+        f.write("%pre\nreboot\n")
+    resp = client.get("/ks/templates/default", headers=auth_headers).get_json()
+    assert resp["builtin"] is True
+    assert resp["template"] == app_module.DEFAULT_KICKSTART_TEMPLATE
+    assert "built-in" in resp["error"]
+
+
+def test_post_ks_batch_reports_unknown_template(client, auth_headers):
+    """An unknown template fails only its own batch item."""
+    items = [_VALID_PAYLOAD, {**_VALID_PAYLOAD, "template": "missing"}]
+    results = client.post("/ks/batch", json=items, headers=auth_headers).get_json()["results"]
+    assert results[0]["image_file"].endswith(".img")
+    assert "template" in results[1]["errors"]
+
+
+# ── Database production mode ──────────────────────────────────────────────────
+
+
+def test_sqlite_pragmas(tmp_path):
+    """New connections are switched to WAL with relaxed syncing and a busy timeout."""
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'pragmas.db'}")
+    sqlalchemy.event.listen(engine, "connect", app_module.set_sqlite_pragmas)
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert connection.exec_driver_sql("PRAGMA synchronous").scalar() == 1
+        assert connection.exec_driver_sql("PRAGMA busy_timeout").scalar() == 30000
+    engine.dispose()
+
+
+def _floppy(name):
+    """Return an unsaved floppy record called ``name``."""
+    return KickstartFloppyModel(name, f"http://localhost/ks/{name}", "192.168.1.5",
+                                datetime.datetime.now() + datetime.timedelta(hours=1))
+
+
+def test_group_commit_coalesces_concurrent_inserts(app, monkeypatch):
+    """Requests arriving while a commit is running share the next transaction."""
+    group_commit = models.GroupCommit()
+    transactions = []
+    first_insert = threading.Event()
+    real_insert = models.GroupCommit._insert  # pylint: disable=protected-access
+
+    def slow_insert(connection, objects):
+        transactions.append(len(objects))
+        first_insert.set()
+        time.sleep(0.2)
+        real_insert(connection, objects)
+
+    monkeypatch.setattr(models.GroupCommit, "_insert", staticmethod(slow_insert))
+
+    def create(name):
+        with app.app_context():
+            db.session.add(_floppy(name))
+            group_commit.commit(db.session)
+
+    threads = [threading.Thread(target=create, args=(f"group{i}.img",)) for i in range(10)]
+    threads[0].start()
+    first_insert.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert transactions == [1, 9]
+    with app.app_context():
+        assert db.session.execute(
+            db.select(db.func.count()).select_from(KickstartFloppyModel)).scalar() == 10
+
+
+def test_group_commit_isolates_failing_inserts(app):
+    """A request whose insert fails gets the error without failing the rest of its group."""
+    group_commit = models.GroupCommit()
+    with app.app_context():
+        db.session.add(_floppy("taken.img"))
+        db.session.commit()
+    items = [models._GroupCommitItem([_floppy("taken.img")]),  # pylint: disable=protected-access
+             models._GroupCommitItem([_floppy("free.img")])]  # pylint: disable=protected-access
+    with app.app_context():
+        group_commit._write(items)  # pylint: disable=protected-access
+        assert isinstance(items[0].error, sqlalchemy.exc.IntegrityError)
+        assert items[1].error is None
+        assert db.session.execute(
+            db.select(KickstartFloppyModel).filter_by(image_file="free.img")).first()
+
+
+# ── Expiry cleanup ────────────────────────────────────────────────────────────
+
+
+def test_cleanup_deletes_expired_rows_in_batches(app, monkeypatch):
+    """Cleanup removes only expired rows and images, batch by batch, and reports the total."""
+    monkeypatch.setitem(app.config, "KICKSTART_CLEANUP_BATCH_SIZE", 100)
+    now = datetime.datetime.now()
+    rows = []
+    for i in range(250):
+        expired = i % 2 == 0
+        image_file = f"{i:08d}.img"
+        rows.append({"image_file": image_file, "image_url": f"http://localhost/ks/{image_file}",
+                     "allowed_ip": "192.168.1.5",
+                     "expires_at": now + datetime.timedelta(minutes=-1 if expired else 60)})
+        path = os.path.join(app.config["KICKSTART_IMAGE_PATH"], image_file)
+        with open(path, "wb") as f:
+            f.write(b"x" * 10)
+    with app.app_context():
+        db.session.execute(db.insert(KickstartFloppyModel), rows)
+        db.session.commit()
+
+    # Reclaimed bytes are the disk blocks the files used.
+    assert app_module.cleanup() == (125, 125 * os.stat(path).st_blocks * 512)
+    with app.app_context():
+        remaining = db.session.execute(db.select(KickstartFloppyModel.image_file)).scalars().all()
+    assert sorted(remaining) == [f"{i:08d}.img" for i in range(1, 250, 2)]
+    assert sorted(os.listdir(app.config["KICKSTART_IMAGE_PATH"])) == sorted(remaining)
+    assert app_module.cleanup() == (0, 0)
+
+
+class _RecordingScheduler:
+    """Stands in for APScheduler, recording when the cleanup job is armed for."""
+
+    def __init__(self):
+        self.run_dates = []
+        self.jobs = {}
+
+    def add_job(self, job_id, func, **kwargs):
+        """Record the run date of a scheduled job."""
+        assert job_id not in self.jobs or kwargs.get("replace_existing")
+        self.jobs[job_id] = func
+        self.run_dates.append(kwargs["run_date"])
+
+    def remove_job(self, job_id):
+        """Drop a scheduled job, raising LookupError like APScheduler if there is none."""
+        del self.jobs[job_id]
+
+    def fire(self):
+        """Run the one pending job and then remove it, as APScheduler does with date jobs."""
+        (job_id, func), = self.jobs.items()
+        func()
+        self.jobs.pop(job_id, None)
+
+
+def test_expiry_queue_arms_earliest_deadline(app, monkeypatch):
+    """The cleanup job always waits for the earliest pending expiry and is re-armed after running."""
+    monkeypatch.setitem(app.config, "KICKSTART_EXPIRY_RESYNC_SECONDS", 0)
+    scheduler = _RecordingScheduler()
+    cleanups = []
+    queue = expiry.ExpiryQueue(app, lambda: cleanups.append(True), scheduler)
+    queue.seed()
+    now = datetime.datetime.now()
+    queue.push(now + datetime.timedelta(minutes=60))
+    queue.push(now + datetime.timedelta(minutes=10))
+    queue.push(now + datetime.timedelta(minutes=30))
+    assert scheduler.run_dates == [now + datetime.timedelta(minutes=60),
+                                   now + datetime.timedelta(minutes=10)]
+
+    queue.push(now - datetime.timedelta(seconds=1))
+    queue.run()
+    assert cleanups == [True]
+    assert scheduler.run_dates[-1] == now + datetime.timedelta(minutes=10)
+    assert len(queue.deadlines) == 3
+
+
+def test_expiry_queue_rearm_survives_removal_of_fired_job(app, monkeypatch):
+    """The job armed by a run is not the one the scheduler removes after that run."""
+    monkeypatch.setitem(app.config, "KICKSTART_EXPIRY_RESYNC_SECONDS", 0)
+    scheduler = _RecordingScheduler()
+    queue = expiry.ExpiryQueue(app, lambda: None, scheduler)
+    queue.seed()
+    now = datetime.datetime.now()
+    queue.push(now + datetime.timedelta(minutes=10))
+    queue.push(now + datetime.timedelta(minutes=5))
+    assert len(scheduler.jobs) == 1
+
+    scheduler.fire()
+    assert list(scheduler.jobs) == [queue.job_id]
+    assert scheduler.run_dates[-1] == now + datetime.timedelta(minutes=5)
+
+
+def test_expiry_queue_rearms_after_failed_cleanup(app, monkeypatch):
+    """A cleanup that raises is retried later instead of leaving the job unarmed."""
+    monkeypatch.setitem(app.config, "KICKSTART_EXPIRY_RESYNC_SECONDS", 0)
+
+    def locked():
+        raise sqlalchemy.exc.OperationalError("DELETE", {}, Exception("database is locked"))
+
+    scheduler = _RecordingScheduler()
+    queue = expiry.ExpiryQueue(app, locked, scheduler)
+    queue.seed()
+    now = datetime.datetime.now()
+    queue.push(now - datetime.timedelta(seconds=1))
+    queue.push(now + datetime.timedelta(minutes=10))
+    queue.run()
+    retry = scheduler.run_dates[-1] - datetime.datetime.now()
+    assert datetime.timedelta(0) < retry <= expiry.CLEANUP_RETRY_DELAY
+
+    # A deadline pushed after the armed run was missed re-arms the job.
+    queue.next_run = now - datetime.timedelta(seconds=1)
+    queue.push(now + datetime.timedelta(minutes=20))
+    assert queue.next_run > now
+
+
+def test_expiry_queue_resyncs_with_other_processes(app, monkeypatch):
+    """The cleanup job runs at least every resync interval and arms for rows it did not create."""
+    monkeypatch.setitem(app.config, "KICKSTART_EXPIRY_RESYNC_SECONDS", 60)
+    scheduler = _RecordingScheduler()
+    queue = expiry.ExpiryQueue(app, app_module.cleanup, scheduler)
+    queue.push(datetime.datetime.now())
+    assert not scheduler.run_dates  # not the leader yet
+
+    queue.seed()
+    assert scheduler.run_dates[-1] - datetime.datetime.now() <= datetime.timedelta(seconds=60)
+
+    # Another process creates a floppy expiring before the next resync.
+    expires_at = datetime.datetime.now() + datetime.timedelta(seconds=30)
+    with app.app_context():
+        db.session.add(KickstartFloppyModel("other.img", "http://localhost/ks/other.img",
+                                            "192.168.1.5", expires_at))
+        db.session.commit()
+    queue.run()
+    assert scheduler.run_dates[-1] == expires_at
+
+
+def test_scheduler_leader_hands_over_when_released(tmp_path):
+    """Only one SchedulerLeader holds the lock; a waiting one takes over once it is released."""
+    lock_file = str(tmp_path / "scheduler.lock")
+    elected = []
+    leader = expiry.SchedulerLeader(lock_file, lambda: elected.append("leader"))
+    follower = expiry.SchedulerLeader(lock_file, lambda: elected.append("follower"))
+
+    assert leader.start()
+    assert not follower.start()
+    assert elected == ["leader"]
+
+    leader.release()
+    assert follower.elected.wait(5)
+    assert elected == ["leader", "follower"]
+    follower.release()
+
+
+def test_get_kickstart_floppy_refuses_expired_row(client, app, blank_img):
+    """An expired floppy is not served even before cleanup has removed it."""
+    floppy_name = "expired.img"
+    shutil.copyfile(blank_img, os.path.join(app.config["KICKSTART_IMAGE_PATH"], floppy_name))
+    with app.app_context():
+        db.session.add(KickstartFloppyModel(
+            floppy_name, f"http://localhost/ks/{floppy_name}", "127.0.0.1",
+            datetime.datetime.now() - datetime.timedelta(seconds=1)))
+        db.session.commit()
+
+    assert client.get(f"/ks/{floppy_name}").status_code == 404
+
+
+def test_expires_at_is_indexed(app):
+    """Cleanup looks expired rows up by an index on expires_at."""
+    with app.app_context():
+        indexes = db.inspect(db.engine).get_indexes(KickstartFloppyModel.__tablename__)
+    assert any(index["column_names"] == ["expires_at"] for index in indexes)
+
+
+# ── POST /ks/batch ────────────────────────────────────────────────────────────
+
+
+@pytest.mark.integration
+def test_post_ks_batch_mixed_results(client, auth_headers, app):
+    """POST /ks/batch creates valid items and reports per-item validation errors."""
+    items = [_VALID_PAYLOAD, {**_VALID_PAYLOAD, "ip": "not-an-ip"},
+             {**_VALID_PAYLOAD, "hostname": "esxi02.example.com"}]
+    resp = client.post("/ks/batch", json=items, headers=auth_headers)
+    assert resp.status_code == 200
+
+    results = resp.get_json()["results"]
+    assert [r["index"] for r in results] == [0, 1, 2]
+    assert "ip" in results[1]["errors"]
+    for result in (results[0], results[2]):
+        assert result["image_file"].endswith(".img")
+        assert result["allowed_ip"] == _VALID_PAYLOAD["allowed_ip"]
+        floppy_path = os.path.join(app.config["KICKSTART_IMAGE_PATH"], result["image_file"])
+        assert os.path.exists(floppy_path)
+    with app.app_context():
+        assert len(db.session.execute(db.select(KickstartFloppyModel)).all()) == 2
+
+
+@pytest.mark.integration
+def test_post_ks_batch_ndjson(client, auth_headers, app, monkeypatch):
+    """With Accept: application/x-ndjson results are streamed one JSON object per line."""
+    monkeypatch.setitem(app.config, "KICKSTART_BATCH_COMMIT_SIZE", 2)
+    headers = {**auth_headers, "Accept": "application/x-ndjson"}
+    resp = client.post("/ks/batch", json=[_VALID_PAYLOAD] * 5, headers=headers)
+    assert resp.status_code == 200
+    assert resp.mimetype == "application/x-ndjson"
+
+    lines = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+    assert [line["index"] for line in lines] == list(range(5))
+    assert all("image_url" in line for line in lines)
+    with app.app_context():
+        assert len(db.session.execute(db.select(KickstartFloppyModel)).all()) == 5
+
+
+def test_post_ks_batch_rejects_non_list(client, auth_headers):
+    """POST /ks/batch returns 400 when the body is not a JSON list."""
+    resp = client.post("/ks/batch", json=_VALID_PAYLOAD, headers=auth_headers)
+    assert resp.status_code == 400
+
+
+def test_post_ks_batch_rejects_oversized_batch(client, auth_headers, app, monkeypatch):
+    """POST /ks/batch returns 413 when the batch exceeds KICKSTART_BATCH_MAX."""
+    monkeypatch.setitem(app.config, "KICKSTART_BATCH_MAX", 2)
+    resp = client.post("/ks/batch", json=[_VALID_PAYLOAD] * 3, headers=auth_headers)
+    assert resp.status_code == 413
@@ -0,0 +1,130 @@
+"""Tests for GET /metrics and the metrics module."""
+
+import datetime
+import re
+
+import pytest
+
+import app as app_module
+from app import KickstartFloppyModel, db
+from metrics import Registry
+
+_VALID_PAYLOAD = {
+    "hostname": "esxi01.example.com",
+    "rootpw": "$1$salt$hashedpassword",
+    "disk": "sda",
+    "ip": "192.168.1.10",
+    "netmask": "255.255.255.0",
+    "gateway": "192.168.1.1",
+    "nameserver": ["8.8.8.8"],
+    "allowed_ip": "192.168.1.5",
+}
+
+
+def _samples(client):
+    """Return the samples reported by GET /metrics as ``{'name{labels}': value}``."""
+    resp = client.get("/metrics")
+    assert resp.status_code == 200
+    assert resp.content_type.startswith("text/plain; version=0.0.4")
+    samples = {}
+    for line in resp.get_data(as_text=True).splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples
+
+
+def test_registry_renders_prometheus_text():
+    """Counters, gauges and histograms render in the Prometheus text format."""
+    registry = Registry()
+    counter = registry.counter("c_total", "A counter.", ("status",))
+    gauge = registry.gauge("g", "A gauge.")
+    histogram = registry.histogram("h_seconds", "A histogram.", ("stage",), buckets=(0.1, 1.0))
+    counter.inc(status=404)
+    counter.inc(2, status=404)
+    gauge.set(7)
+    for value in (0.05, 0.1, 0.5, 5):
+        histogram.observe(value, stage='a"b')
+    assert registry.render() == (
+        "# HELP c_total A counter.\n"
+        "# TYPE c_total counter\n"
+        'c_total{status="404"} 3\n'
+        "# HELP g A gauge.\n"
+        "# TYPE g gauge\n"
+        "g 7\n"
+        "# HELP h_seconds A histogram.\n"
+        "# TYPE h_seconds histogram\n"
+        'h_seconds_bucket{stage="a\\"b",le="0.1"} 2\n'
+        'h_seconds_bucket{stage="a\\"b",le="1.0"} 3\n'
+        'h_seconds_bucket{stage="a\\"b",le="+Inf"} 4\n'
+        'h_seconds_sum{stage="a\\"b"} 5.65\n'
+        'h_seconds_count{stage="a\\"b"} 4\n'
+    )
+    with pytest.raises(ValueError):
+        counter.inc(endpoint="x")
+
+
+def test_metrics_report_kickstart_stages_and_statuses(client, auth_headers):
+    """Creating and fetching floppies shows up in the stage histograms and request counters."""
+    before = _samples(client)
+    image_file = client.post("/ks", json=_VALID_PAYLOAD, headers=auth_headers).get_json()["image_file"]
+    assert client.get(f"/ks/{image_file}").status_code == 401
+    assert client.get("/ks/missing.img").status_code == 404
+    after = _samples(client)
+
+    def delta(name):
+        return after.get(name, 0) - before.get(name, 0)
+
+    for stage in ("validate", "render_kickstart", "build_image", "store_image", "commit"):
+        assert delta(f'ksfloppy_stage_duration_seconds_count'
+                     f'{{operation="kickstart",stage="{stage}"}}') == 1
+    assert delta('ksfloppy_http_requests_total'
+                 '{endpoint="create_kickstart_floppy",method="POST",status="201"}') == 1
+    assert delta('ksfloppy_http_requests_total'
+                 '{endpoint="get_kickstart_floppy",method="GET",status="401"}') == 1
+    assert delta('ksfloppy_http_requests_total'
+                 '{endpoint="get_kickstart_floppy",method="GET",status="404"}') == 1
+    assert after["ksfloppy_live_images"] == 1
+    assert after['ksfloppy_stored_bytes{kind="kickstart_images"}'] > 0
+
+
+def test_metrics_count_cleanup_deletions(app, client, auth_headers):
+    """Rows removed by cleanup are counted, with the bytes reclaimed."""
+    client.post("/ks", json=_VALID_PAYLOAD, headers=auth_headers)
+    before = _samples(client)
+    with app.app_context():
+        db.session.execute(db.update(KickstartFloppyModel).values(
+            expires_at=datetime.datetime.now() - datetime.timedelta(minutes=1)))
+        db.session.commit()
+    app_module.cleanup()
+    after = _samples(client)
+    assert after["ksfloppy_cleanup_deleted_total"] - before["ksfloppy_cleanup_deleted_total"] == 1
+    assert (after["ksfloppy_cleanup_reclaimed_bytes_total"]
+            - before["ksfloppy_cleanup_reclaimed_bytes_total"]) > 0
+    assert after["ksfloppy_live_images"] == 0
+
+
+def test_metrics_token_can_be_required(app, client, auth_headers, monkeypatch):
+    """With METRICS_REQUIRE_TOKEN set, GET /metrics needs a valid API token."""
+    monkeypatch.setitem(app.config, "METRICS_REQUIRE_TOKEN", True)
+    assert client.get("/metrics").status_code == 401
+    assert client.get("/metrics", headers={"X-API-Key": "wrong"}).status_code == 401
+    resp = client.get("/metrics", headers=auth_headers)
+    assert resp.status_code == 200
+    assert re.search(r"^# TYPE ksfloppy_stage_duration_seconds histogram$",
+                     resp.get_data(as_text=True), re.M)
+
+
+@pytest.mark.integration
+def test_metrics_report_iso_stages(client, auth_headers, sample_iso):
+    """Uploading an ISO shows up in the ISO stage histograms and the stored ISO bytes."""
+    before = _samples(client)
+    with open(sample_iso, "rb") as f:
+        resp = client.post("/esxi", data={"file": (f, "esxi.iso")},
+                           content_type="multipart/form-data", headers=auth_headers)
+    assert resp.status_code == 201
+    after = _samples(client)
+    for stage in ("receive", "store"):
+        name = f'ksfloppy_stage_duration_seconds_count{{operation="iso",stage="{stage}"}}'
+        assert after[name] - before.get(name, 0) == 1
+    assert after['ksfloppy_stored_bytes{kind="esxi_isos"}'] > 0
@@ -0,0 +1,66 @@
+"""Tests for admin request profiling: X-Profile, GET /profiles and GET /profiles/<id>."""
+
+import os
+import pstats
+
+import pytest
+
+from profiles import profile_lock
+
+
+@pytest.fixture(autouse=True)
+def _clean_profiles(app):
+    """Remove the profiles a test stored."""
+    yield
+    for name in os.listdir(app.config["PROFILE_PATH"]):
+        os.remove(os.path.join(app.config["PROFILE_PATH"], name))
+
+
+def test_profile_is_stored_for_admin_tokens(client, admin_headers, tmp_path):
+    """X-Profile: 1 from an admin token stores a pstats profile that can be listed and downloaded."""
+    resp = client.get("/esxi", headers={**admin_headers, "X-Profile": "1"})
+    assert resp.status_code == 200
+    profile_id = resp.headers["X-Profile-Id"]
+
+    profiles = client.get("/profiles", headers=admin_headers).get_json()["profiles"]
+    assert [(p["profile_id"], p["endpoint"]) for p in profiles] == [
+        (profile_id, "esxi.get_esxi_isos")]
+
+    resp = client.get(f"/profiles/{profile_id}", headers=admin_headers)
+    assert resp.status_code == 200
+    path = tmp_path / "download.prof"
+    path.write_bytes(resp.data)
+    assert any(func[2] == "get_esxi_isos" for func in pstats.Stats(str(path)).stats)
+
+    resp = client.get(f"/profiles/{profile_id}?format=text&limit=5", headers=admin_headers)
+    assert resp.content_type.startswith("text/plain")
+    assert "cumulative" in resp.get_data(as_text=True)
+
+
+def test_profile_requires_admin_token(client, auth_headers, admin_headers):
+    """Other tokens neither get their requests profiled nor see the profiles."""
+    resp = client.get("/esxi", headers={**auth_headers, "X-Profile": "1"})
+    assert resp.status_code == 200
+    assert "X-Profile-Id" not in resp.headers
+    assert client.get("/profiles", headers=admin_headers).get_json()["profiles"] == []
+    assert client.get("/profiles", headers=auth_headers).status_code == 403
+    assert client.get("/profiles").status_code == 401
+    assert client.get("/profiles/token_hashes", headers=admin_headers).status_code == 404
+
+
+def test_profiles_are_a_ring_buffer(app, client, admin_headers, monkeypatch):
+    """Only the newest PROFILE_KEEP profiles are kept."""
+    monkeypatch.setitem(app.config, "PROFILE_KEEP", 3)
+    ids = [client.get("/esxi", headers={**admin_headers, "X-Profile": "1"}).headers["X-Profile-Id"]
+           for _ in range(5)]
+    profiles = client.get("/profiles", headers=admin_headers).get_json()["profiles"]
+    assert [p["profile_id"] for p in profiles] == ids[:1:-1]
+    assert len(os.listdir(app.config["PROFILE_PATH"])) == 3
+
+
+def test_profiling_is_released_after_errors(client, admin_headers):
+    """A profiled request that fails still stores its profile and frees the profiler."""
+    resp = client.get("/ks/missing.img", headers={**admin_headers, "X-Profile": "1"})
+    assert resp.status_code == 404
+    assert "X-Profile-Id" in resp.headers
+    assert not profile_lock.locked()
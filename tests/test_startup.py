@@ -0,0 +1,145 @@
+"""
+Tests for the cost of importing the application.
+
+Every WSGI worker imports ``app`` before it can serve a request, so the
+import must not pull in modules that only some requests need or do work that
+can wait for the first request.  These tests import the module in a fresh
+interpreter with ``-X importtime``.
+"""
+
+import glob
+import os
+import shutil
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+import app as app_module
+from app import db
+
+APP_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Generous enough for slow CI runners; apiflask and SQLAlchemy alone take
+# about 600 ms of it on a typical machine.
+IMPORT_BUDGET_US = 2_000_000
+
+# Only needed for uploads that cannot be patched while streaming, and by the
+# process running the background jobs.
+LAZY_MODULES = ("pycdlib", "apscheduler", "flask_apscheduler")
+
+
+@pytest.fixture(name="import_times")
+def fixture_import_times():
+    """Import app in a fresh interpreter and return ``{module: cumulative µs}``."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        cwd=APP_ROOT, env={**os.environ, "PYTHONPATH": APP_ROOT},
+        capture_output=True, text=True, check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_import_skips_heavy_optional_modules(import_times):
+    """pycdlib and APScheduler are only imported once they are used."""
+    assert "app" in import_times
+    loaded = [name for name in import_times if name.split(".")[0] in LAZY_MODULES]
+    assert not loaded
+
+
+def test_import_within_budget(import_times):
+    """Importing app stays within the startup budget."""
+    assert import_times["app"] < IMPORT_BUDGET_US
+
+
+def test_first_request_initializes(app, client, tmp_path, monkeypatch):
+    """The tables and image directories are created by the first request."""
+    ks_path = str(tmp_path / "ks")
+    monkeypatch.setitem(app.config, "KICKSTART_IMAGE_PATH", ks_path)
+    monkeypatch.setattr(app_module, "initialized", app_module.threading.Event())
+    with app.app_context():
+        db.drop_all()
+    client.get("/ks/missing.img")
+    assert os.path.isdir(ks_path)
+    with app.app_context():
+        assert db.inspect(db.engine).has_table(app_module.KickstartFloppyModel.__tablename__)
+    assert app_module.scheduler is None  # BACKGROUND_JOBS is off in the tests
+
+
+def test_first_request_adds_new_columns(app, client, monkeypatch):
+    """Columns added by newer versions are added to tables created by older ones."""
+    monkeypatch.setattr(app_module, "initialized", app_module.threading.Event())
+    with app.app_context():
+        db.drop_all()
+        with db.engine.begin() as connection:
+            connection.execute(db.text(
+                "CREATE TABLE kickstart_floppy_model (id INTEGER PRIMARY KEY, "
+                "image_file VARCHAR(12) NOT NULL UNIQUE, image_url VARCHAR(255) NOT NULL UNIQUE, "
+                "allowed_ip VARCHAR(39) NOT NULL, expires_at DATETIME NOT NULL)"))
+    client.get("/ks/missing.img")
+    with app.app_context():
+        columns = {c["name"] for c in db.inspect(db.engine).get_columns("kickstart_floppy_model")}
+        indexes = {i["name"] for i in db.inspect(db.engine).get_indexes("kickstart_floppy_model")}
+    assert {"image_blob", "content_hash"} <= columns
+    assert "ix_kickstart_floppy_model_image_blob" in indexes
+
+
+def _copy_app(tmp_path, config=""):
+    """Copy the app to ``tmp_path`` with its own instance folder and ``config`` in tokens.py."""
+    # The instance folder sits next to app.py, so each copy gets its own.
+    for path in glob.glob(os.path.join(APP_ROOT, "*.py")) + [os.path.join(APP_ROOT, "blank.img")]:
+        shutil.copy(path, tmp_path)
+    (tmp_path / "instance").mkdir(exist_ok=True)
+    (tmp_path / "instance" / "tokens.py").write_text(textwrap.dedent(f"""\
+        TOKENS = {{'test-token': 'test'}}
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///{tmp_path / "ks.db"}'
+        BACKGROUND_JOBS = False
+    """) + textwrap.dedent(config))
+
+
+def _run_app(tmp_path, script):
+    """Run ``script`` against the copy of the app in ``tmp_path``."""
+    return subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=tmp_path, env={**os.environ, "PYTHONPATH": str(tmp_path)},
+        capture_output=True, text=True, check=True,
+    )
+
+
+def test_database_production_mode_is_read_at_setup(tmp_path):
+    """An app built with DATABASE_PRODUCTION_MODE uses WAL and group commits for POST /ks."""
+    _copy_app(tmp_path, "DATABASE_PRODUCTION_MODE = True\n")
+    script = textwrap.dedent("""\
+        import app
+        commits = []
+        commit = app.group_commit.commit
+        app.group_commit.commit = lambda session: commits.append(commit(session))
+        # Changing the config after setup does not switch modes.
+        app.app.config['DATABASE_PRODUCTION_MODE'] = False
+        resp = app.app.test_client().post('/ks', headers={'X-API-Key': 'test-token'}, json={
+            'hostname': 'esxi01.example.com', 'rootpw': '$1$salt$hashedpassword',
+            'disk': 'sda', 'ip': '192.168.1.10', 'netmask': '255.255.255.0',
+            'gateway': '192.168.1.1', 'nameserver': ['8.8.8.8'], 'allowed_ip': '192.168.1.5'})
+        with app.app.app_context():
+            journal_mode = app.db.session.execute(app.db.text('PRAGMA journal_mode')).scalar()
+        print(resp.status_code, journal_mode, len(commits))
+    """)
+    assert _run_app(tmp_path, script).stdout.split() == ["201", "wal", "1"]
+
+
+def test_token_file_without_index_key_warns(tmp_path):
+    """Starting with a token file but no TOKEN_INDEX_KEY logs a warning."""
+    _copy_app(tmp_path)
+    (tmp_path / "instance" / "token_hashes.json").write_text("[]")
+    assert "TOKEN_INDEX_KEY is not set" in _run_app(tmp_path, "import app").stderr
+
+    _copy_app(tmp_path, "TOKEN_INDEX_KEY = 'a long random secret'\n")
+    assert "TOKEN_INDEX_KEY" not in _run_app(tmp_path, "import app").stderr
@@ -0,0 +1,152 @@
+"""API tokens kept as salted hashes in a JSON file that is reloaded when it changes.
+
+Each entry in the file records a token's ``name``, an ``index`` digest used
+to find the entry in a dict, and a ``salt`` and PBKDF2 ``hash`` that the
+presented token is checked against with a constant-time comparison. The
+index is an HMAC of the token under a key kept outside the file, so the
+file alone reveals nothing that can be used to look tokens up.
+
+``add_token`` and ``remove_tokens`` replace the file atomically, so a
+running ``HashedTokenStore`` never reads a half-written file.
+"""
+
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+PBKDF2_ITERATIONS = 100_000
+
+
+def token_index(token, index_key):
+    """Return the hex digest a token is looked up by."""
+    return hmac.new(index_key, token.encode(), hashlib.sha256).hexdigest()
+
+
+def token_hash(token, salt, iterations=PBKDF2_ITERATIONS):
+    """Return the salted hash a token is verified against."""
+    return hashlib.pbkdf2_hmac('sha256', token.encode(), salt, iterations).hex()
+
+
+def _read_entries(path):
+    """Return the entries of a token file, or an empty list if it does not exist."""
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+
+def _write_entries(path, entries):
+    """Atomically replace a token file with ``entries``, keeping its permissions."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.tokens-')
+    try:
+        try:
+            os.chmod(tmp_path, os.stat(path).st_mode)
+        except FileNotFoundError:
+            os.chmod(tmp_path, 0o640)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(entries, f, indent=1)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def add_token(path, name, index_key):
+    """Create a new token called ``name``, add its hashes to the file and return it."""
+    token = secrets.token_urlsafe()
+    salt = secrets.token_bytes(16)
+    entries = _read_entries(path)
+    entries.append({
+        'name': name,
+        'index': token_index(token, index_key),
+        'salt': salt.hex(),
+        'iterations': PBKDF2_ITERATIONS,
+        'hash': token_hash(token, salt),
+    })
+    _write_entries(path, entries)
+    return token
+
+
+def remove_tokens(path, name):
+    """Remove every token called ``name`` from the file and return how many there were."""
+    entries = _read_entries(path)
+    kept = [entry for entry in entries if entry['name'] != name]
+    if len(kept) != len(entries):
+        _write_entries(path, kept)
+    return len(entries) - len(kept)
+
+
+class HashedTokenStore:  # pylint: disable=too-many-instance-attributes,too-few-public-methods
+    """Verify API tokens against a hashed token file.
+
+    The file is reloaded whenever its inode, size or mtime changes, which
+    costs one ``stat`` per lookup. Successfully verified tokens are cached
+    by their index digest for ``cache_ttl`` seconds, up to ``cache_size``
+    of them, so only the first request with a token pays for PBKDF2. The
+    cache is dropped on every reload so that removed tokens stop working
+    immediately.
+    """
+
+    def __init__(self, path, index_key, cache_ttl=60, cache_size=1024):
+        self.path = path
+        self.index_key = index_key
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.entries = {}
+        self.signature = None
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _reload_if_changed(self):
+        """Reload the token file if it has changed since it was last read."""
+        try:
+            stat = os.stat(self.path)
+            signature = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            signature = None
+        if signature == self.signature:
+            return
+        entries = {}
+        for entry in _read_entries(self.path) if signature else []:
+            entries[entry['index']] = entry
+        with self.lock:
+            self.entries = entries
+            self.signature = signature
+            self.cache.clear()
+
+    def verify(self, token):
+        """Return the name of a valid token, or None."""
+        self._reload_if_changed()
+        index = token_index(token, self.index_key)
+        now = time.monotonic()
+        with self.lock:
+            cached = self.cache.get(index)
+            if cached is not None and cached[1] > now:
+                return cached[0]
+            entry = self.entries.get(index)
+            signature = self.signature
+        if entry is None:
+            return None
+        expected = token_hash(token, bytes.fromhex(entry['salt']),
+                              entry.get('iterations', PBKDF2_ITERATIONS))
+        if not hmac.compare_digest(expected, entry['hash']):
+            return None
+        with self.lock:
+            if self.signature != signature:
+                # The file was reloaded while hashing; the token may have been removed.
+                current = self.entries.get(index)
+                if current is None or current['hash'] != entry['hash']:
+                    return None
+                return current['name']
+            self.cache[index] = (entry['name'], now + self.cache_ttl)
+            self.cache.move_to_end(index)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return entry['name']